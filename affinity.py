@@ -0,0 +1,225 @@
+"""
+ChainRad
+========
+
+File: thread counts, CPU affinity and NUMA placement
+"""
+
+
+# Standard library imports
+from glob import glob
+from os import cpu_count, environ
+try:
+    from os import sched_getaffinity, sched_setaffinity
+except ImportError:
+    sched_getaffinity, sched_setaffinity = None, None
+from os.path import basename
+from re import fullmatch
+
+# 3rd party imports
+import torch
+
+
+MEMINFO_FILE = '/proc/meminfo'
+NODE_DIR = '/sys/devices/system/node'
+THREAD_ENV_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                        'OPENBLAS_NUM_THREADS']
+
+
+def configure_process(intra_op_threads : int = None,
+                      inter_op_threads : int = None, cpus : list = None
+                      ) -> dict:
+    """
+    Configure threading and CPU affinity of the process
+    ===================================================
+
+    Parameters
+    ----------
+    intra_op_threads : int, optional (None if omitted)
+        Threads of a single torch operator. If omitted and cpus is given, it
+        is the number of cpus, otherwise it is left unchanged.
+    inter_op_threads : int, optional (None if omitted)
+        Threads running independent torch operators. If omitted, it is left
+        unchanged.
+    cpus : list, optional (None if omitted)
+        CPUs to pin the process to. If omitted, the affinity is left
+        unchanged.
+
+    Returns
+    -------
+    dict
+        The applied configuration with the keys 'intra_op_threads',
+        'inter_op_threads' and 'cpus' (None where the platform has no CPU
+        affinity).
+
+    Notes
+    -----
+        torch accepts the inter-op thread count only before the first
+        parallel work, so call it before SessionSetup.setup(). If it is too
+        late, the current value is kept and reported. The thread environment
+        variables are set too, so processes started from here inherit them.
+    """
+
+    if cpus is not None:
+        if sched_setaffinity is not None:
+            sched_setaffinity(0, set(cpus))
+        if intra_op_threads is None:
+            intra_op_threads = len(cpus)
+    if intra_op_threads is not None:
+        torch.set_num_threads(intra_op_threads)
+        for name in THREAD_ENV_VARIABLES:
+            environ[name] = str(intra_op_threads)
+    if inter_op_threads is not None and \
+       inter_op_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # Parallel work has already started in this process.
+            pass
+    return {'intra_op_threads' : torch.get_num_threads(),
+            'inter_op_threads' : torch.get_num_interop_threads(),
+            'cpus' : (get_available_cpus() if sched_getaffinity is not None
+                      else None)}
+
+
+def get_available_cpus() -> list:
+    """
+    Get the CPUs the process may run on
+    ===================================
+
+    Returns
+    -------
+    list[int]
+        CPU ids in ascending order.
+    """
+
+    if sched_getaffinity is not None:
+        return sorted(sched_getaffinity(0))
+    return list(range(cpu_count() or 1))
+
+
+def get_available_memory() -> float:
+    """
+    Get the memory available for new processes
+    ==========================================
+
+    Returns
+    -------
+    float | None
+        MemAvailable of /proc/meminfo in MB, None if the platform doesn't
+        provide it.
+    """
+
+    try:
+        with open(MEMINFO_FILE, 'r', encoding='utf8') as instream:
+            for line in instream:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def get_numa_nodes() -> list:
+    """
+    Get the available CPUs of every NUMA node
+    =========================================
+
+    Returns
+    -------
+    list[list[int]]
+        CPU ids by node, nodes without available CPUs are left out. Without
+        NUMA information every available CPU is in a single node.
+    """
+
+    available = set(get_available_cpus())
+    result = []
+    for node_dir in sorted(glob(NODE_DIR + '/node[0-9]*'),
+                           key=lambda name: int(basename(name)[4:])):
+        try:
+            with open(node_dir + '/cpulist', 'r', encoding='utf8') as instream:
+                cpus = [cpu for cpu in parse_cpu_list(instream.read())
+                        if cpu in available]
+        except (OSError, ValueError):
+            continue
+        if len(cpus) > 0:
+            result.append(cpus)
+    if len(result) == 0:
+        result = [sorted(available)]
+    return result
+
+
+def get_placement(instances : int, threads : int) -> list:
+    """
+    Place instances on CPUs
+    =======================
+
+    Parameters
+    ----------
+    instances : int
+        Number of instances.
+    threads : int
+        Intra-op threads, that is CPUs, per instance.
+
+    Returns
+    -------
+    list[list[int]]
+        CPUs of every instance.
+
+    Notes
+    -----
+        Instances are spread over the NUMA nodes round-robin and get
+        consecutive CPUs of their node, so an instance never spans two nodes
+        if a node has enough CPUs, and with the default first-touch policy
+        its memory is allocated on its own node. When the CPUs run out,
+        placement starts again from the first CPU of the node, which means
+        oversubscription. An instance gets at most the CPUs of its node.
+    """
+
+    nodes = get_numa_nodes()
+    cursors = [0] * len(nodes)
+    result = []
+    for i in range(instances):
+        node = i % len(nodes)
+        cpus = nodes[node]
+        count = min(threads, len(cpus))
+        if cursors[node] + count > len(cpus):
+            cursors[node] = 0
+        result.append(cpus[cursors[node]:cursors[node] + count])
+        cursors[node] += count
+    return result
+
+
+def parse_cpu_list(text : str) -> list:
+    """
+    Parse a CPU list like 0-3,8-11
+    ==============================
+
+    Parameters
+    ----------
+    text : str
+        CPU list in the format of Linux sysfs and taskset.
+
+    Returns
+    -------
+    list[int]
+        CPU ids.
+
+    Raises
+    ------
+    ValueError
+        When the text is not a CPU list.
+    """
+
+    result = []
+    for part in text.strip().split(','):
+        if part == '':
+            continue
+        match = fullmatch(r'(\d+)(?:-(\d+))?', part.strip())
+        if match is None:
+            raise ValueError('ChainRad couldn\'t parse the CPU list "{}".'
+                             .format(text))
+        first = int(match.group(1))
+        last = first if match.group(2) is None else int(match.group(2))
+        result.extend(range(first, last + 1))
+    return result
@@ -0,0 +1,132 @@
+"""
+ChainRad
+========
+
+File: memory budget of micro-batches
+"""
+
+
+# Standard library imports
+from weakref import finalize
+
+# 3rd party imports
+import torch
+
+
+DEFAULT_MEMORY_BUDGET = 512
+
+
+def get_activation_memory(model : torch.nn.Module, inputs : torch.Tensor
+                          ) -> int:
+    """
+    Measure activation memory of a forward pass
+    ===========================================
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Model in eval mode, on the device of inputs.
+    inputs : torch.Tensor
+        Probe batch.
+
+    Returns
+    -------
+    int
+        Peak memory of the forward pass above the weights and inputs in
+        bytes.
+
+    Notes
+    -----
+        On CUDA devices the allocator's peak is measured. On CPU there is no
+        such counter, so the tensors going in and out of the leaf modules
+        are tracked through the whole pass: a tensor counts from the leaf
+        that sees it first until Python frees it, and the peak is the
+        largest sum of live tensors at a leaf. Models keeping earlier
+        activations alive, like the concatenated features of DenseNet161 or
+        the identity branches of ResNet152, are counted so. Tensors are
+        counted per storage, so in-place results and views are counted
+        once.
+    """
+
+    if inputs.is_cuda:
+        torch.cuda.synchronize(inputs.device)
+        torch.cuda.reset_peak_memory_stats(inputs.device)
+        base = torch.cuda.memory_allocated(inputs.device)
+        with torch.no_grad():
+            model(inputs)
+        torch.cuda.synchronize(inputs.device)
+        return torch.cuda.max_memory_allocated(inputs.device) - base
+    live, peak, finalizers = {}, [0], []
+
+    def hook(module, args, output):
+        # pylint: disable=unused-argument
+        #         The signature is given by register_forward_hook().
+        for tensor in get_tensors(list(args) + [output]):
+            key = tensor.untyped_storage().data_ptr()
+            if key not in live.keys():
+                live[key] = tensor.untyped_storage().nbytes()
+                finalizers.append(finalize(tensor, live.pop, key, None))
+        peak[0] = max(peak[0], sum(live.values()))
+
+    handles = [module.register_forward_hook(hook) for module in model.modules()
+               if len(list(module.children())) == 0]
+    try:
+        with torch.no_grad():
+            model(inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+        for finalizer in finalizers:
+            finalizer.detach()
+    return peak[0]
+
+
+def get_micro_batch_size(memory_budget : float, sample_bytes : int,
+                         limit : int = None) -> int:
+    """
+    Get the number of samples that fit the memory budget
+    ====================================================
+
+    Parameters
+    ----------
+    memory_budget : float
+        Working memory of a micro-batch in MB, the loaded weights excluded.
+    sample_bytes : int
+        Working memory of a single sample in bytes.
+    limit : int, optional (None if omitted)
+        Upper bound, like the number of files to score.
+
+    Returns
+    -------
+    int
+        Micro-batch size, at least 1 even if a single sample exceeds the
+        budget.
+    """
+
+    result = max(1, int(memory_budget * 1048576 // max(sample_bytes, 1)))
+    if limit is not None:
+        result = max(1, min(result, limit))
+    return result
+
+
+def get_tensors(value : any) -> list:
+    """
+    Get tensors of a value
+    ======================
+
+    Parameters
+    ----------
+    value : any
+        Tensor, or tuple or list of tensors, other values are skipped.
+
+    Returns
+    -------
+    list[torch.Tensor]
+        The tensors in the value.
+    """
+
+    if isinstance(value, torch.Tensor):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [tensor for item in value for tensor in get_tensors(item)]
+    return []
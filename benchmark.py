@@ -0,0 +1,407 @@
+"""
+ChainRad
+========
+
+File: inference benchmark
+"""
+
+
+# Standard library imports
+from argparse import ArgumentParser
+from json import dump as json_dump, load as json_load
+from os import makedirs
+from os.path import isdir, isfile, join
+from platform import machine, processor, python_version
+from time import perf_counter, strftime
+
+try:
+    from resource import RUSAGE_SELF, getrusage
+except ImportError:
+    getrusage = None
+
+# 3rd party imports
+from PIL import Image
+import torch
+
+# Project level imports
+import inference
+from pipeline import Pipeline
+from session import InferenceSession
+
+
+BENCH_IMG_DIR = './bench_img'
+IMAGE_SIZE = 1024
+
+
+def compare(baseline : dict, candidate : dict,
+            tolerance : float = 0.1) -> list:
+    """
+    Compare two benchmark results
+    =============================
+
+    Parameters
+    ----------
+    baseline : dict
+        Earlier result, the content of a file written by run().
+    candidate : dict
+        Later result, the content of a file written by run().
+    tolerance : float, optional (0.1 if omitted)
+        Relative change that is still accepted.
+
+    Returns
+    -------
+    list[dict]
+        One entry per configuration present in both results with the keys
+        'config', 'metric', 'baseline', 'candidate', 'change' and
+        'regression'.
+
+    Notes
+    -----
+        The peak RSS is not compared, it's the peak of the whole process, not
+        the one of a configuration.
+    """
+
+    baseline_runs = {config_key(run_result) : run_result
+                     for run_result in baseline['runs']}
+    result = []
+    for run_result in candidate['runs']:
+        key = config_key(run_result)
+        if key not in baseline_runs.keys():
+            continue
+        for metric, higher_is_better in [('p50_ms', False), ('p95_ms', False),
+                                         ('p99_ms', False),
+                                         ('images_per_sec', True)]:
+            old, new = baseline_runs[key].get(metric), run_result.get(metric)
+            if old is None or new is None or old == 0:
+                continue
+            change = (new - old) / old
+            regression = (change < -tolerance if higher_is_better
+                          else change > tolerance)
+            result.append({'config' : key, 'metric' : metric,
+                           'baseline' : old, 'candidate' : new,
+                           'change' : change, 'regression' : regression})
+    return result
+
+
+def config_key(run_result : dict) -> str:
+    """
+    Get the key of a benchmark configuration
+    ========================================
+
+    Parameters
+    ----------
+    run_result : dict
+        A run entry of a benchmark result.
+
+    Returns
+    -------
+    str
+        Key in the form of 'backend/threads/batch_size', followed by '/p'
+        for pipelined runs and by '/v' and the head variant for runs of a
+        head variant.
+    """
+
+    return '{}/t{}/b{}{}{}'.format(run_result['backend'],
+                                   run_result['threads'],
+                                   run_result['batch_size'],
+                                   '/p' if run_result.get('pipeline', False)
+                                   else '',
+                                   '/v{}'.format(run_result['variant'])
+                                   if run_result.get('variant') is not None
+                                   else '')
+
+
+def get_peak_rss() -> float:
+    """
+    Get peak resident set size of the process
+    =========================================
+
+    Returns
+    -------
+    float
+        Peak RSS in MB, or None if not available on the platform.
+    """
+
+    if getrusage is None:
+        return None
+    return getrusage(RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main():
+    """
+    Provides main functionality
+    ===========================
+    """
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    parser = ArgumentParser(description='ChainRad inference benchmark.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Run the benchmark.')
+    run_parser.add_argument('--image-dir', default=BENCH_IMG_DIR,
+                            help='Directory of synthetic images.')
+    run_parser.add_argument('--image-count', type=int, default=32,
+                            help='Number of synthetic images to generate.')
+    run_parser.add_argument('--batch-sizes', type=int, nargs='+',
+                            default=[1, 4, 16])
+    run_parser.add_argument('--threads', type=int, nargs='+',
+                            default=[torch.get_num_threads()])
+    run_parser.add_argument('--backends', nargs='+', default=['cpu'])
+    run_parser.add_argument('--repeats', type=int, default=10)
+    run_parser.add_argument('--warmup', type=int, default=1)
+    run_parser.add_argument('--random-init', action='store_true',
+                            help='Use random weights, no model download.')
+    run_parser.add_argument('--pipeline', action='store_true',
+                            help='Overlap the stages with a pipeline.')
+    run_parser.add_argument('--decode-workers', type=int, default=2)
+    run_parser.add_argument('--transform-workers', type=int, default=1)
+    run_parser.add_argument('--variants', nargs='+', default=None,
+                            help='Head variants to compare side by side, ' +
+                                 'like trained, pruned or lowrank.')
+    run_parser.add_argument('--output',
+                            default='benchmark_{}.json'.format(
+                                                strftime('%Y%m%d%H%M%S')))
+    compare_parser = subparsers.add_parser('compare',
+                                           help='Compare two results.')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+    if args.command == 'run':
+        filelist = make_synthetic_images(args.image_dir, args.image_count)
+        pipeline = None
+        if args.pipeline:
+            pipeline = Pipeline({'decode' : args.decode_workers,
+                                 'transform' : args.transform_workers})
+        variants = None
+        if args.variants is not None:
+            variants = [None if variant == 'trained' else variant
+                        for variant in args.variants]
+        result = run(filelist, args.batch_sizes, args.threads, args.backends,
+                     args.repeats, args.warmup, args.random_init, pipeline,
+                     variants)
+        with open(args.output, 'w', encoding='utf8') as outstream:
+            json_dump(result, outstream, indent=2)
+        print('Results written to "{}".'.format(args.output))
+    else:
+        with open(args.baseline, 'r', encoding='utf8') as instream:
+            baseline = json_load(instream)
+        with open(args.candidate, 'r', encoding='utf8') as instream:
+            candidate = json_load(instream)
+        changes = compare(baseline, candidate, args.tolerance)
+        for change in changes:
+            print('{:24} {:16} {:12.3f} -> {:12.3f} {:+7.1f}% {}'.format(
+                  change['config'], change['metric'], change['baseline'],
+                  change['candidate'], change['change'] * 100,
+                  'REGRESSION' if change['regression'] else ''))
+        regressions = len([change for change in changes
+                           if change['regression']])
+        print('{} regression(s) found.'.format(regressions))
+        if regressions > 0:
+            raise SystemExit(1)
+
+
+def make_synthetic_images(directory : str, count : int,
+                          seed : int = 0) -> list:
+    """
+    Generate synthetic chest X-ray like images
+    ==========================================
+
+    Parameters
+    ----------
+    directory : str
+        Directory to write images into.
+    count : int
+        Number of images.
+    seed : int, optional (0 if omitted)
+        Seed of the random generator, the same seed gives the same images.
+
+    Returns
+    -------
+    list
+        List of image file names.
+
+    Notes
+    -----
+        Images are grayscale IMAGE_SIZE x IMAGE_SIZE PNGs like the NIH chest
+        X-ray dataset: a smooth bright body region with two darker lung fields
+        and noise. Existing images are reused.
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions linspace(), meshgrid(), randn(),
+    #         Generator(), exp()
+
+    if not isdir(directory):
+        makedirs(directory)
+    generator = torch.Generator().manual_seed(seed)
+    axis = torch.linspace(-1.0, 1.0, IMAGE_SIZE)
+    grid_y, grid_x = torch.meshgrid(axis, axis, indexing='ij')
+    body = torch.exp(-(grid_x ** 2 / 0.5 + grid_y ** 2 / 0.8))
+    lungs = (torch.exp(-((grid_x - 0.35) ** 2 / 0.05 + grid_y ** 2 / 0.2)) +
+             torch.exp(-((grid_x + 0.35) ** 2 / 0.05 + grid_y ** 2 / 0.2)))
+    result = []
+    for i in range(count):
+        filename = join(directory, 'synthetic_{:05d}.png'.format(i))
+        noise = torch.randn(IMAGE_SIZE, IMAGE_SIZE, generator=generator)
+        if not isfile(filename):
+            pixels = (body * 200 - lungs * 90 + noise * 12 + 30).clamp(0, 255)
+            Image.fromarray(pixels.to(torch.uint8).numpy(), mode='L'
+                            ).save(filename)
+        result.append(filename)
+    return result
+
+
+def percentile(values : list, rate : float) -> float:
+    """
+    Get percentile of values
+    ========================
+
+    Parameters
+    ----------
+    values : list
+        Values to use.
+    rate : float
+        Percentile between 0 and 100.
+
+    Returns
+    -------
+    float
+        The percentile with linear interpolation.
+    """
+
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * rate / 100.0
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def run(filelist : list, batch_sizes : list, thread_counts : list,
+        backends : list, repeats : int = 10, warmup : int = 1,
+        random_init : bool = False, pipeline : Pipeline = None,
+        variants : list = None) -> dict:
+    """
+    Run the benchmark
+    =================
+
+    Parameters
+    ----------
+    filelist : list
+        Images to use, batches cycle over them.
+    batch_sizes : list
+        Batch sizes to measure.
+    thread_counts : list
+        Intra-op thread counts to measure.
+    backends : list
+        Devices to measure, like 'cpu' or 'cuda'.
+    repeats : int, optional (10 if omitted)
+        Number of measured batches per configuration, at least 1.
+    warmup : int, optional (1 if omitted)
+        Number of unmeasured batches per configuration.
+    random_init : bool, optional (False if omitted)
+        Whether to use random weights instead of the stored models.
+    pipeline : Pipeline, optional (None if omitted)
+        Pipeline to overlap the stages with. Runs get the key 'stages' with
+        the stage metrics of their last batch, see Pipeline.metrics().
+    variants : list, optional (None if omitted)
+        Head variants to compare, see InferenceSession.setup(), None stands
+        for the trained heads. Every variant gets its own session sharing the
+        headless models of the first one, and runs get the key 'variant'. If
+        omitted, the default session is measured with the trained heads.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'environment', 'cold_start', 'runs' and
+        'peak_rss_mb'. The cold start is the one of the first session. The
+        peak RSS is the one of the whole process after every run, so it's
+        given once, not per configuration.
+
+    Raises
+    ------
+    ValueError
+        When repeats is less than 1.
+    """
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    # pylint: disable=too-many-nested-blocks
+    #         Every level is a dimension of the measured configurations.
+
+    if repeats < 1:
+        raise ValueError('ChainRad couldn\'t benchmark with {} repeats, at '
+                         .format(repeats) + 'least 1 is needed.')
+    if variants is None:
+        sessions = {None : inference.SessionSetup}
+    else:
+        sessions = {variant : InferenceSession() for variant in variants}
+    first = list(sessions.values())[0]
+    start = perf_counter()
+    first.setup(random_init=random_init, variant=list(sessions.keys())[0])
+    setup_time = perf_counter() - start
+    start = perf_counter()
+    inference.predict(filelist[:1], device=backends[0], session=first)
+    first_predict_time = perf_counter() - start
+    for variant, session in list(sessions.items())[1:]:
+        session.setup(random_init=random_init, variant=variant,
+                      share_backbones=first)
+    result = {'environment' : {'python' : python_version(),
+                               'torch' : torch.__version__,
+                               'machine' : machine(),
+                               'processor' : processor(),
+                               'random_init' : random_init,
+                               'image_size' : IMAGE_SIZE},
+              'cold_start' : {'setup_sec' : setup_time,
+                              'first_predict_sec' : first_predict_time,
+                              'peak_rss_mb' : get_peak_rss()},
+              'runs' : []}
+    pos = 0
+    for backend in backends:
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            for batch_size in batch_sizes:
+                for variant, session in sessions.items():
+                    latencies = []
+                    for i in range(warmup + repeats):
+                        batch = [filelist[(pos + j) % len(filelist)]
+                                 for j in range(batch_size)]
+                        pos += batch_size
+                        start = perf_counter()
+                        inference.predict(batch, device=backend,
+                                         pipeline=pipeline, session=session)
+                        if i >= warmup:
+                            latencies.append(perf_counter() - start)
+                    mean = sum(latencies) / len(latencies)
+                    run_result = {'backend' : backend, 'threads' : threads,
+                                  'batch_size' : batch_size,
+                                  'repeats' : repeats,
+                                  'mean_ms' : mean * 1000,
+                                  'p50_ms' : percentile(latencies, 50) * 1000,
+                                  'p95_ms' : percentile(latencies, 95) * 1000,
+                                  'p99_ms' : percentile(latencies, 99) * 1000,
+                                  'images_per_sec' : batch_size / mean,
+                                  'pipeline' : pipeline is not None,
+                                  'variant' : variant}
+                    if pipeline is not None:
+                        run_result['stages'] = pipeline.metrics()['stages']
+                    print('{:24} p50 {:10.2f} ms -- p95 {:10.2f} ms -- '
+                          .format(config_key(run_result),
+                                  run_result['p50_ms'],
+                                  run_result['p95_ms']) +
+                          '{:8.2f} images/s'.format(
+                                            run_result['images_per_sec']),
+                          flush=True)
+                    result['runs'].append(run_result)
+    result['peak_rss_mb'] = get_peak_rss()
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+ChainRad
+========
+
+File: early-exit cascade inference
+"""
+
+
+# Standard library imports
+from argparse import ArgumentParser
+from csv import reader
+from json import dump as json_dump
+from os.path import isfile, join
+from pickle import load as pickle_load
+
+# 3rd party imports
+import torch
+
+# Project level imports
+from core import HEADLESS_SLICES, META_DIR, MODEL_DIR, OUT_DIR
+from core import LightClassifier, SoloClassifier, get_stacked_data
+from core import load_diseases
+
+
+CASCADE_BACKBONE = 'GoogleNet'
+UNCERTAINTY_BAND = 0.1
+
+
+def get_light_model_file(key : str) -> str:
+    """
+    Get the state dict file of a light head
+    =======================================
+
+    Parameters
+    ----------
+    key : str
+        Disease key.
+
+    Returns
+    -------
+    str
+        MODEL_DIR/<key>_light.statedict
+    """
+
+    return join(MODEL_DIR, '{}_light.statedict'.format(key))
+
+
+def is_certain(probabilities : dict, thresholds : dict, band : float) -> bool:
+    """
+    Check whether every decision is far from its threshold
+    ======================================================
+
+    Parameters
+    ----------
+    probabilities : dict
+        Probabilities of the light heads by disease key.
+    thresholds : dict
+        Thresholds by disease key, 0.5 is used for missing keys.
+    band : float
+        Half width of the uncertainty band around the thresholds.
+
+    Returns
+    -------
+    bool
+        True if the image can exit early, False if the full chain is needed.
+    """
+
+    return all(abs(probability - thresholds.get(key, 0.5)) > band
+               for key, probability in probabilities.items())
+
+
+def load_light_models(keys : list, random_init : bool = False) -> dict:
+    """
+    Load light heads
+    ================
+
+    Parameters
+    ----------
+    keys : list
+        Disease keys.
+    random_init : bool, optional (False if omitted)
+        Whether to use randomly initialized heads, for benchmarks.
+
+    Returns
+    -------
+    dict
+        Light heads in eval mode by disease key. Empty if a head of any key
+        is missing, the cascade needs all of them.
+    """
+
+    result = {}
+    for key in keys:
+        if not random_init and not isfile(get_light_model_file(key)):
+            return {}
+        result[key] = LightClassifier()
+        if not random_init:
+            result[key].load_state_dict(torch.load(get_light_model_file(key),
+                                                   map_location='cpu'))
+        for param in result[key].parameters():
+            param.requires_grad = False
+        result[key].eval()
+    return result
+
+
+def load_thresholds() -> dict:
+    """
+    Load thresholds of the diseases
+    ===============================
+
+    Returns
+    -------
+    dict
+        Thresholds by disease key.
+
+    Raises
+    ------
+    FileNotFoundError
+        When the chainrad_diseases.json file doesn't exist.
+    """
+
+    return {key : data['treshold'] for key, data in load_diseases().items()
+            if 'treshold' in data.keys()}
+
+
+def main():
+    """
+    Provides main functionality
+    ===========================
+    """
+
+    parser = ArgumentParser(description='Train and evaluate the early-exit ' +
+                                        'cascade of ChainRad.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    train_parser = subparsers.add_parser('train', help='Train light heads ' +
+                                                       'on stored features.')
+    train_parser.add_argument('--epochs', type=int, default=30)
+    train_parser.add_argument('--learning-rate', type=float, default=1e-4)
+    report_parser = subparsers.add_parser('report', help='Report early ' +
+                                                         'exits and ' +
+                                                         'agreement.')
+    report_parser.add_argument('--bands', type=float, nargs='+',
+                               default=[0.05, UNCERTAINTY_BAND, 0.2])
+    report_parser.add_argument('--limit', type=int, default=0,
+                               help='Maximum number of images, 0 is all.')
+    report_parser.add_argument('--output', default=None,
+                               help='JSON file to write the report to.')
+    args = parser.parse_args()
+    keys = list(load_thresholds().keys())
+    if args.command == 'train':
+        for key, result in train_light_heads(keys, args.epochs,
+                                             args.learning_rate).items():
+            print('{:20} epoch {:3d} -- test loss {:.6f} -- auc {:.4f}'
+                  .format(key, result['epoch'], result['loss'],
+                          result['auc']))
+        return
+    result = report(keys, args.bands, args.limit)
+    print('images: {}'.format(result['images']))
+    for band_result in result['bands']:
+        print('band {:.3f} -- early exit {:.2%} -- all decisions agree '
+              .format(band_result['band'], band_result['early_exit']) +
+              '{:.2%} -- lowest agreement {:.2%} ({})'.format(
+                                        band_result['agreement'],
+                                        *min(((value, key) for key, value
+                                              in band_result['diseases']
+                                              .items()))))
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf8') as outstream:
+            json_dump(result, outstream, indent=2)
+
+
+def report(keys : list, bands : list, limit : int = 0) -> dict:
+    """
+    Compare the cascade with the full chain on stored features
+    ==========================================================
+
+    Parameters
+    ----------
+    keys : list
+        Disease keys.
+    bands : list
+        Uncertainty bands to evaluate.
+    limit : int, optional (0 if omitted)
+        Maximum number of images, 0 means every image.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'images' (count of evaluated images) and
+        'bands'. Every band has 'early_exit' (fraction of images that skip
+        the full chain), 'agreement' (fraction of images where all decisions
+        equal the full chain's) and 'diseases' (per disease agreement).
+
+    Raises
+    ------
+    FileNotFoundError
+        When a head doesn't exist.
+
+    Notes
+    -----
+        Images are the union of the valid splits. Headless outputs come from
+        OUT_DIR, so no backbone runs, the cascade is simulated on the stored
+        GoogleNet columns.
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions stack(), sigmoid(), tensor()
+
+    # pylint: disable=not-callable
+    #         toch.tensor() is callable
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    images = []
+    for key in keys:
+        with open(join(META_DIR, 'valid_{}.csv'.format(key)), 'r',
+                  encoding='utf8') as instream:
+            for row in list(reader(instream, delimiter='\t'))[1:]:
+                images.append(row[0].split('.')[0])
+    images = list(dict.fromkeys(images))
+    if limit > 0:
+        images = images[:limit]
+    features = []
+    for image in images:
+        with open(join(OUT_DIR, image + '.out'), 'rb') as instream:
+            features.append(pickle_load(instream))
+    features = torch.stack(features)
+    light_models = load_light_models(keys)
+    if len(light_models) == 0:
+        raise FileNotFoundError('Cannot find the light heads in "{}".'
+                                .format(MODEL_DIR))
+    full, light = [], []
+    with torch.no_grad():
+        for key in keys:
+            model = SoloClassifier()
+            model.load_state_dict(torch.load(join(MODEL_DIR, '{}.statedict'
+                                                  .format(key)),
+                                             map_location='cpu'))
+            model.eval()
+            full.append(torch.sigmoid(model(features).squeeze(1)))
+            light.append(torch.sigmoid(light_models[key](features[
+                    :, HEADLESS_SLICES[CASCADE_BACKBONE]]).squeeze(1)))
+    full, light = torch.stack(full, 1), torch.stack(light, 1)
+    thresholds = load_thresholds()
+    thresholds = torch.tensor([thresholds[key] for key in keys])
+    full_decisions = full >= thresholds
+    result = {'images' : len(images), 'bands' : []}
+    for band in bands:
+        early = ((light - thresholds).abs() > band).all(1)
+        decisions = torch.where(early.unsqueeze(1), light >= thresholds,
+                                full_decisions)
+        agree = decisions == full_decisions
+        result['bands'].append({'band' : band,
+                                'early_exit' : early.float().mean().item(),
+                                'agreement' : agree.all(1).float().mean()
+                                              .item(),
+                                'diseases' : {key : agree[:, i].float().mean()
+                                              .item() for i, key
+                                              in enumerate(keys)}})
+    return result
+
+
+def train_light_heads(keys : list, epochs : int = 30,
+                      learning_rate : float = 1e-4) -> dict:
+    """
+    Train light heads on the stored GoogleNet features
+    ==================================================
+
+    Parameters
+    ----------
+    keys : list
+        Disease keys, the same as the meta file ids of the training.
+    epochs : int, optional (30 if omitted)
+        Number of epochs per disease.
+    learning_rate : float, optional (1e-4 if omitted)
+        Learning rate.
+
+    Returns
+    -------
+    dict
+        Test metrics of the saved state by disease key, see
+        train.fit_stacked().
+    """
+
+    # pylint: disable=import-outside-toplevel
+    #         train imports the training stack, inference doesn't need it.
+
+    from train import fit_stacked
+
+    columns = HEADLESS_SLICES[CASCADE_BACKBONE]
+    result = {}
+    for key in keys:
+        train_x, train_y = get_stacked_data(key, 'train', columns)
+        test_x, test_y = get_stacked_data(key, 'test', columns)
+        state, result[key] = fit_stacked(LightClassifier(train_x.shape[1]),
+                                         train_x, train_y, test_x, test_y,
+                                         epochs=epochs,
+                                         learning_rate=learning_rate,
+                                         progress=False)
+        torch.save(state, get_light_model_file(key))
+    return result
+
+
+if __name__ == '__main__':
+    main()
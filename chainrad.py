@@ -13,20 +13,18 @@ File: inference software
 
 
 # Standard library imports
-from json import load as json_load
-from os.path import isfile, join
 import tkinter as tk
 import tkinter.filedialog as filedialog
 
 # 3rd party imports
 from PIL import Image, ImageTk
-import torch
 
-from core import META_DIR, MODEL_DIR, SoloClassifier, get_headless_models, get_simple_transformer
-
-
-# Global level variables
-DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+# Project level imports
+from dicom import is_dicom, read_dicom
+from hotreload import HotReloader
+from inference import SessionSetup, print_reload, score
+from results import ResultStore
+from triage import Worklist
 
 
 class ChainRadWindow(tk.Tk):
@@ -275,6 +273,7 @@ class ChainRadWindow(tk.Tk):
                    'consolidation' : '3_8', 'emphysema' : '3_9',
                    'fibrosis' : '3_10', 'pneumonia' : '3_11', 'edema' : '3_12',
                    'hernia' : '3_13', 'cardiomegaly' : '3_14'}
+    PAGE_SIZE = 50
 
 
     def __init__(self):
@@ -347,6 +346,13 @@ class ChainRadWindow(tk.Tk):
                                  background='#c0c0c0', font=('Arial', '16'),
                                  relief='ridge', width=4)
         self.lb_night.pack(side='right')
+        self.triage_state = tk.StringVar()
+        self.triage_state.set('FO')
+        self.lb_triage = tk.Label(self.statusbar,
+                                  textvariable=self.triage_state,
+                                  background='#c0c0c0', font=('Arial', '16'),
+                                  relief='ridge', width=4)
+        self.lb_triage.pack(side='right')
         self.status = tk.StringVar()
         self.lb_status = tk.Label(self.statusbar, textvariable=self.status,
                                   background='#c0c0c0', anchor='w',
@@ -373,10 +379,17 @@ class ChainRadWindow(tk.Tk):
         self.btn_right.bind('<Button-1>', self.list_up)
         self.lb_night.bind('<Button-1>', self.ui_switch)
         self.lb_lang.bind('<Button-1>', self.lang_switch)
+        self.lb_triage.bind('<Button-1>', self.triage_switch)
         for key in self.BAR_KEYS:
             self.bar_set(key, 0)
         self.predictions = []
         self.pred_pos = 0
+        self.pred_count = 0
+        self.page_start = 0
+        self.batch = None
+        self.store = ResultStore()
+        self.triage = False
+        self.worklist = Worklist()
 
 
     def bars_make(self):
@@ -579,6 +592,8 @@ class ChainRadWindow(tk.Tk):
 
         if self.pred_pos > 0:
             self.pred_pos -= 1
+            if self.pred_pos < self.page_start:
+                self.__load_page(self.pred_pos - self.PAGE_SIZE + 1)
             self.update_screen()
 
 
@@ -598,8 +613,10 @@ class ChainRadWindow(tk.Tk):
         #         Positional arguments are used to provide compatibility with
         #         TKinter.
 
-        if self.pred_pos < len(self.predictions) - 1:
+        if self.pred_pos < self.pred_count - 1:
             self.pred_pos += 1
+            if self.pred_pos >= self.page_start + len(self.predictions):
+                self.__load_page(self.pred_pos)
             self.update_screen()
 
 
@@ -622,16 +639,13 @@ class ChainRadWindow(tk.Tk):
         filelist = filedialog.askopenfilenames()
         self.btn_read.configure(image=self.img_read_warning)
         if len(filelist) > 0:
-            predictions = predict(filelist)
-            self.predictions = []
+            records = score(filelist)
+            self.batch = self.store.add(records)
+            self.worklist.add(records)
+            self.pred_count = (len(self.worklist) if self.triage
+                               else self.store.count(self.batch))
             self.pred_pos = 0
-            for i, prediction in enumerate(predictions):
-                data_list = {}
-                data_list['image'] = filelist[i]
-                data_list['bars'] = {}
-                for key, value in prediction.items():
-                    data_list['bars'][self.DISEASE_IDS[key]] = value
-                self.predictions.append(data_list)
+            self.__load_page(0)
             self.update_screen()
         self.btn_read.configure(image=self.img_read)
 
@@ -647,7 +661,12 @@ class ChainRadWindow(tk.Tk):
             Name of the file to read.
         """
 
-        image = Image.open(filename)
+        if is_dicom(filename):
+            pixels = read_dicom(filename).permute(1, 2, 0).numpy()
+            image = Image.fromarray(pixels[:, :, 0] if pixels.shape[2] == 1
+                                    else pixels)
+        else:
+            image = Image.open(filename)
         v_rate = self.x_canvas.winfo_height() / image.height
         h_rate = self.x_canvas.winfo_width() / image.width
         if h_rate < v_rate:
@@ -664,6 +683,38 @@ class ChainRadWindow(tk.Tk):
                                    anchor='nw')
 
 
+    def triage_switch(self, *args):
+        """
+        Switch between file order and triage order
+        ==========================================
+
+        Parameters
+        ----------
+        positional arguments : any
+            Not used at the moment. Only added because of TKinter's
+            requirements.
+
+        Notes
+        -----
+            In triage mode the navigation follows the worklist, every study
+            opened in the session ordered by urgency. In file order mode it
+            follows the last opened batch.
+        """
+
+        # pylint: disable=unused-argument
+        #         Positional arguments are used to provide compatibility with
+        #         TKinter.
+
+        self.triage = not self.triage
+        self.triage_state.set('TR' if self.triage else 'FO')
+        self.pred_count = (len(self.worklist) if self.triage
+                           else self.store.count(self.batch)
+                           if self.batch is not None else 0)
+        self.pred_pos = 0
+        self.__load_page(0)
+        self.update_screen()
+
+
     def ui_refresh(self):
         """
         Refresh the UI
@@ -702,6 +753,10 @@ class ChainRadWindow(tk.Tk):
                              .COLORS[self.ui_mode]['back_2'],
                              foreground=ChainRadWindow
                              .COLORS[self.ui_mode]['color'])
+        self.lb_triage.config(background=ChainRadWindow
+                              .COLORS[self.ui_mode]['back_2'],
+                              foreground=ChainRadWindow
+                              .COLORS[self.ui_mode]['color'])
         self.lb_status.config(background=ChainRadWindow
                               .COLORS[self.ui_mode]['back_2'],
                               foreground=ChainRadWindow
@@ -760,244 +815,46 @@ class ChainRadWindow(tk.Tk):
 
         if len(self.predictions) > 0:
             self.pos_state.set('{}/{}'.format(self.pred_pos + 1,
-                               len(self.predictions)))
-            self.set_image(self.predictions[self.pred_pos]['image'])
-            for key, value in self.predictions[self.pred_pos]['bars'].items():
+                               self.pred_count))
+            current = self.predictions[self.pred_pos - self.page_start]
+            self.set_image(current['image'])
+            for key, value in current['bars'].items():
                 self.bar_set(key, value)
         else:
             self.pos_state.set('-/-')
 
 
-
-class SessionSetup:
-    """
-    Singleton to provide session level variables
-    ============================================
-    """
-
-
-    __diseases = {}
-    __headles_models = {}
-    __locked = False
-    __trained_models = {}
-    __transformer = lambda x: x
-    __tresholds = {}
-
-
-    @classmethod
-    def diseases(cls) -> dict:
-        """
-        Get diseases
-        ============
-
-        Returns
-        -------
-        dict
-            Dictionary of disease names.
-        """
-
-        return cls.__diseases
-
-
-    @classmethod
-    def headless_models(cls) -> dict:
-        """
-        Get headles models
-        ==================
-
-        Returns
-        -------
-        dcit
-            Dictionary of headless models.
-        """
-
-        return cls.__headles_models
-
-
-    @classmethod
-    def is_configured(cls) -> bool:
-        """
-        Check whether the singleton class is already configured or not
-        ==============================================================
-
-        Returns
-        -------
-        bool
-            Ture if the class is already configured, False if not.
-        """
-
-        return all([len(cls.__diseases > 0), len(cls.__headles_models > 0),
-                    len(cls.__trained_models > 0), len(cls.__tresholds > 0)])
-
-
-    @classmethod
-    def is_locked(cls) -> bool:
-        """
-        Check whether the singleton class is locked or not
-        ==================================================
-
-        Returns
-        -------
-        bool
-            Ture if the class is locked, False if not.
-        """
-
-        return cls.__locked
-
-
-    @classmethod
-    def keys(cls) -> list:
-        """
-        Get exisiting disease keys
-        ==========================
-
-        Returns
-        -------
-        list
-            The list of existing disease keys.
-        """
-
-        return list(cls.__diseases.keys())
-
-
-    @classmethod
-    def lock(cls):
-        """
-        Lock the class
-        ==============
-
-        Raises
-        ------
-        PermissionError
-            When the session is locked.
-        """
-
-        if cls.is_locked():
-            raise PermissionError('ChainRad cannot lock a locked session.')
-        cls.__locked = True
-
-
-    @classmethod
-    def setup(cls):
-        """
-        Set up session level variables
-        ==============================
-
-        Raises
-        ------
-        FileNotFoundError
-            When the chainrad_diseases.json file doesn't exist.
-        RuntimeError
-            When no disease data was added to the sassion.
-
-        See also
-        --------
-            PermissionError : SessionSetup.lock()
-        """
-
-        cls.lock()
-        if not isfile(join(META_DIR, 'chainrad_diseases.json')):
-            raise FileNotFoundError('ChainRad requires information about ' +
-                                    'diseases. Inference is not available.')
-        with open(join(META_DIR, 'chainrad_diseases.json'), 'r',
-                  encoding='utf8') as instream:
-            json_data = json_load(instream)
-        for key, data in json_data.items():
-            if isfile(join(MODEL_DIR, '{}.statedict'.format(key))
-               ) and 'name' in data.keys() and 'treshold' in data.keys():
-                cls.__trained_models[key] = SoloClassifier()
-                cls.__trained_models[key].load_state_dict(torch.load(
-                                join(MODEL_DIR, '{}.statedict'.format(key))))
-                for param in cls.__trained_models[key].parameters():
-                    param.requires_grad = False
-                cls.__trained_models[key].eval()
-                cls.__diseases[key] = data['name']
-                cls.__tresholds[key] = data['treshold']
-        if len(cls.__diseases) == 0:
-            raise RuntimeError('ChainRad couldn\'t add any disease.')
-        cls.__headles_models = get_headless_models()
-        cls.__transformer = get_simple_transformer()
-        cls.unlock()
-
-
-    @classmethod
-    def trained_models(cls) -> dict:
+    def __load_page(self, start : int):
         """
-        Get trained models
-        ==================
-
-        Returns
-        -------
-        dcit
-            Dictionary of trained models.
-        """
-
-        return cls.__trained_models
-
-
-    @classmethod
-    def transformer(cls) -> dict:
-        """
-        Get transformer
-        ===============
-
-        Returns
-        -------
-        dcit
-            Dictionary of transformer.
-        """
-
-        return cls.__transformer
-
-
-    @classmethod
-    def tresholds(cls) -> dict:
-        """
-        Get tresholds
-        =============
-
-        Returns
-        -------
-        dcit
-            Dictionary of tresholds.
-        """
-
-        return cls.__tresholds
+        Load a page of the current list
+        ===============================
 
+        Parameters
+        ----------
+        start : int
+            Position of the first record of the page.
 
-    @classmethod
-    def unlock(cls):
-        """
-        Unlock the class
-        ================
+        Notes
+        -----
+            The page comes from the worklist in triage mode and from the
+            result store otherwise.
         """
 
-        cls.__locked = False
-
-
-def apply_treshold(raw_predicition : float, key : str) -> int:
-    """
-    Applies treshold on a raw predicition
-    =====================================
-
-    Parameters
-    ----------
-    raw_predicition : float
-        The raw prediction of the model.
-    key : str
-        Name of the treshold to apply.
-
-    Returns
-    -------
-    int
-        The real predicton. 1 if disease is predicted, 0 if not.
-    """
-
-    if key in SessionSetup.tresholds().keys():
-        result = 0 if raw_predicition < SessionSetup.tresholds()[key] else 1
-    else:
-        result = 0 if raw_predicition < 0.5 else 1
-    return result
+        self.page_start = max(start, 0)
+        self.predictions = []
+        if self.triage:
+            records = self.worklist.page(self.page_start, self.PAGE_SIZE)
+        elif self.batch is not None:
+            records = self.store.page(self.page_start, self.PAGE_SIZE,
+                                      batch=self.batch)
+        else:
+            records = []
+        for record in records:
+            self.predictions.append({'image' : record['image'],
+                                     'bars' : {self.DISEASE_IDS[key] : value
+                                               for key, value in
+                                               record['decisions'].items()
+                                               if key in self.DISEASE_IDS}})
 
 
 def main():
@@ -1009,67 +866,13 @@ def main():
     print('Initializing ChainRad... ', end='')
     SessionSetup.setup()
     print('Done.')
+    reloader = HotReloader(SessionSetup, callback=print_reload)
+    reloader.start()
     app = ChainRadWindow()
-    app.mainloop()
-
-
-def predict(filelist : list) -> list:
-    """
-    Predict diseases from images
-    ============================
-
-    Parameters
-    ----------
-    filelist : list
-        List of files to use as inputs.
-
-    Returns
-    -------
-    list[dict]
-        List of predictions. Predictions are in the form of a Dictionary where
-        key is disease ID and value is 1 if the disease is predicted, 0 if not.
-
-    Raises
-    ------
-    FileNotFoundError
-        When a file in the filelist doesn't exist.
-    """
-
-    # pylint: disable=no-member
-    #         toch has a member function cat()
-    #         Link: https://pytorch.org/docs/stable/generated/torch.cat.html
-
-    SessionSetup.lock()
-    headless_outs = []
-    transformer = SessionSetup.transformer()
-    for headless_model in SessionSetup.headless_models().values():
-        headless_model.to(DEVICE)
-    for filename in filelist:
-        if not isfile(filename):
-            raise FileNotFoundError('Source file "{}" doesn\'t exist.'
-                                    .format(filename))
-        img = Image.open(filename).convert('RGB')
-        img = transformer(img).unsqueeze(0).to(DEVICE)
-        flats = []
-        for headless_model in SessionSetup.headless_models().values():
-            flats.append(headless_model(img).squeeze(0).detach().cpu())
-        final = torch.cat(flats)
-        headless_outs.append(final.detach().clone())
-        del final
-    for headless_model in SessionSetup.headless_models().values():
-        headless_model.to('cpu')
-    result = [{} for i in range(len(headless_outs))]
-    for key in SessionSetup.keys():
-        model = SessionSetup.trained_models()[key]
-        model.to(DEVICE)
-        for i, headles_out in enumerate(headless_outs):
-            headles_out = headles_out.to(DEVICE)
-            predicition = model(headles_out)
-            headles_out.to('cpu')
-            result[i][key] = apply_treshold(predicition, key)
-        model.to('cpu')
-    SessionSetup.unlock()
-    return result
+    try:
+        app.mainloop()
+    finally:
+        reloader.stop()
 
 
 if __name__ == '__main__':
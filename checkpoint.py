@@ -0,0 +1,401 @@
+"""
+ChainRad
+========
+
+File: checkpoint management
+"""
+
+
+# Standard library imports
+from os import makedirs, remove, replace
+from os.path import isdir, isfile, join
+from queue import Queue
+from threading import Thread
+
+# 3rd party imports
+import torch
+
+
+def copy_to_cpu(state : any) -> any:
+    """
+    Copy a (nested) state to the CPU
+    ================================
+
+    Parameters
+    ----------
+    state : any
+        A tensor or a dict, list or tuple that contains tensors. Typical inputs
+        are model and optimizer state dicts.
+
+    Returns
+    -------
+    any
+        The same structure with detached CPU copies of every tensor.
+    """
+
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key : copy_to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(copy_to_cpu(value) for value in state)
+    return state
+
+
+class CheckpointManager:
+    """
+    Keep best weights in memory and persist checkpoints in the background
+    =====================================================================
+
+    Notes
+    -----
+        The best-so-far weights are held in memory as a CPU copy, so restoring
+        them never touches the disk. Files are written only when the
+        monitored score improves or every save_every epochs. Writing happens
+        on a background thread, files are written to a temporary name first
+        and renamed afterwards, so an interruption never leaves a truncated
+        checkpoint behind.
+
+        Two kinds of files are written into the directory:
+        - <prefix>_<epoch>.statedict : plain model state dict of an improving
+          epoch, only the keep_top best of them are kept.
+        - <prefix>.checkpoint : the latest resumable state including the
+          optimizer state, the epoch and any extra values of the caller.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    #         The amount of attributes is needed because of the functionality.
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+
+    def __init__(self, directory : str, prefix : str, keep_top : int = 3,
+                 save_every : int = 0, lower_is_better : bool = True):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        directory : str
+            Directory to store checkpoint files in.
+        prefix : str
+            Prefix of checkpoint file names, usually the meta file id.
+        keep_top : int, optional (3 if omitted)
+            Number of best state dict files to keep. Older, worse files are
+            pruned automatically.
+        save_every : int, optional (0 if omitted)
+            Save a resumable checkpoint every save_every epochs even without
+            improvement. 0 means only on improvement.
+        lower_is_better : bool, optional (True if omitted)
+            Whether a lower score is better, like in case of a loss.
+
+        Raises
+        ------
+        ValueError
+            When keep_top is less than 1.
+        """
+
+        if keep_top < 1:
+            raise ValueError('CheckpointManager must keep at least one ' +
+                             'checkpoint.')
+        if not isdir(directory):
+            makedirs(directory)
+        self.directory = directory
+        self.prefix = prefix
+        self.keep_top = keep_top
+        self.save_every = save_every
+        self.lower_is_better = lower_is_better
+        self.best_score = None
+        self.best_epoch = None
+        self.best_state = None
+        self.__top = []
+        self.__queue = Queue()
+        self.__error = None
+        self.__worker = Thread(target=self.__write_loop, daemon=True)
+        self.__worker.start()
+
+
+    def checkpoint_path(self) -> str:
+        """
+        Get the path of the resumable checkpoint
+        ========================================
+
+        Returns
+        -------
+        str
+            Path of the resumable checkpoint file.
+        """
+
+        return join(self.directory, '{}.checkpoint'.format(self.prefix))
+
+
+    def close(self, finished : bool = False):
+        """
+        Wait for pending writes and stop the background writer
+        ======================================================
+
+        Parameters
+        ----------
+        finished : bool, optional (False if omitted)
+            Whether the training run is complete. If True, the resumable
+            checkpoint is removed, so the next run starts from scratch
+            instead of resuming a run that has already ended. The state dict
+            files are kept.
+
+        Raises
+        ------
+        RuntimeError
+            When a background write failed.
+        """
+
+        if self.__worker.is_alive():
+            self.__queue.put(None)
+            self.__worker.join()
+        self.__raise_if_failed()
+        if finished and isfile(self.checkpoint_path()):
+            remove(self.checkpoint_path())
+
+
+    def flush(self):
+        """
+        Wait until every queued checkpoint is written
+        =============================================
+
+        Raises
+        ------
+        RuntimeError
+            When a background write failed.
+        """
+
+        self.__queue.join()
+        self.__raise_if_failed()
+
+
+    def is_better(self, score : float) -> bool:
+        """
+        Check whether a score is better than the best one so far
+        ========================================================
+
+        Parameters
+        ----------
+        score : float
+            Score to check.
+
+        Returns
+        -------
+        bool
+            True if the score is better (or equal) than the best one, False if
+            not.
+        """
+
+        if self.best_score is None:
+            return True
+        if self.lower_is_better:
+            return score <= self.best_score
+        return score >= self.best_score
+
+
+    def restore_best(self, model : torch.nn.Module) -> bool:
+        """
+        Load the best weights into a model from memory
+        ==============================================
+
+        Parameters
+        ----------
+        model : torch.nn.Module
+            Model to load the weights into.
+
+        Returns
+        -------
+        bool
+            True if best weights were available, False if not.
+        """
+
+        if self.best_state is None:
+            return False
+        model.load_state_dict(self.best_state)
+        return True
+
+
+    def resume(self, model : torch.nn.Module,
+               optimizer : torch.optim.Optimizer = None) -> dict:
+        """
+        Resume from the last resumable checkpoint
+        =========================================
+
+        Parameters
+        ----------
+        model : torch.nn.Module
+            Model to load the last weights into.
+        optimizer : torch.optim.Optimizer, optional (None if omitted)
+            Optimizer to load the last state into.
+
+        Returns
+        -------
+        dict
+            Dictionary with the key 'epoch' (the number of finished epochs)
+            and the extra values saved with the checkpoint. Empty if there is
+            nothing to resume.
+
+        Notes
+        -----
+            Only unfinished runs leave a resumable checkpoint behind, see
+            close().
+        """
+
+        filename = self.checkpoint_path()
+        if not isfile(filename):
+            return {}
+        content = torch.load(filename, map_location='cpu')
+        model.load_state_dict(content['model'])
+        if optimizer is not None and content['optimizer'] is not None:
+            optimizer.load_state_dict(content['optimizer'])
+        self.best_score = content['best_score']
+        self.best_epoch = content['best_epoch']
+        self.best_state = content['best_state']
+        self.__top = [(score, epoch) for score, epoch in content['top']
+                      if isfile(self.__statedict_path(epoch))]
+        result = dict(content['extra'])
+        result['epoch'] = content['epoch']
+        return result
+
+
+    def update(self, epoch : int, model : torch.nn.Module, score : float,
+               optimizer : torch.optim.Optimizer = None,
+               extra : dict = None) -> bool:
+        """
+        Register the result of an epoch
+        ===============================
+
+        Parameters
+        ----------
+        epoch : int
+            Number of the finished epoch (1-based).
+        model : torch.nn.Module
+            The trained model.
+        score : float
+            Monitored score of the epoch, usually the test loss.
+        optimizer : torch.optim.Optimizer, optional (None if omitted)
+            Optimizer to save for resuming.
+        extra : dict, optional (None if omitted)
+            Additional values to save for resuming, like early stopping
+            counters.
+
+        Returns
+        -------
+        bool
+            True if the score improved, False if not.
+
+        Raises
+        ------
+        RuntimeError
+            When a previous background write failed.
+        """
+
+        self.__raise_if_failed()
+        improved = self.is_better(score)
+        if improved:
+            self.best_score = score
+            self.best_epoch = epoch
+            self.best_state = copy_to_cpu(model.state_dict())
+            self.__queue.put(('statedict', epoch, score, self.best_state))
+        periodic = self.save_every > 0 and epoch % self.save_every == 0
+        if improved or periodic:
+            content = {'epoch' : epoch,
+                       'model' : (self.best_state if improved
+                                  else copy_to_cpu(model.state_dict())),
+                       'optimizer' : (None if optimizer is None
+                                      else copy_to_cpu(
+                                                optimizer.state_dict())),
+                       'best_score' : self.best_score,
+                       'best_epoch' : self.best_epoch,
+                       'best_state' : self.best_state,
+                       'extra' : {} if extra is None else dict(extra)}
+            self.__queue.put(('checkpoint', epoch, score, content))
+        return improved
+
+
+    def __prune(self):
+        """
+        Remove state dict files that are not among the best ones
+        ========================================================
+        """
+
+        self.__top.sort(key=lambda item: item[0],
+                        reverse=not self.lower_is_better)
+        for _, epoch in self.__top[self.keep_top:]:
+            if isfile(self.__statedict_path(epoch)):
+                remove(self.__statedict_path(epoch))
+        self.__top = self.__top[:self.keep_top]
+
+
+    def __raise_if_failed(self):
+        """
+        Re-raise an error of the background writer
+        ===========================================
+
+        Raises
+        ------
+        RuntimeError
+            When a background write failed.
+        """
+
+        if self.__error is not None:
+            raise RuntimeError('ChainRad couldn\'t write checkpoint.'
+                               ) from self.__error
+
+
+    def __statedict_path(self, epoch : int) -> str:
+        """
+        Get the path of a state dict file
+        =================================
+
+        Parameters
+        ----------
+        epoch : int
+            Number of the epoch.
+
+        Returns
+        -------
+        str
+            Path of the state dict file.
+        """
+
+        return join(self.directory, '{}_{:03d}.statedict'.format(self.prefix,
+                                                                 epoch))
+
+
+    def __write_loop(self):
+        """
+        Write queued checkpoints in the background
+        ==========================================
+        """
+
+        # pylint: disable=broad-except
+        #         Any error is stored and re-raised on the training thread.
+
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                self.__queue.task_done()
+                break
+            kind, epoch, score, content = item
+            try:
+                if kind == 'statedict':
+                    filename = self.__statedict_path(epoch)
+                else:
+                    content = dict(content)
+                    content['top'] = list(self.__top)
+                    filename = self.checkpoint_path()
+                torch.save(content, filename + '.tmp')
+                replace(filename + '.tmp', filename)
+                if kind == 'statedict':
+                    self.__top.append((score, epoch))
+                    self.__prune()
+            except Exception as error:
+                self.__error = error
+            finally:
+                self.__queue.task_done()
@@ -0,0 +1,247 @@
+"""
+ChainRad
+========
+
+File: comparison of head architectures
+"""
+
+
+# Standard library imports
+from argparse import ArgumentParser
+from json import dump as json_dump
+from os.path import isfile
+from time import perf_counter
+
+# 3rd party imports
+import torch
+
+# Project level imports
+from core import HEADLESS_FEATURES, SHARED_FILE
+from core import SharedTrunkClassifier, SoloClassifier
+from core import get_classifier, get_head_file, get_multilabel_data
+from core import load_diseases
+from metrics import get_auc
+
+
+def get_auc_report(keys : list, variant : str = None) -> dict:
+    """
+    Get valid AUC of the independent and the shared heads
+    =====================================================
+
+    Parameters
+    ----------
+    keys : list
+        Disease keys, the same as the meta file ids of the training.
+    variant : str, optional (None if omitted)
+        Variant of the independent heads, see core.get_head_file().
+
+    Returns
+    -------
+    dict
+        AUCs by disease key as {'independent' : auc, 'shared' : auc}. A
+        missing model gives None.
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions cat(), sigmoid()
+
+    keys = sorted(keys)
+    data_x, data_y = get_multilabel_data(keys, 'valid')
+    shared = None
+    if isfile(SHARED_FILE):
+        shared = get_classifier(torch.load(SHARED_FILE, map_location='cpu'))
+        shared.eval()
+        with torch.no_grad():
+            shared = torch.sigmoid(shared(data_x))
+    result = {}
+    for i, key in enumerate(keys):
+        known = data_y[:, i] >= 0
+        result[key] = {'independent' : None, 'shared' : None}
+        if isfile(get_head_file(key, variant)):
+            model = get_classifier(torch.load(get_head_file(key, variant),
+                                              map_location='cpu'))
+            model.eval()
+            with torch.no_grad():
+                result[key]['independent'] = get_auc(torch.sigmoid(
+                            model(data_x[known]).squeeze(1)), data_y[known, i])
+        if shared is not None:
+            result[key]['shared'] = get_auc(shared[known, i],
+                                            data_y[known, i])
+    return result
+
+
+def get_latency(models : list, batch_size : int, repeats : int = 10
+                ) -> float:
+    """
+    Measure CPU latency of heads
+    ============================
+
+    Parameters
+    ----------
+    models : list
+        Heads that together give every disease.
+    batch_size : int
+        Number of samples per forward pass.
+    repeats : int, optional (10 if omitted)
+        Number of timed passes.
+
+    Returns
+    -------
+    float
+        Median time of running every head once in ms.
+    """
+
+    # pylint: disable=no-member
+    #         torch has a member function rand()
+
+    data_x = torch.rand(batch_size, HEADLESS_FEATURES)
+    times = []
+    with torch.no_grad():
+        for model in models:
+            model.eval()(data_x)
+        for _ in range(repeats):
+            start = perf_counter()
+            for model in models:
+                model(data_x)
+            times.append(perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1000
+
+
+def get_training_time(models : list, outputs : int, sample_count : int,
+                      batch_size : int = 128) -> float:
+    """
+    Measure one training epoch of heads on synthetic data
+    =====================================================
+
+    Parameters
+    ----------
+    models : list
+        Heads that together give every disease.
+    outputs : int
+        Number of diseases.
+    sample_count : int
+        Number of synthetic samples.
+    batch_size : int, optional (128 if omitted)
+        Size of training batches.
+
+    Returns
+    -------
+    float
+        Time of the epoch in seconds, every head included.
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions rand(), randint()
+
+    data_x = torch.rand(sample_count, HEADLESS_FEATURES)
+    data_y = torch.randint(0, 2, (sample_count, outputs)).float()
+    criterion = torch.nn.BCEWithLogitsLoss()
+    start = perf_counter()
+    for i, model in enumerate(models):
+        model.train()
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-5)
+        for pos in range(0, sample_count, batch_size):
+            optimizer.zero_grad()
+            output = model(data_x[pos:pos + batch_size])
+            target = data_y[pos:pos + batch_size]
+            if output.shape[1] == 1:
+                target = target[:, i:i + 1]
+            criterion(output, target).backward()
+            optimizer.step()
+    return perf_counter() - start
+
+
+def main():
+    """
+    Provides main functionality
+    ===========================
+    """
+
+    parser = ArgumentParser(description='Compare independent heads with the ' +
+                                        'shared trunk classifier.')
+    parser.add_argument('--samples', type=int, default=512,
+                        help='Synthetic samples of the training time ' +
+                             'measurement.')
+    parser.add_argument('--variant', default=None,
+                        help='Variant of the independent heads.')
+    parser.add_argument('--skip-auc', action='store_true',
+                        help='Skip the AUC part that needs stored features.')
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write the report to.')
+    args = parser.parse_args()
+    keys = list(load_diseases().keys())
+    result = run(keys, args.samples, args.variant, not args.skip_auc)
+    for name in ['independent', 'shared']:
+        print('{:12} {:8.1f} MB -- train {:7.2f} s/epoch -- latency '.format(
+                        name, result[name]['megabytes'],
+                        result[name]['train_seconds']) +
+              '{:.2f} ms (1) {:.2f} ms (64)'.format(
+                        result[name]['latency_ms_1'],
+                        result[name]['latency_ms_64']))
+    for key, value in result.get('auc', {}).items():
+        print('{:20} auc independent {} -- shared {}'.format(
+                    key, *['{:.4f}'.format(value[name])
+                           if value[name] is not None else '-'
+                           for name in ['independent', 'shared']]))
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf8') as outstream:
+            json_dump(result, outstream, indent=2)
+
+
+def run(keys : list, sample_count : int = 512, variant : str = None,
+        auc : bool = True) -> dict:
+    """
+    Compare the head architectures
+    ==============================
+
+    Parameters
+    ----------
+    keys : list
+        Disease keys.
+    sample_count : int, optional (512 if omitted)
+        Synthetic samples of the training time measurement.
+    variant : str, optional (None if omitted)
+        Variant of the independent heads for the AUC part.
+    auc : bool, optional (True if omitted)
+        Whether to compute valid AUCs from the stored features.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'independent' and 'shared' (parameter
+        memory in MB, training time of a synthetic epoch, CPU latency of a
+        single sample and of a batch of 64), and 'auc' (see
+        get_auc_report()) if requested.
+
+    Notes
+    -----
+        The independent heads have the same architecture and are trained
+        and run one after the other, so a single head is measured and its
+        numbers are multiplied by the number of keys. Building all of them
+        would need several GB. Every model is freed after its measurement.
+    """
+
+    result = {}
+    for name in ['independent', 'shared']:
+        if name == 'independent':
+            model, copies = SoloClassifier(), len(keys)
+        else:
+            model, copies = SharedTrunkClassifier(len(keys)), 1
+        result[name] = {'megabytes' : copies * sum(param.numel() *
+                                                   param.element_size()
+                                                   for param
+                                                   in model.parameters())
+                                      / 2 ** 20,
+                        'train_seconds' : copies * get_training_time(
+                                                    [model], len(keys),
+                                                    sample_count),
+                        'latency_ms_1' : copies * get_latency([model], 1),
+                        'latency_ms_64' : copies * get_latency([model], 64)}
+        del model
+    if auc:
+        result['auc'] = get_auc_report(keys, variant)
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -18,11 +18,18 @@ import torch
 from torchvision import models, transforms
 
 
+HEADLESS_FEATURES = 30368
+HEADLESS_SLICES = {'VGG16bn' : slice(0, 25088),
+                   'ResNet152' : slice(25088, 27136),
+                   'DenseNet161' : slice(27136, 29344),
+                   'GoogleNet' : slice(29344, 30368)}
 IMG_DIR = './img'
 LOG_DIR = './log'
 META_DIR = './metadata'
 MODEL_DIR = './models'
 OUT_DIR = './out'
+DISEASES_FILE = join(META_DIR, 'chainrad_diseases.json')
+SHARED_FILE = join(MODEL_DIR, 'shared.statedict')
 
 
 class SoloClassifier(torch.nn.Module):
@@ -46,7 +53,7 @@ class SoloClassifier(torch.nn.Module):
         """
 
         super().__init__()
-        self.fc1 = torch.nn.Linear(30368, 2048)
+        self.fc1 = torch.nn.Linear(HEADLESS_FEATURES, 2048)
         self.fc2 = torch.nn.Linear(2048, 256)
         self.fc3 = torch.nn.Linear(256, 32)
         self.fc4 = torch.nn.Linear(32, 1)
@@ -79,6 +86,263 @@ class SoloClassifier(torch.nn.Module):
         return self.fc4(x)
 
 
+class LightClassifier(torch.nn.Module):
+    """
+    Provide small model architecture for binray classification
+    ==========================================================
+
+    Notes
+    -----
+        Meant for the output of a single headless model, like the first step
+        of the cascade inference.
+    """
+
+    # pylint: disable=abstract-method
+    #         However _forward_unimplemented is abstract, according to
+    #         PyTorch's it is not necessarily to override.
+
+
+    def __init__(self, in_features : int = 1024, hidden : int = 256):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        in_features : int, optional (1024 if omitted)
+            Number of input features, 1024 is the output of GoogleNet.
+        hidden : int, optional (256 if omitted)
+            Number of hidden units.
+        """
+
+        super().__init__()
+        self.fc1 = torch.nn.Linear(in_features, hidden)
+        self.fc2 = torch.nn.Linear(hidden, 1)
+        self.activation = torch.nn.ReLU(inplace=True)
+        self.dropout = torch.nn.Dropout(p=0.5, inplace=True)
+
+
+    def forward(self, x : torch.Tensor) -> torch.Tensor:
+        """
+        Perform forward operation on the model
+        ======================================
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Values to use for predicition.
+
+        Returns
+        -------
+        torch.Tensor
+            Predicted values.
+        """
+
+        # pylint: disable=invalid-name
+        #         The use of name x accords to PyTorch's documentation.
+
+        return self.fc2(self.activation(self.dropout(self.fc1(x))))
+
+
+class LowRankClassifier(torch.nn.Module):
+    """
+    Provide SoloClassifier with rank-r factorized fc1
+    =================================================
+
+    Notes
+    -----
+        fc1 is stored as fc1_u(fc1_v(x)), fc1_v maps the inputs to rank
+        values without bias and fc1_u maps those to 2048 units. It has
+        rank * (HEADLESS_FEATURES + 2048) weights instead of
+        HEADLESS_FEATURES * 2048. The rest of the layers are the same as
+        SoloClassifier's.
+    """
+
+    # pylint: disable=abstract-method
+    #         However _forward_unimplemented is abstract, according to
+    #         PyTorch's it is not necessarily to override.
+
+
+    def __init__(self, rank : int = 64):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        rank : int, optional (64 if omitted)
+            Rank of the factorization.
+        """
+
+        super().__init__()
+        self.fc1_v = torch.nn.Linear(HEADLESS_FEATURES, rank, bias=False)
+        self.fc1_u = torch.nn.Linear(rank, 2048)
+        self.fc2 = torch.nn.Linear(2048, 256)
+        self.fc3 = torch.nn.Linear(256, 32)
+        self.fc4 = torch.nn.Linear(32, 1)
+        self.activation = torch.nn.ReLU(inplace=True)
+        self.dropout = torch.nn.Dropout(p=0.5, inplace=True)
+
+
+    def forward(self, x : torch.Tensor) -> torch.Tensor:
+        """
+        Perform forward operation on the model
+        ======================================
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Values to use for predicition.
+
+        Returns
+        -------
+        torch.Tensor
+            Predicted values.
+        """
+
+        # pylint: disable=invalid-name
+        #         The use of name x accords to PyTorch's documentation.
+
+        x = self.activation(self.dropout(self.fc1_u(self.fc1_v(x))))
+        x = self.activation(self.dropout(self.fc2(x)))
+        x = self.activation(self.dropout(self.fc3(x)))
+        return self.fc4(x)
+
+
+class PrunedClassifier(torch.nn.Module):
+    """
+    Provide SoloClassifier with structurally pruned fc1
+    ===================================================
+
+    Notes
+    -----
+        Only the input columns listed in input_index are gathered and fc1 has
+        fewer hidden units, the rest of the layers are the same as
+        SoloClassifier's. input_index is a buffer, so it is saved in the
+        state dict as the input-index map.
+    """
+
+    # pylint: disable=abstract-method
+    #         However _forward_unimplemented is abstract, according to
+    #         PyTorch's it is not necessarily to override.
+
+
+    def __init__(self, input_index : torch.Tensor, hidden : int):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        input_index : torch.Tensor
+            Indices of the kept headless output columns.
+        hidden : int
+            Number of kept fc1 units.
+        """
+
+        super().__init__()
+        self.register_buffer('input_index', input_index.long().clone())
+        self.fc1 = torch.nn.Linear(input_index.numel(), hidden)
+        self.fc2 = torch.nn.Linear(hidden, 256)
+        self.fc3 = torch.nn.Linear(256, 32)
+        self.fc4 = torch.nn.Linear(32, 1)
+        self.activation = torch.nn.ReLU(inplace=True)
+        self.dropout = torch.nn.Dropout(p=0.5, inplace=True)
+
+
+    def forward(self, x : torch.Tensor) -> torch.Tensor:
+        """
+        Perform forward operation on the model
+        ======================================
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Full headless outputs.
+
+        Returns
+        -------
+        torch.Tensor
+            Predicted values.
+        """
+
+        # pylint: disable=invalid-name
+        #         The use of name x accords to PyTorch's documentation.
+
+        x = x.index_select(-1, self.input_index)
+        x = self.activation(self.dropout(self.fc1(x)))
+        x = self.activation(self.dropout(self.fc2(x)))
+        x = self.activation(self.dropout(self.fc3(x)))
+        return self.fc4(x)
+
+
+class SharedTrunkClassifier(torch.nn.Module):
+    """
+    Provide shared trunk architecture for multi-label classification
+    ================================================================
+
+    Notes
+    -----
+        fc1 and fc2 are shared by every disease, fc3 and fc4 are small tails
+        per disease. Outputs are in the alphabetical order of the disease
+        keys.
+    """
+
+    # pylint: disable=abstract-method
+    #         However _forward_unimplemented is abstract, according to
+    #         PyTorch's it is not necessarily to override.
+
+
+    def __init__(self, outputs : int = 14):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        outputs : int, optional (14 if omitted)
+            Number of diseases.
+        """
+
+        super().__init__()
+        self.fc1 = torch.nn.Linear(HEADLESS_FEATURES, 2048)
+        self.fc2 = torch.nn.Linear(2048, 256)
+        self.fc3 = torch.nn.ModuleList([torch.nn.Linear(256, 32)
+                                        for _ in range(outputs)])
+        self.fc4 = torch.nn.ModuleList([torch.nn.Linear(32, 1)
+                                        for _ in range(outputs)])
+        self.activation = torch.nn.ReLU(inplace=True)
+        self.dropout = torch.nn.Dropout(p=0.5, inplace=True)
+
+
+    def forward(self, x : torch.Tensor) -> torch.Tensor:
+        """
+        Perform forward operation on the model
+        ======================================
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Values to use for predicition.
+
+        Returns
+        -------
+        torch.Tensor
+            Predicted values with one column per disease.
+        """
+
+        # pylint: disable=invalid-name
+        #         The use of name x accords to PyTorch's documentation.
+
+        # pylint: disable=no-member
+        #         torch has a member function cat()
+
+        x = self.activation(self.dropout(self.fc1(x)))
+        x = self.activation(self.dropout(self.fc2(x)))
+        return torch.cat([fc4(self.activation(self.dropout(fc3(x))))
+                          for fc3, fc4 in zip(self.fc3, self.fc4)], -1)
+
+
 class EmptyLayer(torch.nn.Module):
     """
     Empty layer class to substitute classifier layer(s)
@@ -185,6 +449,41 @@ def get_accuracy(pred_list : list, target_list : list) -> float:
     return good_count / len(pred_list)
 
 
+def get_classifier(state_dict : dict) -> torch.nn.Module:
+    """
+    Create a head that fits a state dict
+    ====================================
+
+    Parameters
+    ----------
+    state_dict : dict
+        State dict of a SoloClassifier or one of its compact variants.
+
+    Returns
+    -------
+    torch.nn.Module
+        The head with the state dict loaded.
+    """
+
+    # pylint: disable=no-member
+    #         torch has a member function zeros()
+
+    if 'input_index' in state_dict.keys():
+        result = PrunedClassifier(torch.zeros(state_dict['input_index']
+                                              .numel(), dtype=torch.long),
+                                  state_dict['fc1.weight'].shape[0])
+    elif 'fc1_v.weight' in state_dict.keys():
+        result = LowRankClassifier(state_dict['fc1_v.weight'].shape[0])
+    elif 'fc3.0.weight' in state_dict.keys():
+        result = SharedTrunkClassifier(len([key for key in state_dict.keys()
+                                            if key.startswith('fc4.') and
+                                            key.endswith('.weight')]))
+    else:
+        result = SoloClassifier()
+    result.load_state_dict(state_dict)
+    return result
+
+
 def get_data_in_batches(meta_file_id : str, dataset_type : str = 'train',
                         batch_size : int = 1, drop_last : bool = False,
                         shuffle_count : int = 3) -> list:
@@ -252,11 +551,41 @@ def get_data_in_batches(meta_file_id : str, dataset_type : str = 'train',
     return result
 
 
-def get_headless_models() -> dict:
+def get_head_file(key : str, variant : str = None) -> str:
+    """
+    Get the state dict file of a head
+    =================================
+
+    Parameters
+    ----------
+    key : str
+        Disease key.
+    variant : str, optional (None if omitted)
+        Variant of the head, like 'pruned'. If omitted, the file of the
+        trained SoloClassifier is returned.
+
+    Returns
+    -------
+    str
+        MODEL_DIR/<key>.statedict or MODEL_DIR/<key>_<variant>.statedict
+    """
+
+    if variant is None:
+        return join(MODEL_DIR, '{}.statedict'.format(key))
+    return join(MODEL_DIR, '{}_{}.statedict'.format(key, variant))
+
+
+def get_headless_models(pretrained : bool = True) -> dict:
     """
     Create dict of headless models
     ==============================
 
+    Parameters
+    ----------
+    pretrained : bool, optional (True if omitted)
+        Whether to load pretrained weights. Random weights need no download,
+        they are useful for benchmarks only.
+
     Returns
     -------
     dict
@@ -264,13 +593,13 @@ def get_headless_models() -> dict:
     """
 
     result = {}
-    result['VGG16bn'] = models.vgg16_bn(pretrained=True)
+    result['VGG16bn'] = models.vgg16_bn(pretrained=pretrained)
     result['VGG16bn'].classifier = EmptyLayer()
-    result['ResNet152'] = models.resnet152(pretrained=True)
+    result['ResNet152'] = models.resnet152(pretrained=pretrained)
     result['ResNet152'].fc = EmptyLayer()
-    result['DenseNet161'] = models.densenet161(pretrained=True)
+    result['DenseNet161'] = models.densenet161(pretrained=pretrained)
     result['DenseNet161'].classifier = EmptyLayer()
-    result['GoogleNet'] = models.googlenet(pretrained=True)
+    result['GoogleNet'] = models.googlenet(pretrained=pretrained)
     result['GoogleNet'].fc = EmptyLayer()
     for key in result.keys():
         for param in result[key].parameters():
@@ -279,6 +608,143 @@ def get_headless_models() -> dict:
     return result
 
 
+def get_low_rank_classifier(model : torch.nn.Module, rank : int,
+                            factors : tuple = None) -> LowRankClassifier:
+    """
+    Factorize fc1 of a trained head
+    ===============================
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Trained SoloClassifier.
+    rank : int
+        Rank of the factorization.
+    factors : tuple, optional (None if omitted)
+        (U, S, Vh) of torch.linalg.svd(model.fc1.weight, full_matrices=False)
+        to reuse between ranks. If omitted, it is computed.
+
+    Returns
+    -------
+    LowRankClassifier
+        Head with the best rank-r approximation of fc1 and the other layers
+        copied.
+    """
+
+    # pylint: disable=invalid-name
+    #         Names of the factors accord to PyTorch's documentation.
+
+    if factors is None:
+        factors = torch.linalg.svd(model.fc1.weight.detach(),
+                                   full_matrices=False)
+    u, s, vh = factors
+    root = s[:rank].sqrt()
+    result = LowRankClassifier(rank)
+    with torch.no_grad():
+        result.fc1_v.weight.copy_(vh[:rank] * root.unsqueeze(1))
+        result.fc1_u.weight.copy_(u[:, :rank] * root.unsqueeze(0))
+        result.fc1_u.bias.copy_(model.fc1.bias)
+        for name in ['fc2', 'fc3', 'fc4']:
+            getattr(result, name).load_state_dict(getattr(model, name)
+                                                  .state_dict())
+    return result
+
+
+def get_multilabel_data(meta_file_ids : list, dataset_type : str = 'test'
+                        ) -> tuple:
+    """
+    Get the union of the datasets of diseases as stacked tensors
+    ============================================================
+
+    Parameters
+    ----------
+    meta_file_ids : list
+        Identifiers of the datasets, one per disease.
+    dataset_type : str, optional ('test' if omitted)
+        Type of the datasets to work with. Common values are 'train', 'test',
+        'valid'.
+
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor)
+        Headless outputs with shape (images, features) and float targets with
+        shape (images, diseases). Targets are -1 where an image is not in the
+        meta file of a disease.
+
+    Raises
+    ------
+    FileNotFoundError
+        When a meta file doesn't exist.
+    """
+
+    # pylint: disable=no-member
+    #         toch has a member functions stack(), tensor()
+
+    # pylint: disable=not-callable
+    #         toch.tensor() is callable
+
+    labels = {}
+    for i, meta_file_id in enumerate(meta_file_ids):
+        filename = join(META_DIR, '{}_{}.csv'.format(dataset_type,
+                                                     meta_file_id))
+        if not isfile(filename):
+            raise FileNotFoundError('Cannot find "{}".'.format(filename))
+        with open(filename, 'r', encoding='utf8') as instream:
+            for row in list(reader(instream, delimiter='\t'))[1:]:
+                labels.setdefault(row[0].split('.')[0],
+                                  [-1] * len(meta_file_ids))[i] = int(row[3])
+    x_list = []
+    for name_root in labels.keys():
+        with open(join(OUT_DIR, name_root + '.out'), 'rb') as instream:
+            x_list.append(pickle_load(instream))
+    return (torch.stack(x_list),
+            torch.tensor(list(labels.values())).float())
+
+
+def get_random_classifier(variant : str = None) -> torch.nn.Module:
+    """
+    Create a randomly initialized head of a variant
+    ===============================================
+
+    Parameters
+    ----------
+    variant : str, optional (None if omitted)
+        Variant of the head, 'pruned' or 'lowrank'. If omitted, a
+        SoloClassifier is created.
+
+    Returns
+    -------
+    torch.nn.Module
+        The head with random weights.
+
+    Raises
+    ------
+    ValueError
+        When the variant is unknown.
+
+    Notes
+    -----
+        The sizes are the defaults of prune.py and lowrank.py: a pruned
+        head keeps a random quarter of the headless output columns and half
+        of the fc1 units, a low-rank head has rank 64. Such heads are meant
+        for benchmarks, their predictions are meaningless.
+    """
+
+    # pylint: disable=no-member
+    #         torch has a member function randperm()
+
+    if variant is None:
+        return SoloClassifier()
+    if variant == 'pruned':
+        return PrunedClassifier(torch.randperm(HEADLESS_FEATURES)
+                                [:HEADLESS_FEATURES // 4].sort().values,
+                                2048 // 2)
+    if variant == 'lowrank':
+        return LowRankClassifier()
+    raise ValueError('ChainRad couldn\'t create a random "{}" head.'
+                     .format(variant))
+
+
 def get_simple_transformer() -> transforms.transforms.Compose:
     """
     Get composed simple transformer
@@ -299,6 +765,92 @@ def get_simple_transformer() -> transforms.transforms.Compose:
     return result
 
 
+def get_stacked_data(meta_file_id : str, dataset_type : str = 'test',
+                     columns : slice = None) -> tuple:
+    """
+    Get a whole dataset as stacked tensors
+    ======================================
+
+    Parameters
+    ----------
+    meta_file_id : str
+        Identifier of the dataset to work with.
+    dataset_type : str, optional ('test' if omitted)
+        Type of the dataset to work with. Common values are 'train', 'test',
+        'valid'.
+    columns : slice, optional (None if omitted)
+        Features to keep, like a value of HEADLESS_SLICES. If omitted, every
+        feature is kept. Columns are selected before stacking, so only the
+        kept part is in memory at once.
+
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor)
+        Headless outputs with shape (samples, features) and float targets with
+        shape (samples,), in the order of the meta file.
+
+    Raises
+    ------
+    FileNotFoundError
+        When the given meta file with the given dataset type doesn't exist.
+
+    Notes
+    -----
+        The result is meant to be built once per training run and sliced into
+        large evaluation batches, instead of stacking batches every epoch.
+    """
+
+    # pylint: disable=no-member
+    #         toch has a member functions stack(), tensor()
+
+    # pylint: disable=not-callable
+    #         toch.tensor() is callable
+
+    filename = join(META_DIR, '{}_{}.csv'.format(dataset_type, meta_file_id))
+    if not isfile(filename):
+        raise FileNotFoundError('Cannot find "{}".'.format(filename))
+    x_list, y_list = [], []
+    with open(filename, 'r', encoding='utf8') as instream:
+        for row in list(reader(instream, delimiter='\t'))[1:]:
+            with open(join(OUT_DIR, row[0].split('.')[0] + '.out'),
+                      'rb') as instream:
+                features = pickle_load(instream)
+            x_list.append(features if columns is None
+                          else features[columns].clone())
+            y_list.append(int(row[3]))
+    return torch.stack(x_list), torch.tensor(y_list).float()
+
+
+def get_student_model(pretrained : bool = True, outputs : int = 14
+                      ) -> torch.nn.Module:
+    """
+    Create the compact student model
+    ================================
+
+    Parameters
+    ----------
+    pretrained : bool, optional (True if omitted)
+        Whether to start from ImageNet weights.
+    outputs : int, optional (14 if omitted)
+        Number of outputs, one logit per disease.
+
+    Returns
+    -------
+    torch.nn.Module
+        MobileNetV3 small with its last layer replaced.
+
+    Notes
+    -----
+        The student is distilled from the four headless models and the
+        SoloClassifier heads, see distill.py.
+    """
+
+    result = models.mobilenet_v3_small(pretrained=pretrained)
+    result.classifier[3] = torch.nn.Linear(result.classifier[3].in_features,
+                                           outputs)
+    return result
+
+
 def get_training_transformer(rotation_degree : any = 13,
                              translate : tuple = (0.1, 0.1),
                              shear : float = 0.1, scale : tuple = (0.9, 1.1),
@@ -352,3 +904,27 @@ def get_training_transformer(rotation_degree : any = 13,
                                                       std=
                                                       [0.229, 0.224, 0.225])])
     return result
+
+
+def load_diseases() -> dict:
+    """
+    Load the diseases of inference
+    ==============================
+
+    Returns
+    -------
+    dict
+        Content of chainrad_diseases.json, disease data by disease key.
+
+    Raises
+    ------
+    FileNotFoundError
+        When the chainrad_diseases.json file doesn't exist.
+    """
+
+    if not isfile(DISEASES_FILE):
+        raise FileNotFoundError('ChainRad requires information about ' +
+                                'diseases, "{}" doesn\'t exist.'
+                                .format(DISEASES_FILE))
+    with open(DISEASES_FILE, 'r', encoding='utf8') as instream:
+        return json_load(instream)
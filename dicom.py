@@ -0,0 +1,570 @@
+"""
+ChainRad
+========
+
+File: DICOM input
+"""
+
+
+# Standard library imports
+from os import listdir
+from os.path import isfile, join
+from struct import pack, unpack
+
+# 3rd party imports
+import numpy as np
+import torch
+
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+
+EXPLICIT_LITTLE = '1.2.840.10008.1.2.1'
+IMPLICIT_LITTLE = '1.2.840.10008.1.2'
+LONG_VRS = [b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC',
+            b'UN', b'UR', b'UT', b'UV']
+PIXEL_DATA = (0x7FE0, 0x0010)
+TAGS = {(0x0002, 0x0010) : ('transfer_syntax', 'UI'),
+        (0x0008, 0x0018) : ('sop_instance_uid', 'UI'),
+        (0x0020, 0x000E) : ('series_instance_uid', 'UI'),
+        (0x0020, 0x0013) : ('instance_number', 'IS'),
+        (0x0028, 0x0002) : ('samples_per_pixel', 'US'),
+        (0x0028, 0x0004) : ('photometric', 'CS'),
+        (0x0028, 0x0006) : ('planar_configuration', 'US'),
+        (0x0028, 0x0008) : ('frame_count', 'IS'),
+        (0x0028, 0x0010) : ('rows', 'US'),
+        (0x0028, 0x0011) : ('columns', 'US'),
+        (0x0028, 0x0100) : ('bits_allocated', 'US'),
+        (0x0028, 0x0101) : ('bits_stored', 'US'),
+        (0x0028, 0x0103) : ('pixel_representation', 'US'),
+        (0x0028, 0x1050) : ('window_center', 'DS'),
+        (0x0028, 0x1051) : ('window_width', 'DS'),
+        (0x0028, 0x1052) : ('rescale_intercept', 'DS'),
+        (0x0028, 0x1053) : ('rescale_slope', 'DS')}
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+class DicomImage:
+    """
+    Header of a DICOM image with lazy pixel access
+    ==============================================
+
+    Notes
+    -----
+        Only the tags in TAGS are kept, every other element is skipped with a
+        seek. Pixel data is not read until pixels() is called, then it is
+        read straight into a numpy buffer.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    #         The amount of attributes is needed because of the functionality.
+
+
+    def __init__(self, filename : str):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        filename : str
+            Name of the DICOM file.
+
+        Raises
+        ------
+        RuntimeError
+            When the file is not a DICOM file or has no pixel data.
+        """
+
+        self.filename = filename
+        self.transfer_syntax = IMPLICIT_LITTLE
+        self.sop_instance_uid = ''
+        self.series_instance_uid = ''
+        self.instance_number = 0
+        self.samples_per_pixel = 1
+        self.photometric = 'MONOCHROME2'
+        self.planar_configuration = 0
+        self.frame_count = 1
+        self.rows = 0
+        self.columns = 0
+        self.bits_allocated = 16
+        self.bits_stored = 16
+        self.pixel_representation = 0
+        self.window_center = None
+        self.window_width = None
+        self.rescale_intercept = 0.0
+        self.rescale_slope = 1.0
+        self.pixel_offset = None
+        self.pixel_length = 0
+        self.__parse()
+
+
+    def is_compressed(self) -> bool:
+        """
+        Check whether pixel data is encapsulated (compressed)
+        =====================================================
+
+        Returns
+        -------
+        bool
+            True if the transfer syntax is not an uncompressed little endian
+            one, False if it is.
+        """
+
+        return self.transfer_syntax not in [EXPLICIT_LITTLE, IMPLICIT_LITTLE]
+
+
+    def pixels(self) -> np.ndarray:
+        """
+        Read raw pixel values of the first frame
+        ========================================
+
+        Returns
+        -------
+        np.ndarray
+            Raw stored values with shape (rows, columns) or
+            (rows, columns, samples).
+
+        Raises
+        ------
+        RuntimeError
+            When the pixel data is compressed and pydicom is not available,
+            or the pixel format is not supported.
+        """
+
+        if self.is_compressed():
+            if pydicom is None:
+                raise RuntimeError('ChainRad needs pydicom to decode ' +
+                                   'compressed DICOM "{}".'
+                                   .format(self.filename))
+            result = pydicom.dcmread(self.filename).pixel_array
+            return result[0] if self.frame_count > 1 else result
+        if self.bits_allocated not in [8, 16, 32]:
+            raise RuntimeError('ChainRad cannot read {}-bit DICOM pixels.'
+                               .format(self.bits_allocated))
+        dtype = np.dtype('{}{}'.format('<i' if self.pixel_representation == 1
+                                       else '<u', self.bits_allocated // 8))
+        count = self.rows * self.columns * self.samples_per_pixel
+        result = np.fromfile(self.filename, dtype=dtype, count=count,
+                             offset=self.pixel_offset)
+        if self.bits_stored < self.bits_allocated:
+            result = mask_stored_bits(result, self.bits_stored,
+                                      self.pixel_representation)
+        if self.samples_per_pixel == 1:
+            return result.reshape(self.rows, self.columns)
+        if self.planar_configuration == 1:
+            return result.reshape(self.samples_per_pixel, self.rows,
+                                  self.columns).transpose(1, 2, 0)
+        return result.reshape(self.rows, self.columns, self.samples_per_pixel)
+
+
+    def to_tensor(self) -> torch.Tensor:
+        """
+        Get the windowed image as a uint8 tensor
+        ========================================
+
+        Returns
+        -------
+        torch.Tensor
+            Image with shape (1, rows, columns) for monochrome and
+            (3, rows, columns) for RGB images, values between 0 and 255.
+
+        Notes
+        -----
+            Modality rescale is applied first, then the window from the header
+            (or the full value range without a window), and MONOCHROME1
+            images are inverted, so bright always means dense like in the
+            training PNGs. Color samples wider than 8 bits are scaled from
+            their stored bits to 0-255.
+        """
+
+        # pylint: disable=no-member
+        #         torch has a member function from_numpy()
+
+        values = self.pixels()
+        if values.ndim == 3:
+            if self.bits_stored > 8:
+                values = (values.astype(np.float32) * 255.0 /
+                          ((1 << self.bits_stored) - 1) + 0.5)
+            return torch.from_numpy(np.ascontiguousarray(
+                                    np.clip(values, 0, 255).astype(np.uint8)
+                                    .transpose(2, 0, 1)))
+        values = (values.astype(np.float32) * self.rescale_slope +
+                  self.rescale_intercept)
+        if self.window_center is not None and self.window_width is not None:
+            values = apply_window(values, self.window_center,
+                                  self.window_width)
+        else:
+            low, high = float(values.min()), float(values.max())
+            values = (values - low) / max(high - low, 1e-6)
+        if self.photometric == 'MONOCHROME1':
+            values = 1.0 - values
+        return torch.from_numpy((values * 255.0 + 0.5).astype(np.uint8)
+                                ).unsqueeze(0)
+
+
+    def __parse(self):
+        """
+        Parse the header up to the pixel data
+        =====================================
+
+        Raises
+        ------
+        RuntimeError
+            When the file is not a DICOM file or has no pixel data.
+        """
+
+        with open(self.filename, 'rb') as instream:
+            instream.seek(128)
+            if instream.read(4) != b'DICM':
+                instream.seek(0)
+            explicit = True
+            while True:
+                position = instream.tell()
+                header = instream.read(4)
+                if len(header) < 4:
+                    break
+                group, element = unpack('<HH', header)
+                if group != 0x0002 and explicit:
+                    explicit = self.transfer_syntax != IMPLICIT_LITTLE
+                vr, length = read_length(instream, explicit, group)
+                if (group, element) == PIXEL_DATA:
+                    self.pixel_offset = instream.tell()
+                    self.pixel_length = length
+                    return
+                if length == UNDEFINED_LENGTH:
+                    skip_undefined(instream, explicit)
+                elif (group, element) in TAGS.keys():
+                    name, default_vr = TAGS[(group, element)]
+                    setattr(self, name, decode_value(instream.read(length),
+                                                     vr or default_vr))
+                else:
+                    instream.seek(length, 1)
+                if instream.tell() <= position:
+                    break
+        raise RuntimeError('ChainRad couldn\'t find pixel data in "{}".'
+                           .format(self.filename))
+
+
+def apply_window(values : np.ndarray, center : float,
+                 width : float) -> np.ndarray:
+    """
+    Apply a linear DICOM window
+    ===========================
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Rescaled pixel values.
+    center : float
+        Window center (level).
+    width : float
+        Window width.
+
+    Returns
+    -------
+    np.ndarray
+        Values between 0 and 1 according to the linear VOI LUT function of
+        the DICOM standard.
+    """
+
+    width = max(width, 1.0)
+    return np.clip((values - (center - 0.5)) / max(width - 1.0, 1.0) + 0.5,
+                   0.0, 1.0)
+
+
+def decode_value(raw : bytes, vr : any) -> any:
+    """
+    Decode the value of a needed tag
+    ================================
+
+    Parameters
+    ----------
+    raw : bytes
+        Raw value.
+    vr : bytes | str
+        Value representation.
+
+    Returns
+    -------
+    any
+        int for US and IS, float for DS (the first value of multi-valued
+        elements), str otherwise.
+    """
+
+    vr = vr.decode('ascii') if isinstance(vr, bytes) else vr
+    if vr == 'US':
+        return unpack('<H', raw[:2])[0]
+    text = raw.decode('ascii', errors='ignore').strip('\x00 ')
+    if vr in ['DS', 'IS']:
+        text = text.split('\\')[0].strip()
+        if text == '':
+            return None
+        return int(float(text)) if vr == 'IS' else float(text)
+    return text
+
+
+def is_dicom(filename : str) -> bool:
+    """
+    Check whether a file is a DICOM file
+    ====================================
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file.
+
+    Returns
+    -------
+    bool
+        True if the file has the DICM marker or a .dcm extension.
+    """
+
+    if filename.lower().endswith('.dcm'):
+        return True
+    with open(filename, 'rb') as instream:
+        instream.seek(128)
+        return instream.read(4) == b'DICM'
+
+
+def iter_series(directory : str) -> iter:
+    """
+    Iterate a series directory lazily
+    =================================
+
+    Parameters
+    ----------
+    directory : str
+        Directory of DICOM files.
+
+    Yields
+    ------
+    DicomImage
+        Headers ordered by series and instance number. Pixel data is read
+        only when the caller asks for it.
+    """
+
+    images = [DicomImage(join(directory, filename))
+              for filename in sorted(listdir(directory))
+              if isfile(join(directory, filename))
+              and is_dicom(join(directory, filename))]
+    images.sort(key=lambda image: (image.series_instance_uid,
+                                   image.instance_number or 0))
+    for image in images:
+        yield image
+
+
+def mask_stored_bits(values : np.ndarray, bits_stored : int,
+                     pixel_representation : int) -> np.ndarray:
+    """
+    Keep only the stored bits of pixel values
+    =========================================
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Raw values.
+    bits_stored : int
+        Number of stored bits.
+    pixel_representation : int
+        1 for signed, 0 for unsigned values.
+
+    Returns
+    -------
+    np.ndarray
+        Values with unused high bits cleared, sign extended if signed.
+    """
+
+    unsigned = values.astype(np.int64) & ((1 << bits_stored) - 1)
+    if pixel_representation == 1:
+        sign = 1 << (bits_stored - 1)
+        unsigned = (unsigned ^ sign) - sign
+    return unsigned
+
+
+def read_dicom(filename : str) -> torch.Tensor:
+    """
+    Read a DICOM file as a windowed uint8 tensor
+    ============================================
+
+    Parameters
+    ----------
+    filename : str
+        Name of the DICOM file.
+
+    Returns
+    -------
+    torch.Tensor
+        See DicomImage.to_tensor().
+    """
+
+    return DicomImage(filename).to_tensor()
+
+
+def read_length(instream : any, explicit : bool, group : int) -> tuple:
+    """
+    Read VR and length of an element
+    ================================
+
+    Parameters
+    ----------
+    instream : file
+        Stream positioned after the tag.
+    explicit : bool
+        Whether the VR is explicit.
+    group : int
+        Group of the tag, item tags (FFFE) never have VR.
+
+    Returns
+    -------
+    tuple(bytes, int)
+        VR (None if implicit) and value length.
+    """
+
+    if not explicit or group == 0xFFFE:
+        return None, unpack('<I', instream.read(4))[0]
+    vr = instream.read(2)
+    if vr in LONG_VRS:
+        instream.seek(2, 1)
+        return vr, unpack('<I', instream.read(4))[0]
+    return vr, unpack('<H', instream.read(2))[0]
+
+
+def skip_undefined(instream : any, explicit : bool):
+    """
+    Skip an element of undefined length
+    ===================================
+
+    Parameters
+    ----------
+    instream : file
+        Stream positioned at the start of the value.
+    explicit : bool
+        Whether the VR is explicit.
+
+    Notes
+    -----
+        Nested sequences and items are skipped recursively until the matching
+        sequence delimitation item.
+    """
+
+    while True:
+        header = instream.read(4)
+        if len(header) < 4:
+            return
+        group, element = unpack('<HH', header)
+        _, length = read_length(instream, explicit, group)
+        if (group, element) == (0xFFFE, 0xE0DD):
+            return
+        if (group, element) == (0xFFFE, 0xE00D):
+            continue
+        if length == UNDEFINED_LENGTH:
+            skip_undefined(instream, explicit)
+        else:
+            instream.seek(length, 1)
+
+
+def write_dicom(filename : str, pixels : np.ndarray,
+                photometric : str = 'MONOCHROME2',
+                window : tuple = None, instance_number : int = 1,
+                series_instance_uid : str = '1.2.826.0.1.3680043.2.1',
+                rescale : tuple = None, explicit : bool = True,
+                meta_header : bool = True):
+    """
+    Write a minimal uncompressed DICOM file
+    =======================================
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file to write.
+    pixels : np.ndarray
+        uint16 or uint8 pixel values, 2D for monochrome and 3D with the
+        samples last for color images.
+    photometric : str, optional ('MONOCHROME2' if omitted)
+        Photometric interpretation.
+    window : tuple, optional (None if omitted)
+        Window center and width to store.
+    instance_number : int, optional (1 if omitted)
+        Instance number.
+    series_instance_uid : str, optional
+        Series instance UID.
+    rescale : tuple, optional (None if omitted)
+        Rescale slope and intercept to store.
+    explicit : bool, optional (True if omitted)
+        Whether to write explicit VR little endian instead of implicit VR.
+    meta_header : bool, optional (True if omitted)
+        Whether to write the preamble, the DICM marker and the file meta
+        header. Without them the file is implicit VR, the default transfer
+        syntax.
+
+    Raises
+    ------
+    ValueError
+        When explicit VR is asked without the meta header.
+
+    Notes
+    -----
+        Intended for generating synthetic inputs locally, the file contains
+        only the elements that DicomImage reads.
+    """
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    def element(group : int, number : int, vr : bytes, value : bytes,
+                explicit : bool = True) -> bytes:
+        """
+        Encode a little endian element
+        ==============================
+        """
+
+        if len(value) % 2 == 1:
+            value += b'\x00' if vr in [b'UI', b'OB'] else b' '
+        if not explicit:
+            return pack('<HHI', group, number, len(value)) + value
+        if vr in LONG_VRS:
+            return pack('<HH2sHI', group, number, vr, 0, len(value)) + value
+        return pack('<HH2sH', group, number, vr, len(value)) + value
+
+    if explicit and not meta_header:
+        raise ValueError('ChainRad cannot write explicit VR DICOM without ' +
+                         'meta header.')
+    bits = 8 if pixels.dtype == np.uint8 else 16
+    samples = 1 if pixels.ndim == 2 else pixels.shape[2]
+    elements = [(0x0008, 0x0018, b'UI', '{}.{}'.format(
+                 series_instance_uid, instance_number).encode('ascii')),
+                (0x0020, 0x000E, b'UI', series_instance_uid.encode('ascii')),
+                (0x0020, 0x0013, b'IS', str(instance_number).encode('ascii')),
+                (0x0028, 0x0002, b'US', pack('<H', samples)),
+                (0x0028, 0x0004, b'CS', photometric.encode('ascii'))]
+    if samples > 1:
+        elements.append((0x0028, 0x0006, b'US', pack('<H', 0)))
+    elements += [(0x0028, 0x0010, b'US', pack('<H', pixels.shape[0])),
+                 (0x0028, 0x0011, b'US', pack('<H', pixels.shape[1])),
+                 (0x0028, 0x0100, b'US', pack('<H', bits)),
+                 (0x0028, 0x0101, b'US', pack('<H', bits)),
+                 (0x0028, 0x0103, b'US', pack('<H', 0))]
+    if window is not None:
+        elements += [(0x0028, 0x1050, b'DS', str(window[0]).encode('ascii')),
+                     (0x0028, 0x1051, b'DS', str(window[1]).encode('ascii'))]
+    if rescale is not None:
+        elements += [(0x0028, 0x1052, b'DS', str(rescale[1]).encode('ascii')),
+                     (0x0028, 0x1053, b'DS', str(rescale[0]).encode('ascii'))]
+    elements.append((0x7FE0, 0x0010, b'OW' if bits == 16 else b'OB',
+                     pixels.astype('<u{}'.format(bits // 8)).tobytes()))
+    body = b''.join(element(*item, explicit=explicit) for item in elements)
+    if meta_header:
+        meta = element(0x0002, 0x0010, b'UI', (EXPLICIT_LITTLE if explicit
+                                               else IMPLICIT_LITTLE)
+                       .encode('ascii'))
+        meta = element(0x0002, 0x0000, b'UL', pack('<I', len(meta))) + meta
+        body = b'\x00' * 128 + b'DICM' + meta + body
+    with open(filename, 'wb') as outstream:
+        outstream.write(body)
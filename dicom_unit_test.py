@@ -0,0 +1,170 @@
+"""
+ChainRad
+========
+
+File: unit test for DICOM input
+"""
+
+
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from dicom import DicomImage, EXPLICIT_LITTLE, IMPLICIT_LITTLE, is_dicom
+from dicom import iter_series, read_dicom, write_dicom
+
+
+# pylint: disable=invalid-name
+#         The variables failed and passed are actually not constants.
+
+
+failed, passed = 0, 0
+
+
+def report(title : str, is_successful : bool):
+    """
+    Print and count the result of a test
+    ====================================
+
+    Parameters
+    ----------
+    title : str
+        Title of the test.
+    is_successful : bool
+        Whether the test passed.
+    """
+
+    # pylint: disable=global-statement
+    #         Counters are shared by the whole script.
+
+    global failed, passed
+    print('--- Test: {}: '.format(title), end='')
+    if is_successful:
+        print('PASSED')
+        passed += 1
+    else:
+        print('FAILED')
+        failed += 1
+
+
+def windowed(values : np.ndarray, center : float, width : float
+             ) -> np.ndarray:
+    """
+    Get the expected uint8 result of a linear window
+    ================================================
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Rescaled pixel values.
+    center : float
+        Window center.
+    width : float
+        Window width.
+
+    Returns
+    -------
+    np.ndarray
+        Expected pixels.
+    """
+
+    values = np.clip((values.astype(np.float32) - (center - 0.5)) /
+                     (width - 1.0) + 0.5, 0.0, 1.0)
+    return (values * 255.0 + 0.5).astype(np.uint8)
+
+
+generator = np.random.default_rng(0)
+gray16 = generator.integers(0, 4096, (24, 32), dtype=np.uint16)
+gray8 = generator.integers(0, 256, (24, 32), dtype=np.uint8)
+rgb8 = generator.integers(0, 256, (24, 32, 3), dtype=np.uint8)
+rgb16 = generator.integers(0, 65536, (24, 32, 3), dtype=np.uint16)
+with TemporaryDirectory() as directory:
+    print('Testing transfer syntaxes...')
+    write_dicom(join(directory, 'explicit.dcm'), gray16, window=(2048, 4096))
+    write_dicom(join(directory, 'implicit.dcm'), gray16, window=(2048, 4096),
+                explicit=False)
+    write_dicom(join(directory, 'bare.dcm'), gray16, window=(2048, 4096),
+                explicit=False, meta_header=False)
+    expected = windowed(gray16, 2048, 4096)
+    for name, syntax in [('explicit', EXPLICIT_LITTLE),
+                         ('implicit', IMPLICIT_LITTLE),
+                         ('bare', IMPLICIT_LITTLE)]:
+        image = DicomImage(join(directory, name + '.dcm'))
+        report('{} VR header'.format(name),
+               image.transfer_syntax == syntax and image.rows == 24 and
+               image.columns == 32 and image.window_center == 2048)
+        report('{} VR raw pixels'.format(name),
+               np.array_equal(image.pixels(), gray16))
+        tensor = read_dicom(join(directory, name + '.dcm'))
+        report('{} VR windowed pixels'.format(name),
+               tuple(tensor.shape) == (1, 24, 32) and
+               np.array_equal(tensor[0].numpy(), expected))
+    print('Testing file detection...')
+    write_dicom(join(directory, 'with_meta'), gray8)
+    write_dicom(join(directory, 'without_meta'), gray8, explicit=False,
+                meta_header=False)
+    report('preamble detected', is_dicom(join(directory, 'with_meta')))
+    report('no preamble nor extension rejected',
+           not is_dicom(join(directory, 'without_meta')))
+    report('extension detected', is_dicom(join(directory, 'bare.dcm')))
+    try:
+        write_dicom(join(directory, 'refused.dcm'), gray8,
+                    meta_header=False)
+        report('explicit VR without meta header refused', False)
+    except ValueError:
+        report('explicit VR without meta header refused', True)
+    print('Testing grayscale conversion...')
+    write_dicom(join(directory, 'mono1.dcm'), gray16, window=(2048, 4096),
+                photometric='MONOCHROME1')
+    inverted = read_dicom(join(directory, 'mono1.dcm'))[0].numpy()
+    normal = read_dicom(join(directory, 'explicit.dcm'))[0].numpy()
+    report('MONOCHROME1 inverted',
+           np.abs(inverted.astype(np.int32) + normal - 255).max() <= 1)
+    write_dicom(join(directory, 'rescaled.dcm'), gray16, window=(1000, 2000),
+                rescale=(2.0, -1024.0))
+    image = DicomImage(join(directory, 'rescaled.dcm'))
+    report('rescale header', image.rescale_slope == 2.0 and
+           image.rescale_intercept == -1024.0)
+    report('rescale then window',
+           np.abs(read_dicom(join(directory, 'rescaled.dcm'))[0].numpy()
+                  .astype(np.int32) - windowed(gray16 * 2.0 - 1024.0, 1000,
+                                               2000)).max() <= 1)
+    write_dicom(join(directory, 'gray8.dcm'), gray8)
+    low, high = float(gray8.min()), float(gray8.max())
+    report('8-bit without window uses the value range',
+           np.abs(read_dicom(join(directory, 'gray8.dcm'))[0].numpy()
+                  .astype(np.int32) -
+                  ((gray8 - low) / (high - low) * 255.0 + 0.5)
+                  .astype(np.int32)).max() <= 1)
+    print('Testing color images...')
+    write_dicom(join(directory, 'rgb8.dcm'), rgb8, photometric='RGB')
+    tensor = read_dicom(join(directory, 'rgb8.dcm'))
+    report('8-bit RGB', tuple(tensor.shape) == (3, 24, 32) and
+           np.array_equal(tensor.permute(1, 2, 0).numpy(), rgb8))
+    write_dicom(join(directory, 'rgb16.dcm'), rgb16, photometric='RGB',
+                explicit=False)
+    tensor = read_dicom(join(directory, 'rgb16.dcm'))
+    report('16-bit RGB scaled to 8 bits', tuple(tensor.shape) == (3, 24, 32)
+           and np.abs(tensor.permute(1, 2, 0).numpy().astype(np.int32) -
+                      (rgb16 / 65535.0 * 255.0 + 0.5).astype(np.int32)
+                      ).max() <= 1)
+    print('Testing series...')
+    for name, number in [('c.dcm', 2), ('a.dcm', 3), ('b', 1)]:
+        write_dicom(join(directory, name), gray8, instance_number=number,
+                    series_instance_uid='1.2.3')
+    with open(join(directory, 'notes.txt'), 'w', encoding='utf8'
+              ) as outstream:
+        outstream.write('not an image')
+    images = [image for image in iter_series(directory)
+              if image.series_instance_uid == '1.2.3']
+    report('series ordered by instance number',
+           [image.instance_number for image in images] == [1, 2, 3])
+    report('pixel data located in every file',
+           all(image.pixel_offset is not None for image in images))
+print('Overall test: ', end='')
+if failed == 0:
+    print('PASSED', end='')
+else:
+    print('FAILED', end='')
+print(' --- passes: {}; fails: {}'.format(passed, failed))
@@ -0,0 +1,404 @@
+"""
+ChainRad
+========
+
+File: knowledge distillation into a compact student
+"""
+
+
+# Standard library imports
+from argparse import ArgumentParser
+from csv import reader
+from json import dump as json_dump
+from os.path import isfile, join
+from pickle import load as pickle_load
+
+# 3rd party imports
+import torch
+
+# Project level imports
+from checkpoint import copy_to_cpu
+from core import IMG_DIR, META_DIR, MODEL_DIR, OUT_DIR, SoloClassifier
+from core import get_student_model, load_diseases
+from metrics import get_auc
+from preprocess import BatchPreprocessor, load_batch
+from profiling import Profiler
+
+
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+SPLITS = ['valid', 'test', 'train']
+STUDENT_BATCH_SIZE = 32
+STUDENT_FILE = join(MODEL_DIR, 'student.statedict')
+STUDENT_SIZE = (160, 160)
+TARGETS_FILE = join(OUT_DIR, 'soft_targets.pt')
+
+
+def load_student(keys : list, random_init : bool = False) -> torch.nn.Module:
+    """
+    Load the student model
+    ======================
+
+    Parameters
+    ----------
+    keys : list
+        Disease keys in the order of the student's outputs.
+    random_init : bool, optional (False if omitted)
+        Whether to use a randomly initialized student, for benchmarks.
+
+    Returns
+    -------
+    torch.nn.Module
+        The student in eval mode.
+
+    Raises
+    ------
+    FileNotFoundError
+        When STUDENT_FILE doesn't exist.
+    """
+
+    model = get_student_model(pretrained=False, outputs=len(keys))
+    if not random_init:
+        if not isfile(STUDENT_FILE):
+            raise FileNotFoundError('Cannot find "{}".'.format(STUDENT_FILE))
+        model.load_state_dict(torch.load(STUDENT_FILE, map_location='cpu'))
+    for param in model.parameters():
+        param.requires_grad = False
+    model.eval()
+    return model
+
+
+def main():
+    """
+    Provides main functionality
+    ===========================
+    """
+
+    parser = ArgumentParser(description='Distill the ChainRad chain into a ' +
+                                        'compact student.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('targets', help='Compute soft targets from the ' +
+                                          'stored headless outputs.')
+    train_parser = subparsers.add_parser('train', help='Train the student.')
+    train_parser.add_argument('--epochs', type=int, default=20)
+    train_parser.add_argument('--batch-size', type=int,
+                              default=STUDENT_BATCH_SIZE)
+    train_parser.add_argument('--learning-rate', type=float, default=1e-4)
+    report_parser = subparsers.add_parser('report', help='Compare the ' +
+                                                         'student with the ' +
+                                                         'chain.')
+    report_parser.add_argument('--output', default=None,
+                               help='JSON file to write the report to.')
+    args = parser.parse_args()
+    keys = list(load_diseases().keys())
+    if args.command == 'targets':
+        data = make_soft_targets(keys)
+        print('Soft targets of {} images written to "{}".'.format(
+                                            len(data['images']), TARGETS_FILE))
+    elif args.command == 'train':
+        result = train_student(args.epochs, args.batch_size,
+                               args.learning_rate)
+        print('Best epoch {} -- test loss {:.6f}'.format(result['epoch'],
+                                                         result['loss']))
+    else:
+        result = report()
+        print('images: {} -- all decisions agree {:.2%}'.format(
+                                        result['images'], result['agreement']))
+        for key, value in result['diseases'].items():
+            print('{:20} agreement {:.2%} -- mean abs diff {:.4f} -- '
+                  .format(key, value['agreement'], value['mean_abs_diff']) +
+                  'auc student {:.4f} chain {:.4f}'.format(
+                                    value['student_auc'], value['chain_auc']))
+        if args.output is not None:
+            with open(args.output, 'w', encoding='utf8') as outstream:
+                json_dump(result, outstream, indent=2)
+
+
+def make_soft_targets(keys : list, batch_size : int = 1024) -> dict:
+    """
+    Compute soft targets of the stored headless outputs
+    ===================================================
+
+    Parameters
+    ----------
+    keys : list
+        Disease keys, the same as the meta file ids of the training.
+    batch_size : int, optional (1024 if omitted)
+        Number of headless outputs in memory at once.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'keys', 'images', 'splits' (split of every
+        image), 'targets' (sigmoid outputs of the heads with shape
+        (images, keys)) and 'labels' (ground truth with the same shape, -1
+        where an image is not in the meta file of a disease). It is saved to
+        TARGETS_FILE too.
+
+    Notes
+    -----
+        An image in the valid split of any disease is a valid image, then the
+        same for test, so the student never trains on images the report
+        evaluates.
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions cat(), full(), sigmoid(), stack()
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    splits, labels = {}, {}
+    for split in SPLITS:
+        for i, key in enumerate(keys):
+            with open(join(META_DIR, '{}_{}.csv'.format(split, key)), 'r',
+                      encoding='utf8') as instream:
+                for row in list(reader(instream, delimiter='\t'))[1:]:
+                    splits.setdefault(row[0], split)
+                    labels.setdefault(row[0], [-1] * len(keys))[i] = \
+                        int(row[3])
+    images = list(splits.keys())
+    heads = []
+    for key in keys:
+        heads.append(SoloClassifier())
+        heads[-1].load_state_dict(torch.load(join(MODEL_DIR, '{}.statedict'
+                                                  .format(key)),
+                                             map_location='cpu'))
+        heads[-1].eval()
+    targets = []
+    with torch.no_grad():
+        for pos in range(0, len(images), batch_size):
+            features = []
+            for image in images[pos:pos + batch_size]:
+                with open(join(OUT_DIR, image.split('.')[0] + '.out'),
+                          'rb') as instream:
+                    features.append(pickle_load(instream))
+            features = torch.stack(features)
+            targets.append(torch.cat([torch.sigmoid(head(features))
+                                      for head in heads], 1))
+    result = {'keys' : keys, 'images' : images,
+              'splits' : [splits[image] for image in images],
+              'targets' : torch.cat(targets),
+              'labels' : torch.tensor([labels[image] for image in images])}
+    torch.save(result, TARGETS_FILE)
+    return result
+
+
+def predict_student(model : torch.nn.Module, keys : list, filelist : list,
+                    size : tuple = STUDENT_SIZE, device : str = 'cpu',
+                    profiler : Profiler = None,
+                    batch_size : int = STUDENT_BATCH_SIZE) -> list:
+    """
+    Predict probabilities with the student
+    ======================================
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The student.
+    keys : list
+        Disease keys in the order of the student's outputs.
+    filelist : list
+        Image files.
+    size : tuple, optional (STUDENT_SIZE if omitted)
+        Input size of the student.
+    device : str, optional ('cpu' if omitted)
+        Device to run the student on.
+    profiler : Profiler, optional (None if omitted)
+        Profiler to record 'decode', 'transform' and 'student' stages with.
+    batch_size : int, optional (STUDENT_BATCH_SIZE if omitted)
+        Number of images scored together.
+
+    Returns
+    -------
+    list[dict]
+        Probabilities by disease key for every image.
+    """
+
+    # pylint: disable=no-member
+    #         torch has a member function sigmoid()
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    if profiler is None:
+        profiler = Profiler()
+    preprocessor = BatchPreprocessor(size)
+    model.to(device)
+    result = []
+    with torch.no_grad():
+        for pos in range(0, len(filelist), batch_size):
+            with profiler.stage('decode'):
+                images = load_batch(filelist[pos:pos + batch_size], size)
+            with profiler.stage('transform'):
+                images = preprocessor(images.to(device))
+            with profiler.stage('student'):
+                probabilities = torch.sigmoid(model(images)).cpu()
+            for row in probabilities.tolist():
+                result.append(dict(zip(keys, row)))
+    return result
+
+
+def report(size : tuple = STUDENT_SIZE) -> dict:
+    """
+    Compare the student with the chain on the valid images
+    ======================================================
+
+    Parameters
+    ----------
+    size : tuple, optional (STUDENT_SIZE if omitted)
+        Input size of the student.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'images', 'agreement' (fraction of images
+        where every decision equals the chain's) and 'diseases'. Every
+        disease has 'agreement' (decisions at the stored thresholds),
+        'mean_abs_diff' (of probabilities), and 'student_auc' and
+        'chain_auc' on the ground truth.
+    """
+
+    # pylint: disable=no-member
+    #         torch has a member function tensor()
+
+    # pylint: disable=not-callable
+    #         toch.tensor() is callable
+
+    data = torch.load(TARGETS_FILE)
+    diseases = load_diseases()
+    keys = data['keys']
+    student = score_split(load_student(keys), data, 'valid', size)
+    index = torch.tensor([split == 'valid' for split in data['splits']])
+    chain, labels = data['targets'][index], data['labels'][index]
+    thresholds = torch.tensor([diseases[key]['treshold'] for key in keys])
+    agree = (student >= thresholds) == (chain >= thresholds)
+    result = {'images' : int(index.sum()),
+              'agreement' : agree.all(1).float().mean().item(),
+              'diseases' : {}}
+    for i, key in enumerate(keys):
+        known = labels[:, i] >= 0
+        result['diseases'][key] = {'agreement' :
+                                   agree[:, i].float().mean().item(),
+                                   'mean_abs_diff' :
+                                   (student[:, i] - chain[:, i]).abs().mean()
+                                   .item(),
+                                   'student_auc' :
+                                   get_auc(student[known, i],
+                                           labels[known, i].float()),
+                                   'chain_auc' :
+                                   get_auc(chain[known, i],
+                                           labels[known, i].float())}
+    return result
+
+
+def score_split(model : torch.nn.Module, data : dict, split : str,
+                size : tuple = STUDENT_SIZE) -> torch.Tensor:
+    """
+    Get student probabilities of a split
+    ====================================
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The student.
+    data : dict
+        Soft targets, see make_soft_targets().
+    split : str
+        Split to score.
+    size : tuple, optional (STUDENT_SIZE if omitted)
+        Input size of the student.
+
+    Returns
+    -------
+    torch.Tensor
+        Probabilities with shape (images of the split, keys).
+    """
+
+    # pylint: disable=not-callable
+    #         toch.tensor() is callable
+
+    filelist = [join(IMG_DIR, image) for image, image_split
+                in zip(data['images'], data['splits']) if image_split == split]
+    result = predict_student(model, data['keys'], filelist, size, DEVICE)
+    return torch.tensor([[row[key] for key in data['keys']] for row in result])
+
+
+def train_student(epochs : int = 20, batch_size : int = STUDENT_BATCH_SIZE,
+                  learning_rate : float = 1e-4,
+                  size : tuple = STUDENT_SIZE) -> dict:
+    """
+    Train the student on the soft targets
+    =====================================
+
+    Parameters
+    ----------
+    epochs : int, optional (20 if omitted)
+        Number of epochs.
+    batch_size : int, optional (STUDENT_BATCH_SIZE if omitted)
+        Size of training batches.
+    learning_rate : float, optional (1e-4 if omitted)
+        Learning rate of the Adam optimizer.
+    size : tuple, optional (STUDENT_SIZE if omitted)
+        Input size of the student.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'epoch' and 'loss' of the saved state.
+
+    Notes
+    -----
+        The loss is the binary cross entropy between the student's logits and
+        the chain's probabilities. Images are decoded every epoch, setting
+        CHAINRAD_IMAGE_CACHE keeps the resized images between epochs. The
+        state with the lowest test loss is saved to STUDENT_FILE.
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions randperm(), tensor()
+
+    # pylint: disable=not-callable
+    #         toch.tensor() is callable
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    data = torch.load(TARGETS_FILE)
+    train_index = [i for i, split in enumerate(data['splits'])
+                   if split == 'train']
+    test_index = torch.tensor([split == 'test' for split in data['splits']])
+    model = get_student_model(outputs=len(data['keys'])).to(DEVICE)
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    criterion = torch.nn.BCEWithLogitsLoss()
+    preprocessor = BatchPreprocessor(size, augment=True)
+    best = None
+    for epoch in range(epochs):
+        model.train()
+        order = torch.randperm(len(train_index)).tolist()
+        for pos in range(0, len(order), batch_size):
+            index = [train_index[i] for i in order[pos:pos + batch_size]]
+            images = load_batch([join(IMG_DIR, data['images'][i])
+                                 for i in index], size)
+            images = preprocessor(images.to(DEVICE))
+            optimizer.zero_grad()
+            loss = criterion(model(images),
+                             data['targets'][index].to(DEVICE))
+            loss.backward()
+            optimizer.step()
+        model.eval()
+        with torch.no_grad():
+            probabilities = score_split(model, data, 'test', size)
+            loss = torch.nn.functional.binary_cross_entropy(
+                            probabilities.clamp(1e-7, 1 - 1e-7),
+                            data['targets'][test_index]).item()
+        print('Epoch {}: test loss {:.6f}'.format(epoch + 1, loss),
+              flush=True)
+        if best is None or loss < best['loss']:
+            best = {'epoch' : epoch + 1, 'loss' : loss}
+            torch.save(copy_to_cpu(model.state_dict()), STUDENT_FILE)
+    return best
+
+
+if __name__ == '__main__':
+    main()
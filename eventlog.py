@@ -0,0 +1,381 @@
+"""
+ChainRad
+========
+
+File: structured event logging
+"""
+
+
+# Standard library imports
+from csv import reader
+from os import makedirs, replace
+from os.path import isdir, isfile, join
+from queue import Queue
+from threading import Thread
+
+# 3rd party imports
+import numpy as np
+import torch
+
+
+HISTORY_COLUMNS = ['epoch', 'train_loss', 'train_accuracy', 'test_loss',
+                   'test_accuracy']
+
+
+class EventLogger:
+    """
+    Buffer training events in memory and flush them in the background
+    =================================================================
+
+    Notes
+    -----
+        Per-epoch metrics and the per-sample predictions of the last test pass
+        are kept in memory. Flushing writes them as compact columnar numpy
+        archives from a background thread:
+        - <log_id>.history.npz : one column per metric, one row per epoch.
+        - <log_id>.predictions.npz : columns 'prediction' and 'target'.
+        export_csv() writes the tab separated <log_id>.csv and
+        last_<log_id>.csv files that the notebooks read.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    #         The amount of attributes is needed because of the functionality.
+
+
+    def __init__(self, log_id : str, directory : str, flush_every : int = 1,
+                 resume_epoch : int = 0):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        log_id : str
+            Identifier of the log, usually the meta file id.
+        directory : str
+            Directory to write log files into.
+        flush_every : int, optional (1 if omitted)
+            Flush automatically after every flush_every epochs. 0 means only
+            on explicit flush() or close().
+        resume_epoch : int, optional (0 if omitted)
+            If greater than 0, the existing history is loaded and rows up to
+            this epoch are kept, otherwise the history starts empty.
+        """
+
+        if not isdir(directory):
+            makedirs(directory)
+        self.log_id = log_id
+        self.directory = directory
+        self.flush_every = flush_every
+        self.__history = {}
+        if resume_epoch > 0:
+            for key, values in read_history(log_id, directory).items():
+                self.__history[key] = list(values)
+            kept = [i for i, epoch in enumerate(self.__history.get('epoch',
+                                                                   []))
+                    if epoch <= resume_epoch]
+            for key, values in self.__history.items():
+                self.__history[key] = [values[i] for i in kept]
+        self.__predictions = None
+        self.__epochs_since_flush = 0
+        self.__queue = Queue()
+        self.__error = None
+        self.__worker = Thread(target=self.__write_loop, daemon=True)
+        self.__worker.start()
+
+
+    def close(self, csv : bool = True):
+        """
+        Flush pending events and stop the background writer
+        ====================================================
+
+        Parameters
+        ----------
+        csv : bool, optional (True if omitted)
+            Whether to export CSV files for the notebooks as well.
+
+        Raises
+        ------
+        RuntimeError
+            When a background write failed.
+        """
+
+        self.flush()
+        if csv:
+            self.__queue.put(('csv', None))
+        if self.__worker.is_alive():
+            self.__queue.put(None)
+            self.__worker.join()
+        self.__raise_if_failed()
+
+
+    def export_csv(self):
+        """
+        Export CSV files for the notebooks
+        ==================================
+
+        Notes
+        -----
+            The export is queued, the files are written by the background
+            writer.
+        """
+
+        self.flush()
+        self.__queue.put(('csv', None))
+
+
+    def flush(self):
+        """
+        Queue buffered events for writing
+        =================================
+
+        Raises
+        ------
+        RuntimeError
+            When a background write failed.
+        """
+
+        self.__raise_if_failed()
+        self.__queue.put(('npz', ({key : list(values) for key, values
+                                   in self.__history.items()},
+                                  self.__predictions)))
+        self.__epochs_since_flush = 0
+
+
+    def log_epoch(self, values : dict):
+        """
+        Log metrics of an epoch
+        =======================
+
+        Parameters
+        ----------
+        values : dict
+            Dictionary of metric name and value. The key 'epoch' should be
+            present. Missing values of previously seen metrics are NaN.
+        """
+
+        row_count = len(self.__history.get('epoch', []))
+        for key in values.keys():
+            if key not in self.__history.keys():
+                self.__history[key] = [float('nan')] * row_count
+        for key, column in self.__history.items():
+            column.append(values.get(key, float('nan')))
+        self.__epochs_since_flush += 1
+        if 0 < self.flush_every <= self.__epochs_since_flush:
+            self.flush()
+
+
+    def log_predictions(self, predictions : torch.Tensor,
+                        targets : torch.Tensor):
+        """
+        Log per-sample predictions of a test pass
+        =========================================
+
+        Parameters
+        ----------
+        predictions : torch.Tensor
+            Predicted probabilities.
+        targets : torch.Tensor
+            Targets.
+
+        Notes
+        -----
+            The tensors are cloned on their device without synchronization,
+            copying to the host happens on the background writer.
+        """
+
+        self.__predictions = (predictions.detach().clone(),
+                              targets.detach().clone())
+
+
+    def __raise_if_failed(self):
+        """
+        Re-raise an error of the background writer
+        ===========================================
+
+        Raises
+        ------
+        RuntimeError
+            When a background write failed.
+        """
+
+        if self.__error is not None:
+            raise RuntimeError('ChainRad couldn\'t write event log.'
+                               ) from self.__error
+
+
+    def __write_csv(self, history : dict, predictions : tuple):
+        """
+        Write CSV files in the format of the notebooks
+        ==============================================
+
+        Parameters
+        ----------
+        history : dict
+            Columns of the history.
+        predictions : tuple
+            Predictions and targets as numpy arrays or None.
+        """
+
+        columns = [key for key in HISTORY_COLUMNS if key in history.keys()]
+        columns += [key for key in history.keys() if key not in columns]
+        filename = join(self.directory, '{}.csv'.format(self.log_id))
+        with open(filename + '.tmp', 'w', encoding='utf8') as outstream:
+            outstream.write('\t'.join(columns) + '\n')
+            for row in zip(*[history[key] for key in columns]):
+                outstream.write('\t'.join(str(value) for value in row) + '\n')
+        replace(filename + '.tmp', filename)
+        if predictions is not None:
+            filename = join(self.directory, 'last_{}.csv'.format(self.log_id))
+            with open(filename + '.tmp', 'w', encoding='utf8') as outstream:
+                outstream.write('prediction\ttarget\n')
+                for _x, _y in zip(predictions[0].tolist(),
+                                  predictions[1].tolist()):
+                    outstream.write('{}\t{}\n'.format(_x, int(_y)))
+            replace(filename + '.tmp', filename)
+
+
+    def __write_loop(self):
+        """
+        Write queued events in the background
+        =====================================
+        """
+
+        # pylint: disable=broad-except
+        #         Any error is stored and re-raised on the training thread.
+
+        history, predictions = {}, None
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                self.__queue.task_done()
+                break
+            kind, content = item
+            try:
+                if kind == 'npz':
+                    history, predictions = content
+                    if predictions is not None:
+                        predictions = (predictions[0].cpu().numpy(),
+                                       predictions[1].cpu().numpy())
+                    write_npz(join(self.directory, '{}.history.npz'
+                                                   .format(self.log_id)),
+                              {key : np.asarray(values)
+                               for key, values in history.items()})
+                    if predictions is not None:
+                        write_npz(join(self.directory, '{}.predictions.npz'
+                                                       .format(self.log_id)),
+                                  {'prediction' : predictions[0],
+                                   'target' : predictions[1]})
+                else:
+                    self.__write_csv(history, predictions)
+            except Exception as error:
+                self.__error = error
+            finally:
+                self.__queue.task_done()
+
+
+def read_csv_columns(filename : str) -> dict:
+    """
+    Read a tab separated numeric file into columns
+    ==============================================
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file to read.
+
+    Returns
+    -------
+    dict
+        Dictionary of column name and numpy array of values. Empty if the file
+        doesn't exist.
+    """
+
+    if not isfile(filename):
+        return {}
+    with open(filename, 'r', encoding='utf8') as instream:
+        rows = list(reader(instream, delimiter='\t'))
+    if len(rows) == 0:
+        return {}
+    return {key : np.asarray([float(row[i]) for row in rows[1:]])
+            for i, key in enumerate(rows[0])}
+
+
+def read_history(log_id : str, directory : str) -> dict:
+    """
+    Read the epoch history of a log
+    ===============================
+
+    Parameters
+    ----------
+    log_id : str
+        Identifier of the log, usually the meta file id.
+    directory : str
+        Directory of log files.
+
+    Returns
+    -------
+    dict
+        Dictionary of metric name and numpy array of values per epoch. It can
+        be passed directly to pandas.DataFrame(). Empty if there is no log.
+
+    Notes
+    -----
+        The columnar archive is preferred, the CSV file is read if there is no
+        archive.
+    """
+
+    filename = join(directory, '{}.history.npz'.format(log_id))
+    if isfile(filename):
+        with np.load(filename) as content:
+            return {key : content[key] for key in content.files}
+    return read_csv_columns(join(directory, '{}.csv'.format(log_id)))
+
+
+def read_predictions(log_id : str, directory : str) -> dict:
+    """
+    Read the per-sample predictions of the last test pass
+    =====================================================
+
+    Parameters
+    ----------
+    log_id : str
+        Identifier of the log, usually the meta file id.
+    directory : str
+        Directory of log files.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'prediction' and 'target' and numpy arrays as
+        values. Empty if there is no log.
+
+    Notes
+    -----
+        The columnar archive is preferred, last_<log_id>.csv is read if there
+        is no archive.
+    """
+
+    filename = join(directory, '{}.predictions.npz'.format(log_id))
+    if isfile(filename):
+        with np.load(filename) as content:
+            return {key : content[key] for key in content.files}
+    return read_csv_columns(join(directory, 'last_{}.csv'.format(log_id)))
+
+
+def write_npz(filename : str, columns : dict):
+    """
+    Write columns into a numpy archive atomically
+    =============================================
+
+    Parameters
+    ----------
+    filename : str
+        Name of the archive, should end with .npz.
+    columns : dict
+        Dictionary of column name and numpy array.
+    """
+
+    with open(filename + '.tmp', 'wb') as outstream:
+        np.savez(outstream, **columns)
+    replace(filename + '.tmp', filename)
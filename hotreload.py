@@ -0,0 +1,145 @@
+"""
+ChainRad
+========
+
+File: background reload of changed tresholds and models
+"""
+
+
+# Standard library imports
+from threading import Event, Thread
+
+
+class HotReloader:
+    """
+    Reload a session in the background when its files change
+    ========================================================
+
+    Notes
+    -----
+        A daemon thread calls InferenceSession.reload() every poll interval.
+        The changed state dicts are loaded by this thread while scoring goes
+        on, then swapped in at once, so scoring never waits for the reload,
+        and the next micro-batches use the new models. If another thread
+        keeps swapping the session for longer than the swap timeout, or a
+        file fails to load, nothing changes and the next poll tries again.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    #         The amount of attributes is needed because of the functionality.
+
+
+    def __init__(self, session : any, poll_interval : float = 2.0,
+                 swap_timeout : float = 1.0, callback : any = None):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        session : InferenceSession
+            Session to reload.
+        poll_interval : float, optional (2.0 if omitted)
+            Seconds between two checks of the files.
+        swap_timeout : float, optional (1.0 if omitted)
+            Maximum seconds to wait for a setup() or reload() of another
+            thread before the swap.
+        callback : callable, optional (None if omitted)
+            Function to call with the result of InferenceSession.reload()
+            when something was reloaded.
+        """
+
+        self.session = session
+        self.poll_interval = poll_interval
+        self.swap_timeout = swap_timeout
+        self.callback = callback
+        self.last_error = None
+        self.reloads = 0
+        self.__stop = Event()
+        self.__thread = None
+
+
+    def check(self) -> dict:
+        """
+        Check the files and reload the changed ones once
+        ================================================
+
+        Returns
+        -------
+        dict | None
+            The result of InferenceSession.reload() or None if it failed,
+            the error is kept in last_error.
+        """
+
+        # pylint: disable=broad-except
+        #         A failed reload must not stop the thread, it's tried again.
+
+        try:
+            result = self.session.reload(self.swap_timeout)
+        except Exception as error:
+            self.last_error = error
+            return None
+        self.last_error = None
+        if len(result['tresholds']) > 0 or len(result['models']) > 0:
+            self.reloads += 1
+            if self.callback is not None:
+                self.callback(result)
+        return result
+
+
+    def is_running(self) -> bool:
+        """
+        Check whether the thread is running
+        ===================================
+
+        Returns
+        -------
+        bool
+            True if the thread is running, False if not.
+        """
+
+        return self.__thread is not None and self.__thread.is_alive()
+
+
+    def start(self):
+        """
+        Start the thread
+        ================
+
+        Raises
+        ------
+        RuntimeError
+            When the thread is already running.
+        """
+
+        if self.is_running():
+            raise RuntimeError('ChainRad couldn\'t start a running reloader.')
+        self.__stop.clear()
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+
+    def stop(self):
+        """
+        Stop the thread
+        ===============
+
+        Notes
+        -----
+            A reload in progress is finished first.
+        """
+
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+
+    def __run(self):
+        """
+        Check the files until stop() is called
+        ======================================
+        """
+
+        while not self.__stop.wait(self.poll_interval):
+            self.check()
@@ -0,0 +1,612 @@
+"""
+ChainRad
+========
+
+File: inference without the GUI
+"""
+
+
+# Standard library imports
+from os.path import isfile
+from time import time
+
+# 3rd party imports
+import torch
+
+# Project level imports
+from batching import DEFAULT_MEMORY_BUDGET, get_micro_batch_size
+from cascade import CASCADE_BACKBONE, is_certain
+from decode import IMAGE_SIZE
+from distill import STUDENT_SIZE
+from pipeline import Pipeline
+from preprocess import BatchPreprocessor, load_batch
+from profiling import Profiler, get_profiler
+from results import get_content_hash
+from session import InferenceSession
+
+
+# Global level variables
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+PROFILER = get_profiler()
+# Default session of the process, used wherever no session is given. Further
+# sessions can be made with InferenceSession() and passed to score(). The name
+# is kept, so SessionSetup.setup() and the getters work as before.
+# pylint: disable=invalid-name
+SessionSetup = InferenceSession()
+
+
+def apply_treshold(probability : float, key : str,
+                   session : InferenceSession = None) -> int:
+    """
+    Applies treshold on a predicted probability
+    ===========================================
+
+    Parameters
+    ----------
+    probability : float
+        The probability of the disease, sigmoid of the model's output.
+    key : str
+        Name of the treshold to apply.
+    session : InferenceSession, optional (None if omitted)
+        Session to take the treshold from. If omitted, SessionSetup is used.
+
+    Returns
+    -------
+    int
+        The real predicton. 1 if disease is predicted, 0 if not.
+    """
+
+    if session is None:
+        session = SessionSetup
+    if key in session.tresholds().keys():
+        result = 0 if probability < session.tresholds()[key] else 1
+    else:
+        result = 0 if probability < 0.5 else 1
+    return result
+
+
+def iter_predict(filelist : list, profiler : Profiler = None,
+                 device : str = None, band : float = None,
+                 memory_budget : float = None, pipeline : Pipeline = None,
+                 session : InferenceSession = None) -> any:
+    """
+    Predict diseases from images incrementally
+    ==========================================
+
+    Parameters
+    ----------
+    filelist : list
+        List of files to use as inputs.
+    profiler : Profiler, optional (None if omitted)
+        Profiler to record per-stage timings with, see score().
+    device : str, optional (None if omitted)
+        Device to run the models on. If omitted, DEVICE is used.
+    band : float, optional (None if omitted)
+        Uncertainty band of the cascade, see score().
+    memory_budget : float, optional (None if omitted)
+        Working memory of a micro-batch in MB, see iter_score().
+    pipeline : Pipeline, optional (None if omitted)
+        Pipeline to overlap the stages with, see iter_score().
+    session : InferenceSession, optional (None if omitted)
+        Session to score with, see iter_score().
+
+    Yields
+    ------
+    dict
+        Prediction of the next image in the form predict() gives.
+
+    Raises
+    ------
+    FileNotFoundError
+        When a file in the filelist doesn't exist.
+    """
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    for record in iter_score(filelist, profiler=profiler, device=device,
+                             band=band, memory_budget=memory_budget,
+                             pipeline=pipeline, session=session):
+        yield record['decisions']
+
+
+def iter_score(filelist : list, profiler : Profiler = None,
+               device : str = None, band : float = None,
+               memory_budget : float = None, pipeline : Pipeline = None,
+               session : InferenceSession = None) -> any:
+    """
+    Score images incrementally in micro-batches
+    ===========================================
+
+    Parameters
+    ----------
+    filelist : list
+        List of files to use as inputs.
+    profiler : Profiler, optional (None if omitted)
+        Profiler to record per-stage timings with. If omitted, the profiler
+        configured by the CHAINRAD_PROFILE environment variable is used.
+        Every micro-batch is profiled as a batch.
+    device : str, optional (None if omitted)
+        Device to run the models on. If omitted, DEVICE is used.
+    band : float, optional (None if omitted)
+        Uncertainty band of the cascade, see score_batch().
+    memory_budget : float, optional (None if omitted)
+        Working memory of a micro-batch in MB, the loaded weights excluded.
+        If omitted, batching.DEFAULT_MEMORY_BUDGET is used.
+    pipeline : Pipeline, optional (None if omitted)
+        If given, decode, transform, backbones and heads run as stages of
+        the pipeline, see iter_score_pipelined(). If omitted, the stages of
+        a micro-batch run one after the other.
+    session : InferenceSession, optional (None if omitted)
+        Session with the models and tresholds to score with. If omitted,
+        SessionSetup, the default session of the process is used.
+
+    Yields
+    ------
+    dict
+        Record of the next image in the form score() gives.
+
+    Raises
+    ------
+    FileNotFoundError
+        When a file in the filelist doesn't exist.
+
+    Notes
+    -----
+        The micro-batch size is the memory budget divided by the measured
+        working memory of a single sample, see
+        InferenceSession.sample_memory(). Images are decoded, passed through
+        the backbones and the heads one micro-batch at a time, so only a
+        micro-batch of images and headless outputs is held at once whatever
+        the length of filelist is. Every micro-batch is scored with a new
+        snapshot of the session, so any number of threads can score with
+        the same session at once, and the session may change between
+        micro-batches.
+    """
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    if profiler is None:
+        profiler = PROFILER
+    if device is None:
+        device = DEVICE
+    if memory_budget is None:
+        memory_budget = DEFAULT_MEMORY_BUDGET
+    if session is None:
+        session = SessionSetup
+    for filename in filelist:
+        if not isfile(filename):
+            raise FileNotFoundError('Source file "{}" doesn\'t exist.'
+                                    .format(filename))
+    if pipeline is not None:
+        yield from iter_score_pipelined(filelist, profiler, device, band,
+                                        memory_budget, pipeline, session)
+        return
+    batch_size = None
+    pos = 0
+    while pos < len(filelist):
+        current = session.snapshot()
+        if batch_size is None:
+            batch_size = get_micro_batch_size(memory_budget,
+                                              current.sample_memory(device),
+                                              len(filelist))
+        with profiler.batch():
+            records = score_batch(filelist[pos:pos + batch_size], profiler,
+                                  device, band, current)
+        pos += batch_size
+        yield from records
+
+
+def iter_score_pipelined(filelist : list, profiler : Profiler, device : str,
+                         band : float, memory_budget : float,
+                         pipeline : Pipeline, session : InferenceSession = None
+                         ) -> any:
+    """
+    Score images with overlapping stages
+    ====================================
+
+    Parameters
+    ----------
+    filelist : list
+        List of existing files to use as inputs.
+    profiler : Profiler
+        Profiler to record the whole run as a batch with.
+    device : str
+        Device to run the models on.
+    band : float
+        Uncertainty band of the cascade, see score_batch().
+    memory_budget : float
+        Working memory of all micro-batches in the pipeline in MB.
+    pipeline : Pipeline
+        Pipeline with the worker counts of the stages 'decode',
+        'transform', 'backbone' and 'head'.
+    session : InferenceSession, optional (None if omitted)
+        Session to score with. If omitted, SessionSetup is used.
+
+    Yields
+    ------
+    dict
+        Record of the next image in the form score() gives.
+
+    Notes
+    -----
+        Micro-batches flow through bounded queues, so while the backbones
+        run on one micro-batch the next ones are being decoded and the
+        previous one is at the heads. The budget is shared by the
+        micro-batches the pipeline can hold at once, see
+        Pipeline.in_flight(). Per-stage times, utilization and backpressure
+        are given by pipeline.metrics(), the profiler records the run as a
+        single batch. A snapshot of the session is taken for every
+        micro-batch when it enters the pipeline, so every stage of a
+        micro-batch sees the same models, and a reload is picked up by the
+        next micro-batch.
+    """
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    if session is None:
+        session = SessionSetup
+    names = ['decode', 'transform', 'backbone', 'head']
+    stage_profiler = Profiler()
+    batch_size = get_micro_batch_size(memory_budget /
+                                      pipeline.in_flight(names),
+                                      session.snapshot().sample_memory(device),
+                                      len(filelist))
+    sizes = {'chain' : IMAGE_SIZE, 'student' : STUDENT_SIZE}
+    preprocessors = {key : BatchPreprocessor(size)
+                     for key, size in sizes.items()}
+    # Items are (files, snapshot, data), the data changes stage by stage.
+    stages = [lambda item: (item[0], item[1],
+                            load_batch(item[0], sizes[item[1].backend()])),
+              lambda item: (item[0], item[1],
+                            preprocessors[item[1].backend()](
+                                                    item[2].to(device))),
+              lambda item: (item[0], item[1],
+                            run_backbones(item[2], stage_profiler, device,
+                                          band, item[1])),
+              lambda item: run_heads(item[0], item[2], stage_profiler, device,
+                                     item[1])]
+    with profiler.batch('pipeline'):
+        for records in pipeline.run(list(zip(names, stages)),
+                                    ((filelist[pos:pos + batch_size],
+                                      session.snapshot(), None)
+                                     for pos in range(0, len(filelist),
+                                                      batch_size))):
+            yield from records
+
+
+def predict(filelist : list, profiler : Profiler = None,
+            device : str = None, band : float = None,
+            memory_budget : float = None, pipeline : Pipeline = None,
+            session : InferenceSession = None) -> list:
+    """
+    Predict diseases from images
+    ============================
+
+    Parameters
+    ----------
+    filelist : list
+        List of files to use as inputs.
+    profiler : Profiler, optional (None if omitted)
+        Profiler to record per-stage timings with. If omitted, the profiler
+        configured by the CHAINRAD_PROFILE environment variable is used.
+    device : str, optional (None if omitted)
+        Device to run the models on. If omitted, DEVICE is used.
+    band : float, optional (None if omitted)
+        Uncertainty band of the cascade, see score().
+    memory_budget : float, optional (None if omitted)
+        Working memory of a micro-batch in MB, see iter_score().
+    pipeline : Pipeline, optional (None if omitted)
+        Pipeline to overlap the stages with, see iter_score().
+    session : InferenceSession, optional (None if omitted)
+        Session to score with, see iter_score().
+
+    Returns
+    -------
+    list[dict]
+        List of predictions. Predictions are in the form of a Dictionary where
+        key is disease ID and value is 1 if the disease is predicted, 0 if not.
+
+    Raises
+    ------
+    FileNotFoundError
+        When a file in the filelist doesn't exist.
+
+    See also
+    --------
+        Probabilities and versions : score()
+        Incremental results : iter_predict()
+    """
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    return list(iter_predict(filelist, profiler=profiler, device=device,
+                             band=band, memory_budget=memory_budget,
+                             pipeline=pipeline, session=session))
+
+
+def print_reload(changes : dict):
+    """
+    Print what a hot reload changed
+    ===============================
+
+    Parameters
+    ----------
+    changes : dict
+        Result of InferenceSession.reload().
+    """
+
+    print('Reloaded tresholds: {} -- models: {}.'.format(
+          ', '.join(changes['tresholds']) or 'none',
+          ', '.join(changes['models']) or 'none'), flush=True)
+
+
+def run_backbones(images : torch.Tensor, profiler : Profiler, device : str,
+                  band : float = None, session : InferenceSession = None
+                  ) -> dict:
+    """
+    Run the backbones or the student on a micro-batch
+    =================================================
+
+    Parameters
+    ----------
+    images : torch.Tensor
+        Transformed micro-batch on device.
+    profiler : Profiler
+        Profiler to record per-stage timings with.
+    device : str
+        Device to run the models on.
+    band : float, optional (None if omitted)
+        Uncertainty band of the cascade, see score_batch().
+    session : InferenceSession, optional (None if omitted)
+        Session to score with. If omitted, SessionSetup is used.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'probabilities' (list of probabilities by
+        disease ID for the images scored already, None for the others),
+        'early_exit' (list of bools, True if the light heads gave the
+        result), 'chain_index' (indices of the images the heads have to
+        score) and 'headless_outs' (their headless outputs on the CPU, None
+        if chain_index is empty).
+    """
+
+    # pylint: disable=no-member
+    #         toch has member functions cat(), no_grad(), sigmoid()
+
+    if session is None:
+        session = SessionSetup
+    count = images.shape[0]
+    result = {'probabilities' : [None] * count, 'early_exit' : [False] * count,
+              'chain_index' : [], 'headless_outs' : None}
+    with torch.no_grad(), session.device_guard(device, 'backbone'):
+        if session.backend() == 'student':
+            # The student gives every probability, nothing to run after.
+            with profiler.stage('student'):
+                probabilities = torch.sigmoid(session.student().to(
+                                                    device)(images)).cpu()
+            result['probabilities'] = [dict(zip(session.keys(), row))
+                                       for row in probabilities.tolist()]
+            return result
+        chain_index = list(range(count))
+        for headless_model in session.headless_models().values():
+            headless_model.to(device)
+        flats = {}
+        if band is not None and len(session.light_models()) > 0:
+            with profiler.stage('backbone:{}'.format(CASCADE_BACKBONE)):
+                flats[CASCADE_BACKBONE] = session\
+                    .headless_models()[CASCADE_BACKBONE](images).cpu()
+            with profiler.stage('cascade'):
+                light = {key : torch.sigmoid(model(
+                                flats[CASCADE_BACKBONE])).squeeze(1).tolist()
+                         for key, model in session.light_models().items()}
+            for i in range(count):
+                light_out = {key : value[i] for key, value in light.items()}
+                if is_certain(light_out, session.tresholds(), band):
+                    result['probabilities'][i] = light_out
+                    result['early_exit'][i] = True
+            chain_index = [i for i in chain_index
+                           if not result['early_exit'][i]]
+            if len(chain_index) < count:
+                images = images[chain_index]
+                flats[CASCADE_BACKBONE] = flats[CASCADE_BACKBONE][chain_index]
+        if len(chain_index) > 0:
+            for name, headless_model in session.headless_models().items():
+                if name not in flats.keys():
+                    with profiler.stage('backbone:{}'.format(name)):
+                        flats[name] = headless_model(images).cpu()
+            with profiler.stage('concat'):
+                result['headless_outs'] = torch.cat([flats[name] for name
+                                                     in session
+                                                     .headless_models()
+                                                     .keys()], 1)
+        for headless_model in session.headless_models().values():
+            headless_model.to('cpu')
+    result['chain_index'] = chain_index
+    return result
+
+
+def run_heads(filelist : list, outputs : dict, profiler : Profiler,
+              device : str, session : InferenceSession = None) -> list:
+    """
+    Run the heads and make the records of a micro-batch
+    ===================================================
+
+    Parameters
+    ----------
+    filelist : list
+        Files of the micro-batch.
+    outputs : dict
+        Outputs of run_backbones() for the micro-batch.
+    profiler : Profiler
+        Profiler to record per-stage timings with.
+    device : str
+        Device to run the heads on.
+    session : InferenceSession, optional (None if omitted)
+        Session to score with. If omitted, SessionSetup is used.
+
+    Returns
+    -------
+    list[dict]
+        Records in the form score() gives.
+    """
+
+    # pylint: disable=no-member
+    #         toch has member functions no_grad(), sigmoid()
+
+    if session is None:
+        session = SessionSetup
+    result = []
+    for i, filename in enumerate(filelist):
+        with profiler.stage('hash'):
+            result.append({'image' : filename,
+                           'content_hash' : get_content_hash(filename),
+                           'model_version' : session.model_version(),
+                           'threshold_version' : session.threshold_version(),
+                           'scored' : time(), 'probabilities' : {},
+                           'decisions' : {},
+                           'early_exit' : outputs['early_exit'][i]})
+        if outputs['probabilities'][i] is not None:
+            for key, probability in outputs['probabilities'][i].items():
+                result[i]['probabilities'][key] = probability
+                result[i]['decisions'][key] = apply_treshold(probability, key,
+                                                             session)
+    if len(outputs['chain_index']) == 0:
+        return result
+    with torch.no_grad(), session.device_guard(device, 'head'):
+        headless_outs = outputs['headless_outs'].to(device)
+        if session.shared_model() is not None:
+            model = session.shared_model().to(device)
+            keys = sorted(session.keys())
+            with profiler.stage('head:shared'):
+                probabilities = torch.sigmoid(model(headless_outs)).cpu()\
+                                .tolist()
+            with profiler.stage('threshold'):
+                for i, row in zip(outputs['chain_index'], probabilities):
+                    for key, probability in zip(keys, row):
+                        result[i]['probabilities'][key] = probability
+                        result[i]['decisions'][key] = apply_treshold(
+                                                    probability, key, session)
+            model.to('cpu')
+        for key, model in session.trained_models().items():
+            model.to(device)
+            with profiler.stage('head:{}'.format(key)):
+                probabilities = torch.sigmoid(model(headless_outs)).squeeze(1)\
+                                .cpu().tolist()
+            with profiler.stage('threshold'):
+                for i, probability in zip(outputs['chain_index'],
+                                          probabilities):
+                    result[i]['probabilities'][key] = probability
+                    result[i]['decisions'][key] = apply_treshold(probability,
+                                                                 key, session)
+            model.to('cpu')
+    return result
+
+
+def score(filelist : list, profiler : Profiler = None, device : str = None,
+          band : float = None, memory_budget : float = None,
+          pipeline : Pipeline = None, session : InferenceSession = None
+          ) -> list:
+    """
+    Score images with probabilities and decisions
+    =============================================
+
+    Parameters
+    ----------
+    filelist : list
+        List of files to use as inputs.
+    profiler : Profiler, optional (None if omitted)
+        Profiler to record per-stage timings with. If omitted, the profiler
+        configured by the CHAINRAD_PROFILE environment variable is used.
+    device : str, optional (None if omitted)
+        Device to run the models on. If omitted, DEVICE is used.
+    band : float, optional (None if omitted)
+        Uncertainty band of the cascade, see score_batch().
+    memory_budget : float, optional (None if omitted)
+        Working memory of a micro-batch in MB, see iter_score().
+    pipeline : Pipeline, optional (None if omitted)
+        Pipeline to overlap the stages with, see iter_score().
+    session : InferenceSession, optional (None if omitted)
+        Session to score with, see iter_score().
+
+    Returns
+    -------
+    list[dict]
+        List of records in the form results.ResultStore.add() expects: the
+        image, its content hash, the model and treshold versions, the scoring
+        time, the probabilities and decisions by disease ID, and 'early_exit'
+        that is True if the light heads gave the result.
+
+    Raises
+    ------
+    FileNotFoundError
+        When a file in the filelist doesn't exist.
+
+    See also
+    --------
+        Incremental results : iter_score()
+    """
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    return list(iter_score(filelist, profiler=profiler, device=device,
+                           band=band, memory_budget=memory_budget,
+                           pipeline=pipeline, session=session))
+
+
+def score_batch(filelist : list, profiler : Profiler, device : str,
+                band : float = None, session : InferenceSession = None
+                ) -> list:
+    """
+    Score a micro-batch of images
+    =============================
+
+    Parameters
+    ----------
+    filelist : list
+        Existing files of the micro-batch.
+    profiler : Profiler
+        Profiler to record per-stage timings with.
+    device : str
+        Device to run the models on.
+    band : float, optional (None if omitted)
+        Uncertainty band of the cascade. If given and the light heads are
+        loaded, CASCADE_BACKBONE and the light heads run first, and the other
+        backbones and the heads run only for images having a probability
+        within band of its treshold. If omitted, every image goes through the
+        full chain. With the 'student' backend the student scores every
+        image and band has no effect.
+    session : InferenceSession, optional (None if omitted)
+        Session to score with. If omitted, SessionSetup is used.
+
+    Returns
+    -------
+    list[dict]
+        Records in the form score() gives.
+
+    Notes
+    -----
+        Pass a snapshot of the session, see InferenceSession.snapshot(), so
+        the micro-batch sees the same models and tresholds throughout.
+    """
+
+    if session is None:
+        session = SessionSetup
+    size = STUDENT_SIZE if session.backend() == 'student' else IMAGE_SIZE
+    with profiler.stage('decode'):
+        images = load_batch(filelist, size)
+    with profiler.stage('transform'):
+        images = BatchPreprocessor(size)(images.to(device))
+    outputs = run_backbones(images, profiler, device, band, session)
+    del images
+    return run_heads(filelist, outputs, profiler, device, session)
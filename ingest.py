@@ -0,0 +1,657 @@
+"""
+ChainRad
+========
+
+File: watch-folder ingestion service
+"""
+
+
+# Standard library imports
+from argparse import ArgumentParser
+import ctypes
+import ctypes.util
+from json import dump as json_dump
+from os import O_NONBLOCK, close, listdir, read, replace, stat
+from os.path import isfile, join
+from select import select
+import sqlite3
+from time import sleep, time
+
+# Project level imports
+from hotreload import HotReloader
+import inference
+from results import RESULTS_FILE, ResultStore
+
+
+IMAGE_EXTENSIONS = ['.dcm', '.jpeg', '.jpg', '.png']
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+RESULT_SUFFIX = '.chainrad.json'
+
+
+class DirectoryWatcher:
+    """
+    Wait for changes in a directory
+    ===============================
+
+    Notes
+    -----
+        On Linux the watcher uses inotify through libc, elsewhere (or if
+        inotify is not available) it falls back to sleeping for the poll
+        interval. In both cases the caller rescans the directory after
+        wait(), the watcher only tells when it is worth doing.
+    """
+
+
+    def __init__(self, directory : str, poll_interval : float = 2.0):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        directory : str
+            Directory to watch.
+        poll_interval : float, optional (2.0 if omitted)
+            Maximum time to wait between scans.
+        """
+
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.__fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            file_descriptor = libc.inotify_init1(O_NONBLOCK)
+            if file_descriptor >= 0:
+                if libc.inotify_add_watch(file_descriptor,
+                                          directory.encode('utf8'),
+                                          IN_CLOSE_WRITE | IN_MOVED_TO) >= 0:
+                    self.__fd = file_descriptor
+                else:
+                    close(file_descriptor)
+        except (AttributeError, OSError, TypeError):
+            self.__fd = None
+
+
+    def close(self):
+        """
+        Release the inotify instance
+        ============================
+        """
+
+        if self.__fd is not None:
+            close(self.__fd)
+            self.__fd = None
+
+
+    def uses_inotify(self) -> bool:
+        """
+        Check whether inotify is used
+        =============================
+
+        Returns
+        -------
+        bool
+            True if inotify is used, False if the watcher polls.
+        """
+
+        return self.__fd is not None
+
+
+    def wait(self, timeout : float = None):
+        """
+        Wait for a change or the timeout
+        ================================
+
+        Parameters
+        ----------
+        timeout : float, optional (None if omitted)
+            Maximum time to wait. If omitted, the poll interval is used.
+        """
+
+        timeout = self.poll_interval if timeout is None else timeout
+        if self.__fd is None:
+            sleep(timeout)
+            return
+        ready, _, _ = select([self.__fd], [], [], timeout)
+        if ready:
+            try:
+                while read(self.__fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+
+class DurableQueue:
+    """
+    SQLite backed queue of images to score
+    ======================================
+
+    Notes
+    -----
+        An image is identified by its path, size and modification time, so
+        an image is queued once and a replaced image is queued again. Items
+        taken by claim() are marked 'processing', and items still in that
+        state at startup are given back to 'pending', so a crash never loses
+        an image.
+    """
+
+
+    def __init__(self, filename : str):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        filename : str
+            Name of the SQLite database file.
+        """
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS queue (' +
+                                'path TEXT NOT NULL, size INTEGER NOT NULL, ' +
+                                'mtime INTEGER NOT NULL, ' +
+                                'state TEXT NOT NULL DEFAULT \'pending\', ' +
+                                'added REAL NOT NULL, error TEXT, ' +
+                                'PRIMARY KEY (path, size, mtime))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS queue_state ' +
+                                'ON queue (state, added)')
+        with self.connection:
+            self.connection.execute('UPDATE queue SET state = \'pending\' ' +
+                                    'WHERE state = \'processing\'')
+
+
+    def add(self, path : str, size : int, mtime : int) -> bool:
+        """
+        Add an image to the queue
+        =========================
+
+        Parameters
+        ----------
+        path : str
+            Path of the image.
+        size : int
+            Size of the file in bytes.
+        mtime : int
+            Modification time of the file in nanoseconds.
+
+        Returns
+        -------
+        bool
+            True if the image is new, False if it was already queued.
+        """
+
+        with self.connection:
+            cursor = self.connection.execute('INSERT OR IGNORE INTO queue ' +
+                                             '(path, size, mtime, added) ' +
+                                             'VALUES (?, ?, ?, ?)',
+                                             (path, size, mtime, time()))
+        return cursor.rowcount > 0
+
+
+    def claim(self, count : int) -> list:
+        """
+        Take pending images for processing
+        ==================================
+
+        Parameters
+        ----------
+        count : int
+            Maximum number of images.
+
+        Returns
+        -------
+        list[tuple]
+            (path, size, mtime) of the claimed images, oldest first.
+        """
+
+        with self.connection:
+            rows = self.connection.execute('SELECT path, size, mtime ' +
+                                           'FROM queue WHERE state = ' +
+                                           '\'pending\' ORDER BY added ' +
+                                           'LIMIT ?', (count,)).fetchall()
+            self.connection.executemany('UPDATE queue SET state = ' +
+                                        '\'processing\' WHERE path = ? AND ' +
+                                        'size = ? AND mtime = ?', rows)
+        return rows
+
+
+    def close(self):
+        """
+        Close the database
+        ==================
+        """
+
+        self.connection.close()
+
+
+    def finish(self, items : list, error : str = None):
+        """
+        Mark images as done or failed
+        =============================
+
+        Parameters
+        ----------
+        items : list[tuple]
+            (path, size, mtime) of the images.
+        error : str, optional (None if omitted)
+            Error message, if given the images are marked 'failed'.
+        """
+
+        with self.connection:
+            self.connection.executemany('UPDATE queue SET state = ?, ' +
+                                        'error = ? WHERE path = ? AND ' +
+                                        'size = ? AND mtime = ?',
+                                        [('done' if error is None else
+                                          'failed', error) + tuple(item)
+                                         for item in items])
+
+
+    def pending_count(self) -> int:
+        """
+        Get the number of pending images
+        ================================
+
+        Returns
+        -------
+        int
+            Number of pending images.
+        """
+
+        return self.connection.execute('SELECT COUNT(*) FROM queue WHERE ' +
+                                       'state = \'pending\'').fetchone()[0]
+
+
+    def release(self, items : list):
+        """
+        Give claimed images back to the queue
+        =====================================
+
+        Parameters
+        ----------
+        items : list[tuple]
+            (path, size, mtime) of the images, they are marked 'pending'.
+        """
+
+        with self.connection:
+            self.connection.executemany('UPDATE queue SET state = ' +
+                                        '\'pending\' WHERE path = ? AND ' +
+                                        'size = ? AND mtime = ?', items)
+
+
+class IngestService:
+    """
+    Score images arriving in a directory
+    ====================================
+
+    Notes
+    -----
+        A file is queued only after its size and modification time stayed
+        the same for the debounce time, so partially written files are not
+        scored. Results are written next to each image as
+        <image>.chainrad.json through a temporary file and a rename, and
+        every batch is added to the result store in one transaction.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    #         The amount of attributes is needed because of the functionality.
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+
+    def __init__(self, directory : str, queue_file : str = None,
+                 batch_size : int = 8, debounce : float = 2.0,
+                 poll_interval : float = 2.0, store : ResultStore = None,
+                 band : float = None, pool : any = None):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        directory : str
+            Directory to watch.
+        queue_file : str, optional (None if omitted)
+            SQLite file of the durable queue. If omitted,
+            <directory>/.chainrad_queue.sqlite is used.
+        batch_size : int, optional (8 if omitted)
+            Maximum number of images scored together.
+        debounce : float, optional (2.0 if omitted)
+            Seconds a file must stay unchanged before it is queued.
+        poll_interval : float, optional (2.0 if omitted)
+            Maximum seconds between directory scans.
+        store : ResultStore, optional (None if omitted)
+            Result store to add the records to.
+        band : float, optional (None if omitted)
+            Uncertainty band of the cascade, see inference.score(). If
+            omitted, the full chain scores every image.
+        pool : WorkerPool, optional (None if omitted)
+            Worker processes to score with, see serving.WorkerPool. If
+            omitted, inference.score() scores in this process.
+        """
+
+        self.directory = directory
+        self.batch_size = batch_size
+        self.debounce = debounce
+        self.queue = DurableQueue(join(directory, '.chainrad_queue.sqlite')
+                                  if queue_file is None else queue_file)
+        self.watcher = DirectoryWatcher(directory, poll_interval)
+        self.store = store
+        self.band = band
+        self.pool = pool
+        self.running = False
+        self.__candidates = {}
+
+
+    def close(self):
+        """
+        Release the queue and the watcher
+        =================================
+        """
+
+        self.watcher.close()
+        self.queue.close()
+        if self.store is not None:
+            self.store.close()
+
+
+    def process(self) -> int:
+        """
+        Score one batch of queued images
+        ================================
+
+        Returns
+        -------
+        int
+            Number of processed images.
+
+        Raises
+        ------
+        RuntimeError
+            When the pool lost a worker and couldn't be restarted. The
+            claimed images are given back to the queue.
+
+        Notes
+        -----
+            Only errors of a single image mark it failed. If a worker of
+            the pool exits, the pool is restarted before the images are
+            scored one by one.
+        """
+
+        # pylint: disable=broad-except
+        #         A broken image must not stop the service, it's marked failed.
+
+        items = self.queue.claim(self.batch_size)
+        if len(items) == 0:
+            return 0
+        todo = [item for item in items if not has_result(*item)]
+        if len(todo) < len(items):
+            self.queue.finish([item for item in items if item not in todo])
+        if len(todo) == 0:
+            return len(items)
+        try:
+            records = self.__score([item[0] for item in todo])
+        except Exception:
+            self.__restart_if_lost(todo)
+            # Score one by one to find the broken image(s).
+            records = []
+            for position, item in enumerate(todo):
+                try:
+                    records.extend(self.__score([item[0]]))
+                except Exception as error:
+                    # An image killing its worker is still its own error.
+                    self.__restart_if_lost([done for done, record
+                                            in zip(todo, records)
+                                            if record is not None] +
+                                           todo[position:])
+                    records.append(None)
+                    self.queue.finish([item], error=str(error))
+        scored = [record for record in records if record is not None]
+        if self.store is not None and len(scored) > 0:
+            self.store.add(scored)
+        for item, record in zip(todo, records):
+            if record is not None:
+                write_result(item, record)
+                self.queue.finish([item])
+        return len(items)
+
+
+    def run(self):
+        """
+        Run the service until stop() is called
+        ======================================
+        """
+
+        self.running = True
+        while self.running:
+            self.scan()
+            while self.running and self.process() > 0:
+                self.scan()
+            self.watcher.wait(self.debounce if len(self.__candidates) > 0
+                              else None)
+
+
+    def scan(self) -> int:
+        """
+        Scan the directory and queue settled files
+        ==========================================
+
+        Returns
+        -------
+        int
+            Number of newly queued images.
+        """
+
+        now, result, seen = time(), 0, set()
+        for filename in listdir(self.directory):
+            path = join(self.directory, filename)
+            if not is_image(filename) or not isfile(path):
+                continue
+            seen.add(path)
+            info = stat(path)
+            key = (info.st_size, info.st_mtime_ns)
+            if path not in self.__candidates.keys() or \
+               self.__candidates[path][0] != key:
+                self.__candidates[path] = (key, now)
+                continue
+            if now - self.__candidates[path][1] >= self.debounce:
+                if self.queue.add(path, *key):
+                    result += 1
+                del self.__candidates[path]
+        for path in list(self.__candidates.keys()):
+            if path not in seen:
+                del self.__candidates[path]
+        return result
+
+
+    def stop(self):
+        """
+        Stop the service after the current batch
+        ========================================
+        """
+
+        self.running = False
+
+
+    def __restart_if_lost(self, items : list):
+        """
+        Restart the pool if it lost a worker
+        ====================================
+
+        Parameters
+        ----------
+        items : list[tuple]
+            (path, size, mtime) of the claimed images that are not finished
+            yet.
+
+        Raises
+        ------
+        RuntimeError
+            When the pool couldn't be restarted, the images are given back
+            to the queue then.
+        """
+
+        if self.pool is None or self.pool.is_alive():
+            return
+        try:
+            self.pool.close()
+            self.pool.start()
+        except RuntimeError:
+            self.queue.release(items)
+            raise
+
+
+    def __score(self, filelist : list) -> list:
+        """
+        Score images in this process or with the pool
+        ==============================================
+
+        Parameters
+        ----------
+        filelist : list
+            Images to score.
+
+        Returns
+        -------
+        list[dict]
+            Records in the form of inference.score().
+        """
+
+        if self.pool is None:
+            return inference.score(filelist, band=self.band)
+        return self.pool.score(filelist, band=self.band)
+
+
+def has_result(path : str, size : int, mtime : int) -> bool:
+    """
+    Check whether an image already has a result
+    ===========================================
+
+    Parameters
+    ----------
+    path : str
+        Path of the image.
+    size : int
+        Size of the image file.
+    mtime : int
+        Modification time of the image file in nanoseconds.
+
+    Returns
+    -------
+    bool
+        True if a result file exists and it is younger than the image, False
+        if not.
+
+    Notes
+    -----
+        This check prevents scoring an image twice when the service stopped
+        after writing the result but before marking the image done.
+    """
+
+    # pylint: disable=unused-argument
+    #         The signature matches the queue items.
+
+    result_file = path + RESULT_SUFFIX
+    return isfile(result_file) and stat(result_file).st_mtime_ns >= mtime
+
+
+def is_image(filename : str) -> bool:
+    """
+    Check whether a file name looks like an input image
+    ===================================================
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file.
+
+    Returns
+    -------
+    bool
+        True for supported extensions, False for anything else including
+        temporary and result files.
+    """
+
+    lower = filename.lower()
+    return not lower.startswith('.') and any(lower.endswith(extension)
+                                             for extension
+                                             in IMAGE_EXTENSIONS)
+
+
+def main():
+    """
+    Provides main functionality
+    ===========================
+    """
+
+    parser = ArgumentParser(description='Score images arriving in a ' +
+                                        'directory with ChainRad.')
+    parser.add_argument('directory', help='Directory to watch.')
+    parser.add_argument('--queue', default=None,
+                        help='SQLite file of the durable queue.')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--debounce', type=float, default=2.0)
+    parser.add_argument('--poll-interval', type=float, default=2.0)
+    parser.add_argument('--store', default=RESULTS_FILE,
+                        help='SQLite file of the result store.')
+    parser.add_argument('--no-store', action='store_true',
+                        help='Write result files only.')
+    parser.add_argument('--band', type=float, default=None,
+                        help='Uncertainty band of the early-exit cascade.')
+    parser.add_argument('--backend', choices=['chain', 'student'],
+                        default='chain', help='Models to score with.')
+    parser.add_argument('--hot-reload', action='store_true',
+                        help='Reload changed tresholds and heads while ' +
+                             'running.')
+    args = parser.parse_args()
+    print('Initializing ChainRad... ', end='', flush=True)
+    inference.SessionSetup.setup(backend=args.backend)
+    print('Done.')
+    service = IngestService(args.directory, args.queue, args.batch_size,
+                            args.debounce, args.poll_interval,
+                            None if args.no_store else
+                            ResultStore(args.store), args.band)
+    print('Watching "{}" ({}).'.format(args.directory,
+                                       'inotify' if service.watcher
+                                       .uses_inotify() else 'polling'))
+    reloader = None
+    if args.hot_reload:
+        reloader = HotReloader(inference.SessionSetup, args.poll_interval,
+                               callback=inference.print_reload)
+        reloader.start()
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if reloader is not None:
+            reloader.stop()
+        service.close()
+
+
+def write_result(item : tuple, record : dict):
+    """
+    Write the result of an image atomically
+    =======================================
+
+    Parameters
+    ----------
+    item : tuple
+        (path, size, mtime) of the image.
+    record : dict
+        Record of the image as inference.score() gives.
+    """
+
+    result_file = item[0] + RESULT_SUFFIX
+    with open(result_file + '.tmp', 'w', encoding='utf8') as outstream:
+        json_dump(dict(record, size=item[1], mtime=item[2]), outstream,
+                  indent=1)
+    replace(result_file + '.tmp', result_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""
+ChainRad
+========
+
+File: low-rank factorized heads
+"""
+
+
+# Standard library imports
+from argparse import ArgumentParser
+from json import dump as json_dump
+
+# 3rd party imports
+import torch
+
+# Project level imports
+from core import LowRankClassifier
+from core import get_classifier, get_head_file, get_low_rank_classifier
+from core import get_stacked_data, load_diseases
+from metrics import get_auc
+from prune import get_latency
+from train import LEARNING_RATE, fit_stacked
+
+
+def get_valid_auc(model : torch.nn.Module, valid_x : torch.Tensor,
+                  valid_y : torch.Tensor) -> float:
+    """
+    Get valid AUC of a head
+    =======================
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Head to evaluate.
+    valid_x : torch.Tensor
+        Stacked valid inputs.
+    valid_y : torch.Tensor
+        Stacked valid targets.
+
+    Returns
+    -------
+    float
+        The AUC.
+    """
+
+    # pylint: disable=no-member
+    #         torch has a member function sigmoid()
+
+    model = model.to('cpu').eval()
+    with torch.no_grad():
+        return get_auc(torch.sigmoid(model(valid_x).squeeze(1)), valid_y)
+
+
+def main():
+    """
+    Provides main functionality
+    ===========================
+    """
+
+    parser = ArgumentParser(description='Low-rank factorized fc1 of the ' +
+                                        'ChainRad heads.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, text in [('factorize', 'Factorize the trained heads by ' +
+                                        'SVD and fine-tune them.'),
+                          ('train', 'Train low-rank heads from scratch.')]:
+        subparser = subparsers.add_parser(command, help=text)
+        subparser.add_argument('--rank', type=int, default=64)
+        subparser.add_argument('--epochs', type=int,
+                               default=3 if command == 'factorize' else 200)
+        subparser.add_argument('--learning-rate', type=float,
+                               default=1e-5 if command == 'factorize'
+                               else LEARNING_RATE)
+    sweep_parser = subparsers.add_parser('sweep', help='Report AUC, latency ' +
+                                                       'and memory by rank.')
+    sweep_parser.add_argument('--ranks', type=int, nargs='+',
+                              default=[16, 32, 64, 128, 256])
+    sweep_parser.add_argument('--epochs', type=int, default=1,
+                              help='Epochs of fine-tuning per rank.')
+    sweep_parser.add_argument('--output', default=None,
+                              help='JSON file to write the report to.')
+    args = parser.parse_args()
+    keys = list(load_diseases().keys())
+    if args.command == 'sweep':
+        result = sweep(keys, args.ranks, args.epochs)
+        for rank, value in result.items():
+            print('rank {:>6} -- {:8.1f} MB -- latency {:.2f} ms -- '
+                  .format(rank, value['megabytes'], value['latency_ms']) +
+                  'mean auc {:.4f}'.format(value['mean_auc']))
+        if args.output is not None:
+            with open(args.output, 'w', encoding='utf8') as outstream:
+                json_dump(result, outstream, indent=2)
+        return
+    for key in keys:
+        auc = make_head(key, args.rank, args.epochs, args.learning_rate,
+                        from_scratch=args.command == 'train')
+        print('{:20} rank {} -- valid auc {:.4f}'.format(key, args.rank, auc),
+              flush=True)
+
+
+def make_head(key : str, rank : int, epochs : int, learning_rate : float,
+              from_scratch : bool = False) -> float:
+    """
+    Make and save the low-rank head of a disease
+    ============================================
+
+    Parameters
+    ----------
+    key : str
+        Disease key, the same as the meta file id of the training.
+    rank : int
+        Rank of the factorization.
+    epochs : int
+        Epochs of training.
+    learning_rate : float
+        Learning rate.
+    from_scratch : bool, optional (False if omitted)
+        Whether to train a randomly initialized head instead of factorizing
+        the trained one.
+
+    Returns
+    -------
+    float
+        Valid AUC of the saved head.
+
+    Notes
+    -----
+        The head is saved as MODEL_DIR/<key>_lowrank.statedict, load it with
+        SessionSetup.setup(variant='lowrank').
+    """
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    if from_scratch:
+        model = LowRankClassifier(rank)
+    else:
+        model = get_low_rank_classifier(get_classifier(torch.load(
+                            get_head_file(key), map_location='cpu')), rank)
+    train_x, train_y = get_stacked_data(key, 'train')
+    test_x, test_y = get_stacked_data(key, 'test')
+    state, _ = fit_stacked(model, train_x, train_y, test_x, test_y,
+                           epochs=epochs, learning_rate=learning_rate,
+                           progress=False)
+    del train_x, train_y, test_x, test_y
+    model.load_state_dict(state)
+    torch.save(state, get_head_file(key, 'lowrank'))
+    return get_valid_auc(model, *get_stacked_data(key, 'valid'))
+
+
+def sweep(keys : list, ranks : list, epochs : int = 1) -> dict:
+    """
+    Sweep ranks over every disease
+    ==============================
+
+    Parameters
+    ----------
+    keys : list
+        Disease keys, the same as the meta file ids of the training.
+    ranks : list
+        Ranks to evaluate.
+    epochs : int, optional (1 if omitted)
+        Epochs of fine-tuning after the factorization, 0 evaluates the plain
+        SVD truncation.
+
+    Returns
+    -------
+    dict
+        Results by rank, 'full' for the trained heads. Every rank has
+        'megabytes' (parameter memory of one head), 'latency_ms' (CPU time
+        of one head for a batch of 64), 'auc' (valid AUC by disease key) and
+        'mean_auc'.
+
+    Notes
+    -----
+        The SVD of every head is computed once and truncated for every rank.
+        Nothing is saved.
+    """
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    result = {rank : {'auc' : {}} for rank in ['full'] + list(ranks)}
+    for key in keys:
+        original = get_classifier(torch.load(get_head_file(key),
+                                             map_location='cpu'))
+        factors = torch.linalg.svd(original.fc1.weight.detach(),
+                                   full_matrices=False)
+        train_x, train_y = get_stacked_data(key, 'train')
+        test_x, test_y = get_stacked_data(key, 'test')
+        valid_x, valid_y = get_stacked_data(key, 'valid')
+        result['full']['auc'][key] = get_valid_auc(original, valid_x, valid_y)
+        for rank in ranks:
+            model = get_low_rank_classifier(original, rank, factors)
+            if epochs > 0:
+                state, _ = fit_stacked(model, train_x, train_y, test_x,
+                                       test_y, epochs=epochs,
+                                       learning_rate=1e-5, progress=False)
+                model.load_state_dict(state)
+            result[rank]['auc'][key] = get_valid_auc(model, valid_x, valid_y)
+        print('{:20} '.format(key) + ' -- '.join(
+                    'rank {} auc {:.4f}'.format(rank, value['auc'][key])
+                    for rank, value in result.items()), flush=True)
+    for rank, value in result.items():
+        model = (get_classifier(torch.load(get_head_file(keys[0]),
+                                           map_location='cpu'))
+                 if rank == 'full' else LowRankClassifier(rank))
+        value['megabytes'] = sum(param.numel() * param.element_size()
+                                 for param in model.parameters()) / 2 ** 20
+        value['latency_ms'] = get_latency(model)
+        value['mean_auc'] = sum(value['auc'].values()) / max(len(value['auc']),
+                                                             1)
+    return result
+
+
+if __name__ == '__main__':
+    main()
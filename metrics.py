@@ -0,0 +1,326 @@
+"""
+ChainRad
+========
+
+File: metrics accumulation
+"""
+
+
+# 3rd party imports
+import torch
+
+
+class MetricsAccumulator:
+    """
+    Accumulate binary classification metrics on the device
+    ======================================================
+
+    Notes
+    -----
+        Running loss, confusion counts and the probability and target buffers
+        are preallocated tensors on the device of the model. Nothing is copied
+        to the host until compute() is called, so a whole epoch needs only one
+        synchronization.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    #         The amount of attributes is needed because of the functionality.
+
+    # pylint: disable=no-member
+    #         torch has member functions zeros(), empty(), sigmoid(), cat()
+
+
+    def __init__(self, capacity : int, device : str = 'cpu',
+                 threshold : float = 0.5):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        capacity : int
+            Expected number of samples per epoch. Buffers grow automatically if
+            more samples arrive.
+        device : str, optional ('cpu' if omitted)
+            Device to keep the buffers on.
+        threshold : float, optional (0.5 if omitted)
+            Probability threshold of a positive prediction.
+        """
+
+        self.device = device
+        self.threshold = threshold
+        self.probabilities = torch.empty(max(capacity, 1), device=device)
+        self.targets = torch.empty(max(capacity, 1), device=device)
+        self.loss_sum = torch.zeros((), device=device)
+        self.confusion = torch.zeros(4, dtype=torch.long, device=device)
+        self.loss_count = 0
+        self.sample_count = 0
+
+
+    def compute(self) -> dict:
+        """
+        Compute metrics of the accumulated samples
+        ==========================================
+
+        Returns
+        -------
+        dict
+            Dictionary with the keys 'loss', 'accuracy', 'precision',
+            'recall', 'f1', 'auc', 'tp', 'fp', 'tn' and 'fn'.
+        """
+
+        probabilities, targets = self.values()
+        auc = get_auc(probabilities, targets)
+        true_pos, false_pos, true_neg, false_neg = self.confusion.tolist()
+        result = {'loss' : (self.loss_sum.item() / self.loss_count
+                            if self.loss_count > 0 else 0.0),
+                  'tp' : true_pos, 'fp' : false_pos,
+                  'tn' : true_neg, 'fn' : false_neg}
+        result.update(get_rates(true_pos, false_pos, true_neg, false_neg))
+        result['auc'] = auc
+        return result
+
+
+    def reset(self):
+        """
+        Reset the accumulator for a new epoch
+        =====================================
+
+        Notes
+        -----
+            The buffers are kept, only the counters are zeroed.
+        """
+
+        self.loss_sum.zero_()
+        self.confusion.zero_()
+        self.loss_count = 0
+        self.sample_count = 0
+
+
+    def update(self, logits : torch.Tensor, targets : torch.Tensor,
+               loss : torch.Tensor = None):
+        """
+        Add a batch to the accumulator
+        ==============================
+
+        Parameters
+        ----------
+        logits : torch.Tensor
+            Raw outputs of the model with shape (batch,).
+        targets : torch.Tensor
+            Targets (0 or 1) with shape (batch,).
+        loss : torch.Tensor, optional (None if omitted)
+            Mean loss of the batch. It is not synchronized with the host. The
+            reported loss is the mean over samples, so batches of different
+            sizes are weighted correctly.
+        """
+
+        logits = logits.detach().reshape(-1)
+        targets = targets.detach().reshape(-1).to(self.probabilities.dtype)
+        count = logits.shape[0]
+        start, end = self.sample_count, self.sample_count + count
+        if end > self.probabilities.shape[0]:
+            self.__grow(end)
+        probabilities = torch.sigmoid(logits)
+        self.probabilities[start:end] = probabilities
+        self.targets[start:end] = targets
+        predictions = probabilities >= self.threshold
+        positives = targets > 0.5
+        self.confusion += torch.stack([(predictions & positives).sum(),
+                                       (predictions & ~positives).sum(),
+                                       (~predictions & ~positives).sum(),
+                                       (~predictions & positives).sum()])
+        if loss is not None:
+            self.loss_sum += loss.detach() * count
+            self.loss_count += count
+        self.sample_count = end
+
+
+    def values(self) -> tuple:
+        """
+        Get accumulated probabilities and targets
+        =========================================
+
+        Returns
+        -------
+        tuple(torch.Tensor, torch.Tensor)
+            Probabilities and targets of the accumulated samples on the device.
+        """
+
+        return (self.probabilities[:self.sample_count],
+                self.targets[:self.sample_count])
+
+
+    def __grow(self, size : int):
+        """
+        Grow the buffers
+        ================
+
+        Parameters
+        ----------
+        size : int
+            Minimum size required.
+        """
+
+        new_size = max(size, self.probabilities.shape[0] * 2)
+        for name in ['probabilities', 'targets']:
+            old = getattr(self, name)
+            new = torch.empty(new_size, device=self.device, dtype=old.dtype)
+            new[:self.sample_count] = old[:self.sample_count]
+            setattr(self, name, new)
+
+
+def get_auc(probabilities : torch.Tensor, targets : torch.Tensor) -> float:
+    """
+    Get area under the ROC curve
+    ============================
+
+    Parameters
+    ----------
+    probabilities : torch.Tensor
+        Predicted probabilities.
+    targets : torch.Tensor
+        Targets (0 or 1).
+
+    Returns
+    -------
+    float
+        The area under the ROC curve, or 0.5 if only one class is present.
+
+    Notes
+    -----
+        The area is computed with the Mann-Whitney rank statistic from a single
+        sort, ties get their average rank.
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions sort(), unique_consecutive(), cumsum()
+
+    positives = targets > 0.5
+    pos_count = int(positives.sum().item())
+    neg_count = targets.shape[0] - pos_count
+    if pos_count == 0 or neg_count == 0:
+        return 0.5
+    sorted_values, order = torch.sort(probabilities)
+    _, inverse, counts = torch.unique_consecutive(sorted_values,
+                                                  return_inverse=True,
+                                                  return_counts=True)
+    ends = torch.cumsum(counts, 0).to(torch.float64)
+    average_ranks = ends - (counts.to(torch.float64) - 1.0) / 2.0
+    ranks = average_ranks[inverse]
+    rank_sum = ranks[positives[order]].sum().item()
+    return ((rank_sum - pos_count * (pos_count + 1) / 2.0) /
+            (pos_count * neg_count))
+
+
+def get_optimal_threshold(probabilities : torch.Tensor, targets : torch.Tensor,
+                          criterion : str = 'f1',
+                          target_sensitivity : float = 0.9) -> dict:
+    """
+    Get optimal decision threshold
+    ==============================
+
+    Parameters
+    ----------
+    probabilities : torch.Tensor
+        Predicted probabilities.
+    targets : torch.Tensor
+        Targets (0 or 1).
+    criterion : str, optional ('f1' if omitted)
+        What to optimize. 'f1' maximizes the F1 score, 'youden' maximizes
+        Youden's J statistic (sensitivity + specificity - 1), 'sensitivity'
+        gives the highest threshold that reaches target_sensitivity.
+    target_sensitivity : float, optional (0.9 if omitted)
+        Required sensitivity in case of criterion 'sensitivity'.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'threshold', 'score' (value of the
+        criterion), 'precision', 'sensitivity' and 'specificity'. A sample is
+        predicted positive if its probability is not less than the threshold.
+
+    Raises
+    ------
+    ValueError
+        When the criterion is unknown or the dataset is empty.
+
+    Notes
+    -----
+        Every distinct probability is a candidate threshold. Candidates are
+        evaluated at once from cumulative sums over a single descending sort,
+        so the cost is O(n log n) instead of rescanning the whole curve for
+        each candidate.
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions sort(), cumsum(), ones_like(), argmax()
+
+    if criterion not in ['f1', 'youden', 'sensitivity']:
+        raise ValueError('Unknown threshold criterion "{}".'.format(criterion))
+    if probabilities.numel() == 0:
+        raise ValueError('Cannot optimize threshold on an empty dataset.')
+    probabilities = probabilities.detach().reshape(-1).to(torch.float64)
+    targets = (targets.detach().reshape(-1) > 0.5).to(torch.float64)
+    sorted_values, order = torch.sort(probabilities, descending=True)
+    true_pos = torch.cumsum(targets[order], 0)
+    false_pos = torch.arange(1, true_pos.shape[0] + 1,
+                             dtype=torch.float64) - true_pos
+    last_of_ties = torch.ones_like(sorted_values, dtype=torch.bool)
+    last_of_ties[:-1] = sorted_values[:-1] != sorted_values[1:]
+    sorted_values = sorted_values[last_of_ties]
+    true_pos, false_pos = true_pos[last_of_ties], false_pos[last_of_ties]
+    pos_count = max(targets.sum().item(), 1e-12)
+    neg_count = max(targets.shape[0] - targets.sum().item(), 1e-12)
+    sensitivity = true_pos / pos_count
+    specificity = 1.0 - false_pos / neg_count
+    if criterion == 'f1':
+        scores = 2.0 * true_pos / (true_pos + false_pos + pos_count)
+    elif criterion == 'youden':
+        scores = sensitivity + specificity - 1.0
+    else:
+        scores = (sensitivity >= target_sensitivity).to(torch.float64)
+    index = int(torch.argmax(scores).item())
+    return {'threshold' : sorted_values[index].item(),
+            'score' : (sensitivity[index].item() if criterion == 'sensitivity'
+                       else scores[index].item()),
+            'precision' : (true_pos[index] /
+                           (true_pos[index] + false_pos[index])).item(),
+            'sensitivity' : sensitivity[index].item(),
+            'specificity' : specificity[index].item()}
+
+
+def get_rates(true_pos : int, false_pos : int, true_neg : int,
+              false_neg : int) -> dict:
+    """
+    Get rates from confusion counts
+    ===============================
+
+    Parameters
+    ----------
+    true_pos : int
+        Count of true positives.
+    false_pos : int
+        Count of false positives.
+    true_neg : int
+        Count of true negatives.
+    false_neg : int
+        Count of false negatives.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'accuracy', 'precision', 'recall' and 'f1'.
+        Undefined rates are 0.0.
+    """
+
+    total = true_pos + false_pos + true_neg + false_neg
+    precision = (true_pos / (true_pos + false_pos)
+                 if true_pos + false_pos > 0 else 0.0)
+    recall = (true_pos / (true_pos + false_neg)
+              if true_pos + false_neg > 0 else 0.0)
+    return {'accuracy' : (true_pos + true_neg) / total if total > 0 else 0.0,
+            'precision' : precision,
+            'recall' : recall,
+            'f1' : (2 * precision * recall / (precision + recall)
+                    if precision + recall > 0 else 0.0)}
@@ -0,0 +1,356 @@
+"""
+ChainRad
+========
+
+File: staged producer/consumer pipeline
+"""
+
+
+# Standard library imports
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Semaphore, Thread
+from time import perf_counter
+
+
+POLL_INTERVAL = 0.1
+
+
+class Pipeline:
+    """
+    Run items through stages with bounded queues between them
+    =========================================================
+
+    Notes
+    -----
+        Every stage has its own worker threads and reads from a bounded
+        queue, so a slow stage blocks the stages before it (backpressure)
+        instead of letting work pile up, and the throughput approaches the
+        rate of the slowest stage instead of the sum of the stages. Torch and
+        PIL release the GIL in their heavy parts, so threads overlap file
+        I/O, decoding and model inference. Outputs are yielded in the order
+        of the inputs, and at most in_flight() items are between the source
+        and the consumer at once.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    #         The amount of attributes is needed because of the functionality.
+
+
+    def __init__(self, workers : dict = None, queue_size : int = 2):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        workers : dict, optional (None if omitted)
+            Number of worker threads by stage name, 1 for missing stages.
+        queue_size : int, optional (2 if omitted)
+            Capacity of the queue in front of every stage.
+        """
+
+        self.workers = {} if workers is None else dict(workers)
+        self.queue_size = max(1, queue_size)
+        self.__elapsed = 0.0
+        self.__error = None
+        self.__lock = Lock()
+        self.__queues = []
+        self.__stages = []
+        self.__start = None
+        self.__stats = {}
+        self.__stop = Event()
+
+
+    def in_flight(self, names : list) -> int:
+        """
+        Get the maximum number of items in the pipeline
+        ===============================================
+
+        Parameters
+        ----------
+        names : list
+            Names of the stages.
+
+        Returns
+        -------
+        int
+            Items that can be queued or processed at once.
+        """
+
+        return sum(self.workers.get(name, 1) + self.queue_size
+                   for name in names) + self.queue_size
+
+
+    def metrics(self) -> dict:
+        """
+        Get per-stage metrics of the current or last run
+        ================================================
+
+        Returns
+        -------
+        dict
+            Dictionary with the keys 'elapsed' (seconds) and 'stages'. Every
+            stage has 'workers', 'items', 'busy' (seconds spent in the stage
+            function), 'starved' (seconds waited for input), 'blocked'
+            (seconds waited for room in the next queue, the backpressure),
+            'utilization' (busy share of the workers' time), 'queue' (current
+            depth of its input queue) and 'queue_max' (its high-water mark).
+        """
+
+        with self.__lock:
+            elapsed = (perf_counter() - self.__start if self.__start
+                       is not None else self.__elapsed)
+            result = {'elapsed' : elapsed, 'stages' : {}}
+            for i, (name, _) in enumerate(self.__stages):
+                stats = dict(self.__stats[name])
+                stats['utilization'] = (stats['busy'] / (elapsed *
+                                                         stats['workers'])
+                                        if elapsed > 0 else 0.0)
+                stats['queue'] = self.__queues[i].qsize()
+                result['stages'][name] = stats
+        return result
+
+
+    def run(self, stages : list, items : any) -> any:
+        """
+        Run items through the stages
+        ============================
+
+        Parameters
+        ----------
+        stages : list
+            List of (name, function) tuples, every function gets the output
+            of the previous stage.
+        items : iterable
+            Inputs of the first stage.
+
+        Yields
+        ------
+        any
+            Output of the last stage for every item, in the input order.
+
+        Raises
+        ------
+        RuntimeError
+            When the pipeline is already running.
+
+        Notes
+        -----
+            The first exception of a stage function stops the pipeline and
+            is raised to the consumer. Closing the generator stops the
+            workers too.
+        """
+
+        # pylint: disable=too-many-branches
+        #         Same branches are separated due to readability of the code.
+
+        with self.__lock:
+            if self.__start is not None:
+                raise RuntimeError('ChainRad couldn\'t start a running ' +
+                                   'pipeline.')
+            self.__start = perf_counter()
+            self.__error = None
+            self.__stages = list(stages)
+            self.__queues = [Queue(self.queue_size) for _
+                             in range(len(self.__stages) + 1)]
+            self.__stats = {name : {'workers' : self.workers.get(name, 1),
+                                    'items' : 0, 'busy' : 0.0,
+                                    'starved' : 0.0, 'blocked' : 0.0,
+                                    'queue_max' : 0}
+                            for name, _ in self.__stages}
+            self.__stop.clear()
+        slots = Semaphore(self.in_flight([name for name, _ in self.__stages]))
+        threads = [Thread(target=self.__feed, args=(items, slots),
+                          daemon=True)]
+        for i, (name, function) in enumerate(self.__stages):
+            remaining = [self.workers.get(name, 1)]
+            for _ in range(self.workers.get(name, 1)):
+                threads.append(Thread(target=self.__work,
+                                      args=(i, name, function, remaining),
+                                      daemon=True))
+        for thread in threads:
+            thread.start()
+        pending, position = {}, 0
+        try:
+            while True:
+                value = self.__get(self.__queues[-1])
+                if value is None:
+                    break
+                index, output = value
+                pending[index] = output
+                while position in pending.keys():
+                    output = pending.pop(position)
+                    position += 1
+                    slots.release()
+                    yield output
+            if self.__error is not None:
+                raise self.__error
+        finally:
+            self.__stop.set()
+            for thread in threads:
+                thread.join()
+            with self.__lock:
+                self.__elapsed = perf_counter() - self.__start
+                self.__start = None
+
+
+    def __feed(self, items : any, slots : Semaphore):
+        """
+        Put items into the first queue
+        ==============================
+
+        Parameters
+        ----------
+        items : iterable
+            Inputs of the first stage.
+        slots : Semaphore
+            Free places in the pipeline.
+        """
+
+        # pylint: disable=broad-except
+        #         Any error of the input stops the pipeline and is re-raised.
+
+        try:
+            for index, item in enumerate(items):
+                while not slots.acquire(timeout=POLL_INTERVAL):
+                    if self.__stop.is_set():
+                        return
+                if not self.__put(self.__queues[0], (index, item)):
+                    return
+        except Exception as exception:
+            self.__fail(exception)
+            return
+        for _ in range(self.workers.get(self.__stages[0][0], 1)
+                       if len(self.__stages) > 0 else 1):
+            if not self.__put(self.__queues[0], None):
+                return
+
+
+    def __fail(self, exception : Exception):
+        """
+        Stop the pipeline because of an error
+        =====================================
+
+        Parameters
+        ----------
+        exception : Exception
+            The error to raise to the consumer.
+        """
+
+        with self.__lock:
+            if self.__error is None:
+                self.__error = exception
+        self.__stop.set()
+
+
+    def __get(self, queue : Queue) -> any:
+        """
+        Get from a queue unless the pipeline stops
+        ==========================================
+
+        Parameters
+        ----------
+        queue : Queue
+            Queue to get from.
+
+        Returns
+        -------
+        any
+            The value or None if the pipeline stopped or the queue ended.
+        """
+
+        while not self.__stop.is_set():
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+        return None
+
+
+    def __put(self, queue : Queue, value : any) -> bool:
+        """
+        Put into a queue unless the pipeline stops
+        ==========================================
+
+        Parameters
+        ----------
+        queue : Queue
+            Queue to put into.
+        value : any
+            The value.
+
+        Returns
+        -------
+        bool
+            True if the value was put, False if the pipeline stopped.
+        """
+
+        while not self.__stop.is_set():
+            try:
+                queue.put(value, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                continue
+        return False
+
+
+    def __work(self, position : int, name : str, function : any,
+               remaining : list):
+        """
+        Run a worker of a stage
+        =======================
+
+        Parameters
+        ----------
+        position : int
+            Position of the stage.
+        name : str
+            Name of the stage.
+        function : callable
+            Function of the stage.
+        remaining : list
+            Single element list with the count of running workers of the
+            stage, the last one ends the next queue.
+        """
+
+        # pylint: disable=broad-except
+        #         Any error of a stage stops the pipeline and is re-raised.
+
+        # pylint: disable=too-many-locals
+        #         Same variables are separated due to readability of the code.
+
+        source, target = self.__queues[position], self.__queues[position + 1]
+        stats = self.__stats[name]
+        while True:
+            depth = source.qsize()
+            start = perf_counter()
+            value = self.__get(source)
+            waited = perf_counter() - start
+            if value is None:
+                break
+            index, item = value
+            start = perf_counter()
+            try:
+                output = function(item)
+            except Exception as exception:
+                self.__fail(exception)
+                break
+            busy = perf_counter() - start
+            start = perf_counter()
+            if not self.__put(target, (index, output)):
+                break
+            with self.__lock:
+                stats['items'] += 1
+                stats['busy'] += busy
+                stats['starved'] += waited
+                stats['blocked'] += perf_counter() - start
+                stats['queue_max'] = max(stats['queue_max'], depth)
+        with self.__lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(self.workers.get(self.__stages[position + 1][0],
+                                            1)
+                           if position + 1 < len(self.__stages) else 1):
+                if not self.__put(target, None):
+                    break
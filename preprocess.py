@@ -0,0 +1,350 @@
+"""
+ChainRad
+========
+
+File: batched tensor preprocessing
+"""
+
+
+# Standard library imports
+from math import radians
+
+# 3rd party imports
+import torch
+from torch.nn import functional
+from torchvision.transforms.functional import pil_to_tensor
+
+# Project level imports
+from decode import IMAGE_SIZE, decode_image, normalize
+from dicom import is_dicom, read_dicom
+
+
+class BatchPreprocessor:
+    """
+    Preprocess uint8 image batches with a few tensor operations
+    ===========================================================
+
+    Notes
+    -----
+        The tensor counterpart of core.get_simple_transformer() and
+        core.get_training_transformer(): inputs are uint8 batches with shape
+        (N, C, H, W) where C is 1 or 3, outputs are normalized float batches
+        with shape (N, 3, 224, 224). The random affine transformation and the
+        horizontal flip get independent parameters per sample and are applied
+        to the whole batch with one affine_grid() and one grid_sample() call.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    #         The amount of attributes is needed because of the functionality.
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+
+    def __init__(self, size : tuple = IMAGE_SIZE, augment : bool = False,
+                 rotation_degree : any = 13, translate : tuple = (0.1, 0.1),
+                 shear : any = 0.1, scale : tuple = (0.9, 1.1),
+                 h_flip_probability : float = 0.5,
+                 generator : torch.Generator = None):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        size : tuple, optional (IMAGE_SIZE if omitted)
+            Output size as (height, width).
+        augment : bool, optional (False if omitted)
+            Whether to apply random affine transformation and flip.
+        rotation_degree : float | tuple, optional (13 if omitted)
+            Rotation range like at core.get_training_transformer().
+        translate : tuple, optional ((0.1, 0.1) if omitted)
+            Maximum absolute fraction for horizontal and vertical random
+            translations.
+        shear : float | tuple, optional (0.1 if omitted)
+            Shear range in degrees like at core.get_training_transformer().
+        scale : tuple, optional ((0.9, 1.1) if omitted)
+            Interval of random scale.
+        h_flip_probability : float, optional (0.5 if omitted)
+            Probability of a random horizontal flip.
+        generator : torch.Generator, optional (None if omitted)
+            Random generator for reproducible augmentation.
+        """
+
+        self.size = size
+        self.augment = augment
+        self.rotation_degree = rotation_degree
+        self.translate = translate
+        self.shear = shear
+        self.scale = scale
+        self.h_flip_probability = h_flip_probability
+        self.generator = generator
+
+
+    def __call__(self, images : torch.Tensor) -> torch.Tensor:
+        """
+        Preprocess a batch
+        ==================
+
+        Parameters
+        ----------
+        images : torch.Tensor
+            Batch of uint8 images with shape (N, C, H, W).
+
+        Returns
+        -------
+        torch.Tensor
+            Normalized float batch with shape (N, 3, height, width).
+        """
+
+        images = resize(images, self.size)
+        if self.augment:
+            images = functional.grid_sample(images,
+                                            functional.affine_grid(
+                                                self.get_thetas(images),
+                                                list(images.shape),
+                                                align_corners=False),
+                                            mode='nearest',
+                                            padding_mode='zeros',
+                                            align_corners=False)
+        return normalize(images)
+
+
+    def get_thetas(self, images : torch.Tensor) -> torch.Tensor:
+        """
+        Get random affine matrices of a batch
+        =====================================
+
+        Parameters
+        ----------
+        images : torch.Tensor
+            Batch of images with shape (N, C, H, W).
+
+        Returns
+        -------
+        torch.Tensor
+            Matrices with shape (N, 2, 3) that map normalized output
+            coordinates to normalized input coordinates, as affine_grid()
+            expects.
+        """
+
+        # pylint: disable=no-member
+        #         torch has member functions stack(), where(), rand()
+
+        count, height, width = images.shape[0], images.shape[2], images.shape[3]
+        forward = self.__get_forward(count)
+        shift_x = self.__sample((-self.translate[0], self.translate[0]), count
+                                ) * width
+        shift_y = self.__sample((-self.translate[1], self.translate[1]), count
+                                ) * height
+        inverse = torch.linalg.inv(forward)
+        flip = torch.where(torch.rand(count, generator=self.generator)
+                           < self.h_flip_probability, -1.0, 1.0)
+        # Normalized coordinates to pixels around the center and back.
+        to_pixel = torch.tensor([width / 2.0, height / 2.0])
+        linear = inverse * to_pixel.view(1, 1, 2) / to_pixel.view(1, 2, 1)
+        linear[:, :, 0] = linear[:, :, 0] * flip.view(-1, 1)
+        shift = -(inverse @ torch.stack([shift_x, shift_y], -1
+                                        ).unsqueeze(-1)).squeeze(-1)
+        shift = shift / to_pixel.view(1, 2)
+        return torch.cat([linear, shift.unsqueeze(-1)], -1).to(images.device)
+
+
+    def __get_forward(self, count : int) -> torch.Tensor:
+        """
+        Get random forward matrices in pixel space
+        ==========================================
+
+        Parameters
+        ----------
+        count : int
+            Number of matrices.
+
+        Returns
+        -------
+        torch.Tensor
+            Matrices with shape (N, 2, 2) of rotation @ shear @ scale around
+            the center of the image.
+        """
+
+        # pylint: disable=no-member
+        #         torch has member functions cos(), sin(), tan(), stack(),
+        #         zeros()
+
+        angle = self.__sample(self.rotation_degree, count, symmetric=True)
+        angle = angle * radians(1)
+        shear = self.shear if isinstance(self.shear, (list, tuple)
+                                         ) else (-self.shear, self.shear)
+        shear_x = self.__sample(tuple(shear[:2]), count) * radians(1)
+        shear_y = (self.__sample(tuple(shear[2:4]), count) * radians(1)
+                   if len(shear) == 4 else torch.zeros(count,
+                                                       dtype=torch.float32))
+        scale = self.__sample(tuple(self.scale), count)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        tan_x, tan_y = torch.tan(shear_x), torch.tan(shear_y)
+        forward = torch.stack([torch.stack([cos - sin * tan_y,
+                                            cos * tan_x - sin], -1),
+                               torch.stack([sin + cos * tan_y,
+                                            sin * tan_x + cos], -1)], -2)
+        return forward * scale.view(-1, 1, 1)
+
+
+    def __sample(self, value : any, count : int,
+                 symmetric : bool = False) -> torch.Tensor:
+        """
+        Sample random values for a batch
+        ================================
+
+        Parameters
+        ----------
+        value : float | tuple
+            A number gives the range between - and + number if symmetric,
+            a two element tuple gives the range, more elements are choices.
+        count : int
+            Number of values.
+        symmetric : bool, optional (False if omitted)
+            Whether a single number means a symmetric range.
+
+        Returns
+        -------
+        torch.Tensor
+            Random values with shape (count,).
+        """
+
+        # pylint: disable=no-member
+        #         torch has member functions rand(), randint(), tensor()
+
+        # pylint: disable=not-callable
+        #         toch.tensor() is callable
+
+        if not isinstance(value, (list, tuple)):
+            value = (-value, value) if symmetric else (value, value)
+        if len(value) > 2:
+            choices = torch.tensor(value, dtype=torch.float32)
+            return choices[torch.randint(len(value), (count,),
+                                         generator=self.generator)]
+        low, high = float(value[0]), float(value[1])
+        return low + (high - low) * torch.rand(count,
+                                               generator=self.generator)
+
+
+def get_simple_preprocessor() -> BatchPreprocessor:
+    """
+    Get batched counterpart of the simple transformer
+    =================================================
+
+    Returns
+    -------
+    BatchPreprocessor
+        Preprocessor that resizes and normalizes.
+    """
+
+    return BatchPreprocessor()
+
+
+def get_training_preprocessor(rotation_degree : any = 13,
+                              translate : tuple = (0.1, 0.1),
+                              shear : float = 0.1, scale : tuple = (0.9, 1.1),
+                              h_flip_probability : float = 0.5
+                              ) -> BatchPreprocessor:
+    """
+    Get batched counterpart of the training transformer
+    ===================================================
+
+    Parameters
+    ----------
+    rotation_degree : float | tuple, optional (13 if omitted)
+        Degree to randomly rotate images.
+    translate : tuple, optional ((0.1, 0.1) if omitted)
+        Maximum absolute fraction for horizontal and vertical random
+        translations.
+    shear : float | tuple, optional (0.1 if omitted)
+        Random shear range.
+    scale : tuple, optional ((0.9, 1.1) if omitted)
+        Interval of random scale.
+    h_flip_probability : float = 0.5,
+        Probability of a random horizontal flip.
+
+    Returns
+    -------
+    BatchPreprocessor
+        Preprocessor that resizes, augments and normalizes.
+
+    See also
+    --------
+        Parameter details : core.get_training_transformer()
+    """
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    return BatchPreprocessor(augment=True, rotation_degree=rotation_degree,
+                             translate=translate, shear=shear, scale=scale,
+                             h_flip_probability=h_flip_probability)
+
+
+def load_batch(filelist : list, size : tuple = IMAGE_SIZE) -> torch.Tensor:
+    """
+    Load images as a uint8 batch
+    ============================
+
+    Parameters
+    ----------
+    filelist : list
+        Image files to load.
+    size : tuple, optional (IMAGE_SIZE if omitted)
+        Size of images as (height, width).
+
+    Returns
+    -------
+    torch.Tensor
+        Batch with shape (N, C, height, width). C is 1 if every image is
+        grayscale, otherwise grayscale images are expanded to 3 channels.
+
+    See also
+    --------
+        Decoding details : decode.decode_image()
+        DICOM details : dicom.DicomImage.to_tensor()
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions stack(), uint8
+
+    images = []
+    for filename in filelist:
+        if is_dicom(filename):
+            image = resize(read_dicom(filename).unsqueeze(0), size)[0]
+            images.append((image + 0.5).to(torch.uint8))
+        else:
+            images.append(pil_to_tensor(decode_image(filename, size)))
+    channels = max(image.shape[0] for image in images)
+    return torch.stack([image.expand(channels, -1, -1) for image in images])
+
+
+def resize(images : torch.Tensor, size : tuple) -> torch.Tensor:
+    """
+    Resize a batch
+    ==============
+
+    Parameters
+    ----------
+    images : torch.Tensor
+        Batch of uint8 images with shape (N, C, H, W).
+    size : tuple
+        Size of the result as (height, width).
+
+    Returns
+    -------
+    torch.Tensor
+        Float batch with values between 0 and 255. Images already at the size
+        are only converted.
+    """
+
+    images = images.float()
+    if tuple(images.shape[2:]) == tuple(size):
+        return images
+    return functional.interpolate(images, size=size, mode='bilinear',
+                                  align_corners=False,
+                                  antialias=True).clamp(0.0, 255.0)
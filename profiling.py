@@ -0,0 +1,371 @@
+"""
+ChainRad
+========
+
+File: hot path profiling
+"""
+
+
+# Standard library imports
+from contextlib import contextmanager, nullcontext
+from json import dump as json_dump
+from os import environ, getpid, makedirs
+from os.path import isdir, join
+from threading import Lock, get_ident, local
+from time import perf_counter, strftime
+
+try:
+    from resource import RUSAGE_SELF, getrusage
+except ImportError:
+    getrusage = None
+
+# 3rd party imports
+import torch
+
+# Project level imports
+from core import LOG_DIR
+
+
+PROFILE_ENV = 'CHAINRAD_PROFILE'
+PROFILE_DIR_ENV = 'CHAINRAD_PROFILE_DIR'
+
+
+class Profiler(local):
+    """
+    Collect per-stage timings of a batch
+    ====================================
+
+    Notes
+    -----
+        When disabled, stage() returns a shared no-op context manager, so the
+        instrumented code pays only one attribute check per stage.
+        The value of the CHAINRAD_PROFILE environment variable enables the
+        default profiler: '1' records stage timings, 'torch' additionally
+        captures torch.profiler traces. CHAINRAD_PROFILE_DIR overrides the
+        output directory.
+
+        The profiler is thread-local: every thread gets its own events,
+        totals and counts, initialized with the arguments of the
+        constructor. Threads scoring at once with the same profiler
+        therefore never reset or mix each other's measurements. Batch ids
+        are unique across threads. Only one thread at a time can capture a
+        torch.profiler trace, the batches of other threads record stage
+        timings only meanwhile.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    #         The amount of attributes is needed because of the functionality.
+
+
+    _NULL = nullcontext()
+    _BATCH_LOCK = Lock()
+    _LAST_BATCH_ID = [0]
+    _TORCH_LOCK = Lock()
+
+
+    def __init__(self, enabled : bool = False, torch_profiler : bool = False,
+                 output_dir : str = join(LOG_DIR, 'profile'),
+                 synchronize : bool = True):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        enabled : bool, optional (False if omitted)
+            Whether to record anything.
+        torch_profiler : bool, optional (False if omitted)
+            Whether to capture a torch.profiler trace of each batch as well.
+        output_dir : str, optional (LOG_DIR/profile if omitted)
+            Directory to dump summaries and traces into.
+        synchronize : bool, optional (True if omitted)
+            Whether to synchronize CUDA at stage boundaries, so GPU time is
+            attributed to the right stage.
+        """
+
+        self.enabled = enabled
+        self.torch_profiler = torch_profiler and enabled
+        self.output_dir = output_dir
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.events = []
+        self.totals = {}
+        self.counts = {}
+        self.batch_id = 0
+        self.__batch_start = 0.0
+        self.__torch_profile = None
+
+
+    @contextmanager
+    def batch(self, name : str = 'predict'):
+        """
+        Profile a batch and dump the results at its end
+        ===============================================
+
+        Parameters
+        ----------
+        name : str, optional ('predict' if omitted)
+            Name of the batch, used in file names.
+
+        Yields
+        ------
+        Profiler
+            The profiler itself.
+        """
+
+        if not self.enabled:
+            yield self
+            return
+        self.events, self.totals, self.counts = [], {}, {}
+        with Profiler._BATCH_LOCK:
+            Profiler._LAST_BATCH_ID[0] += 1
+            self.batch_id = Profiler._LAST_BATCH_ID[0]
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        if self.torch_profiler and Profiler._TORCH_LOCK.acquire(False):
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.__torch_profile = torch.profiler.profile(
+                                            activities=activities,
+                                            record_shapes=True,
+                                            profile_memory=True)
+            self.__torch_profile.__enter__()
+        self.__batch_start = perf_counter()
+        try:
+            yield self
+        finally:
+            self.__record('batch', self.__batch_start, perf_counter())
+            if self.__torch_profile is not None:
+                self.__torch_profile.__exit__(None, None, None)
+            try:
+                self.dump(name)
+            finally:
+                if self.__torch_profile is not None:
+                    self.__torch_profile = None
+                    Profiler._TORCH_LOCK.release()
+
+
+    def dump(self, name : str = 'predict') -> str:
+        """
+        Dump summary table and Chrome trace of the last batch
+        =====================================================
+
+        Parameters
+        ----------
+        name : str, optional ('predict' if omitted)
+            Name of the batch, used in file names.
+
+        Returns
+        -------
+        str
+            Path prefix of the written files.
+        """
+
+        if not isdir(self.output_dir):
+            makedirs(self.output_dir)
+        prefix = join(self.output_dir, '{}_{}_{}_{:04d}'.format(
+                                    name, strftime('%Y%m%d%H%M%S'), getpid(),
+                                    self.batch_id))
+        with open(prefix + '.txt', 'w', encoding='utf8') as outstream:
+            outstream.write(self.summary() + '\n')
+        with open(prefix + '.trace.json', 'w', encoding='utf8') as outstream:
+            json_dump({'traceEvents' : self.events,
+                       'displayTimeUnit' : 'ms'}, outstream)
+        if self.__torch_profile is not None:
+            self.__torch_profile.export_chrome_trace(prefix +
+                                                     '.torch.trace.json')
+        return prefix
+
+
+    def memory(self) -> dict:
+        """
+        Get memory high-water marks
+        ===========================
+
+        Returns
+        -------
+        dict
+            Dictionary with the keys 'max_rss_mb' (peak resident set size of
+            the process, None if not available) and 'cuda_max_allocated_mb'
+            (None without CUDA).
+        """
+
+        result = {'max_rss_mb' : None, 'cuda_max_allocated_mb' : None}
+        if getrusage is not None:
+            result['max_rss_mb'] = getrusage(RUSAGE_SELF).ru_maxrss / 1024.0
+        if torch.cuda.is_available():
+            result['cuda_max_allocated_mb'] = (torch.cuda.max_memory_allocated()
+                                               / 1048576.0)
+        return result
+
+
+    def stage(self, name : str) -> any:
+        """
+        Time a stage
+        ============
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage, like 'decode' or 'head:edema'.
+
+        Returns
+        -------
+        context manager
+            Context manager that times its block.
+        """
+
+        if not self.enabled:
+            return Profiler._NULL
+        return self.__stage(name)
+
+
+    def summary(self) -> str:
+        """
+        Get summary table of the last batch
+        ===================================
+
+        Returns
+        -------
+        str
+            Table of stages with call counts, total, mean and share of the
+            batch time, followed by memory high-water marks.
+        """
+
+        batch_total = self.totals.get('batch', 0.0)
+        lines = ['{:32} {:>7} {:>12} {:>12} {:>7}'.format('stage', 'calls',
+                                                        'total ms', 'mean ms',
+                                                        'share')]
+        for name, total in sorted(self.totals.items(), key=lambda item:
+                                  -item[1]):
+            lines.append('{:32} {:7d} {:12.3f} {:12.3f} {:6.1f}%'.format(
+                         name, self.counts[name], total * 1000,
+                         total * 1000 / self.counts[name],
+                         100 * total / batch_total if batch_total > 0 else 0))
+        for key, value in self.memory().items():
+            if value is not None:
+                lines.append('{:32} {:.1f}'.format(key, value))
+        return '\n'.join(lines)
+
+
+    def __record(self, name : str, start : float, end : float):
+        """
+        Record a finished stage
+        =======================
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        start : float
+            Start time from perf_counter().
+        end : float
+            End time from perf_counter().
+        """
+
+        self.totals[name] = self.totals.get(name, 0.0) + end - start
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.events.append({'name' : name, 'ph' : 'X', 'pid' : getpid(),
+                            'tid' : get_ident(),
+                            'ts' : (start - self.__batch_start) * 1e6,
+                            'dur' : (end - start) * 1e6})
+
+
+    @contextmanager
+    def __stage(self, name : str):
+        """
+        Time a stage when enabled
+        =========================
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        """
+
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = perf_counter()
+        try:
+            if self.__torch_profile is not None:
+                with torch.profiler.record_function(name):
+                    yield
+            else:
+                yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.__record(name, start, perf_counter())
+
+
+def get_process_memory(pid : int = None) -> dict:
+    """
+    Get resident and proportional memory of a process
+    =================================================
+
+    Parameters
+    ----------
+    pid : int, optional (None if omitted)
+        Process id. If omitted, the current process is measured.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'rss_mb' (resident set size), 'pss_mb'
+        (proportional set size, shared pages divided by the number of
+        processes mapping them), 'shared_mb' and 'private_mb'. Values that
+        the platform doesn't provide are None.
+
+    Notes
+    -----
+        RSS counts shared weights in every process, so the sum of the RSS of
+        workers overstates the memory use. The sum of PSS is the real total.
+        PSS comes from /proc/<pid>/smaps_rollup (Linux 4.14+).
+    """
+
+    result = {'rss_mb' : None, 'pss_mb' : None, 'shared_mb' : None,
+              'private_mb' : None}
+    prefix = '/proc/{}'.format('self' if pid is None else pid)
+    try:
+        with open(prefix + '/smaps_rollup', 'r', encoding='utf8') as instream:
+            values = {}
+            for line in instream:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    values[parts[0].rstrip(':')] = int(parts[1]) / 1024.0
+        result['rss_mb'] = values.get('Rss')
+        result['pss_mb'] = values.get('Pss')
+        result['shared_mb'] = (values.get('Shared_Clean', 0.0) +
+                               values.get('Shared_Dirty', 0.0))
+        result['private_mb'] = (values.get('Private_Clean', 0.0) +
+                                values.get('Private_Dirty', 0.0))
+        return result
+    except OSError:
+        pass
+    try:
+        with open(prefix + '/status', 'r', encoding='utf8') as instream:
+            for line in instream:
+                if line.startswith('VmRSS:'):
+                    result['rss_mb'] = int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return result
+
+
+def get_profiler() -> Profiler:
+    """
+    Get the profiler configured by the environment
+    ==============================================
+
+    Returns
+    -------
+    Profiler
+        Disabled profiler if CHAINRAD_PROFILE is unset, empty or '0',
+        otherwise an enabled one.
+    """
+
+    value = environ.get(PROFILE_ENV, '').strip().lower()
+    enabled = value not in ['', '0', 'false', 'no', 'off']
+    return Profiler(enabled=enabled, torch_profiler=value == 'torch',
+                    output_dir=environ.get(PROFILE_DIR_ENV,
+                                           join(LOG_DIR, 'profile')))
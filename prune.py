@@ -0,0 +1,252 @@
+"""
+ChainRad
+========
+
+File: structured pruning of the heads
+"""
+
+
+# Standard library imports
+from argparse import ArgumentParser
+from json import dump as json_dump
+from time import perf_counter
+
+# 3rd party imports
+import torch
+
+# Project level imports
+from core import HEADLESS_FEATURES, PrunedClassifier
+from core import get_classifier, get_head_file, get_stacked_data
+from core import load_diseases
+from metrics import get_auc
+from train import fit_stacked
+
+
+STATS_BATCH_SIZE = 4096
+
+
+def get_importance(model : torch.nn.Module, data_x : torch.Tensor,
+                   batch_size : int = STATS_BATCH_SIZE) -> tuple:
+    """
+    Score input columns and hidden units of fc1
+    ===========================================
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Trained SoloClassifier.
+    data_x : torch.Tensor
+        Training inputs with shape (samples, HEADLESS_FEATURES).
+    batch_size : int, optional (STATS_BATCH_SIZE if omitted)
+        Number of samples processed at once.
+
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor)
+        Importance of every input column and of every fc1 unit.
+
+    Notes
+    -----
+        A column scores the root mean square of its values times the norm of
+        its fc1 weights, so near-dead activations and ignored columns both
+        score low. A unit scores the root mean square of its activation times
+        the norm of its fc2 weights.
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions relu(), zeros()
+
+    model.eval()
+    input_square = torch.zeros(data_x.shape[1])
+    hidden_square = torch.zeros(model.fc1.out_features)
+    with torch.no_grad():
+        for pos in range(0, data_x.shape[0], batch_size):
+            batch_x = data_x[pos:pos + batch_size]
+            input_square += (batch_x ** 2).sum(0)
+            hidden_square += (torch.relu(model.fc1(batch_x)) ** 2).sum(0)
+    count = max(data_x.shape[0], 1)
+    input_importance = ((input_square / count).sqrt() *
+                        model.fc1.weight.detach().norm(dim=0))
+    hidden_importance = ((hidden_square / count).sqrt() *
+                         model.fc2.weight.detach().norm(dim=0))
+    return input_importance, hidden_importance
+
+
+def get_latency(model : torch.nn.Module, repeats : int = 20,
+                batch_size : int = 64) -> float:
+    """
+    Measure CPU latency of a head
+    =============================
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Head to measure.
+    repeats : int, optional (20 if omitted)
+        Number of timed forward passes.
+    batch_size : int, optional (64 if omitted)
+        Number of samples per forward pass.
+
+    Returns
+    -------
+    float
+        Median time of a forward pass in ms.
+    """
+
+    # pylint: disable=no-member
+    #         torch has a member function rand()
+
+    model = model.to('cpu').eval()
+    data_x = torch.rand(batch_size, HEADLESS_FEATURES)
+    times = []
+    with torch.no_grad():
+        model(data_x)
+        for _ in range(repeats):
+            start = perf_counter()
+            model(data_x)
+            times.append(perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1000
+
+
+def main():
+    """
+    Provides main functionality
+    ===========================
+    """
+
+    parser = ArgumentParser(description='Prune fc1 of the ChainRad heads.')
+    parser.add_argument('--keep-inputs', type=float, default=0.25,
+                        help='Fraction of headless output columns to keep.')
+    parser.add_argument('--keep-hidden', type=float, default=0.5,
+                        help='Fraction of fc1 units to keep.')
+    parser.add_argument('--epochs', type=int, default=5,
+                        help='Epochs of fine-tuning.')
+    parser.add_argument('--learning-rate', type=float, default=1e-5)
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write the report to.')
+    args = parser.parse_args()
+    keys = list(load_diseases().keys())
+    report = {}
+    for key in keys:
+        report[key] = prune_head(key, args.keep_inputs, args.keep_hidden,
+                                 args.epochs, args.learning_rate)
+        print('{:20} params {:.1%} -- latency {:.2f} -> {:.2f} ms -- '
+              .format(key, report[key]['parameters'] /
+                      report[key]['original_parameters'],
+                      report[key]['original_latency_ms'],
+                      report[key]['latency_ms']) +
+              'auc {:.4f} -> {:.4f}'.format(report[key]['original_auc'],
+                                            report[key]['auc']), flush=True)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf8') as outstream:
+            json_dump(report, outstream, indent=2)
+
+
+def prune(model : torch.nn.Module, input_index : torch.Tensor,
+          hidden_index : torch.Tensor) -> PrunedClassifier:
+    """
+    Build a pruned head from a trained one
+    ======================================
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Trained SoloClassifier.
+    input_index : torch.Tensor
+        Input columns to keep.
+    hidden_index : torch.Tensor
+        fc1 units to keep.
+
+    Returns
+    -------
+    PrunedClassifier
+        Head with the kept weights copied.
+    """
+
+    result = PrunedClassifier(input_index, hidden_index.numel())
+    with torch.no_grad():
+        result.fc1.weight.copy_(model.fc1.weight[hidden_index][:,
+                                                               input_index])
+        result.fc1.bias.copy_(model.fc1.bias[hidden_index])
+        result.fc2.weight.copy_(model.fc2.weight[:, hidden_index])
+        result.fc2.bias.copy_(model.fc2.bias)
+        for name in ['fc3', 'fc4']:
+            getattr(result, name).load_state_dict(getattr(model, name)
+                                                  .state_dict())
+    return result
+
+
+def prune_head(key : str, keep_inputs : float, keep_hidden : float,
+               epochs : int = 5, learning_rate : float = 1e-5) -> dict:
+    """
+    Prune, fine-tune and save the head of a disease
+    ===============================================
+
+    Parameters
+    ----------
+    key : str
+        Disease key, the same as the meta file id of the training.
+    keep_inputs : float
+        Fraction of input columns to keep.
+    keep_hidden : float
+        Fraction of fc1 units to keep.
+    epochs : int, optional (5 if omitted)
+        Epochs of fine-tuning.
+    learning_rate : float, optional (1e-5 if omitted)
+        Learning rate of fine-tuning.
+
+    Returns
+    -------
+    dict
+        Parameter counts, CPU latencies and valid AUCs of the original and
+        the pruned head.
+
+    Notes
+    -----
+        The pruned head is saved as MODEL_DIR/<key>_pruned.statedict, load it
+        with SessionSetup.setup(variant='pruned').
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions sigmoid(), sort(), topk()
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    original = get_classifier(torch.load(get_head_file(key),
+                                         map_location='cpu'))
+    train_x, train_y = get_stacked_data(key, 'train')
+    input_importance, hidden_importance = get_importance(original, train_x)
+    input_index = torch.sort(torch.topk(input_importance, max(1, int(
+                        input_importance.numel() * keep_inputs))).indices
+                             ).values
+    hidden_index = torch.sort(torch.topk(hidden_importance, max(1, int(
+                        hidden_importance.numel() * keep_hidden))).indices
+                              ).values
+    model = prune(original, input_index, hidden_index)
+    test_x, test_y = get_stacked_data(key, 'test')
+    state, _ = fit_stacked(model, train_x, train_y, test_x, test_y,
+                           epochs=epochs, learning_rate=learning_rate,
+                           progress=False)
+    del train_x, train_y, test_x, test_y
+    model.load_state_dict(state)
+    torch.save(state, get_head_file(key, 'pruned'))
+    valid_x, valid_y = get_stacked_data(key, 'valid')
+    result = {'inputs' : input_index.numel(), 'hidden' : hidden_index.numel()}
+    for prefix, head in [('original_', original), ('', model)]:
+        head = head.to('cpu').eval()
+        with torch.no_grad():
+            result[prefix + 'auc'] = get_auc(torch.sigmoid(
+                                    head(valid_x).squeeze(1)), valid_y)
+        result[prefix + 'parameters'] = sum(param.numel() for param
+                                            in head.parameters())
+        result[prefix + 'latency_ms'] = get_latency(head)
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,439 @@
+"""
+ChainRad
+========
+
+File: persistent result store
+"""
+
+
+# Standard library imports
+from hashlib import sha1, sha256
+from json import dumps as json_dumps
+from os import makedirs
+from os.path import dirname, isdir, join
+import sqlite3
+from time import time
+
+# Project level imports
+from core import LOG_DIR, load_diseases
+
+
+RESULTS_FILE = join(LOG_DIR, 'chainrad_results.sqlite')
+
+
+class ResultStore:
+    """
+    SQLite store of scored images
+    =============================
+
+    Notes
+    -----
+        Every image has one row with its content hash, the model and
+        threshold versions, whether the light heads of the cascade decided
+        it (early_exit), and a probability (p_<key>) and a decision
+        (d_<key>) column per disease. A content hash is stored once per model
+        and threshold version, scoring the same image again updates the row.
+        Records added together share a batch number. Batch membership is
+        kept in the separate batch_items table with the position and the
+        file name of every record in the batch, so scoring an image again
+        doesn't move it out of older batches, and files of the same content
+        are all listed under their own name. The GUI pages through a batch
+        by position. The batch and image columns of the results table hold
+        the last batch and file name the row was scored with. Every p_<key>
+        column has an index with the scoring time, so queries like
+        "pneumothorax above 0.8 since this morning" don't scan the table.
+    """
+
+
+    def __init__(self, filename : str = RESULTS_FILE, keys : list = None):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        filename : str, optional (RESULTS_FILE if omitted)
+            Name of the SQLite database file.
+        keys : list, optional (None if omitted)
+            Disease keys. If omitted, the keys of chainrad_diseases.json are
+            used.
+
+        Raises
+        ------
+        ValueError
+            When a key is not a valid column name.
+        """
+
+        if keys is None:
+            keys = list(load_diseases().keys())
+        for key in keys:
+            if not key.isidentifier():
+                raise ValueError('ChainRad couldn\'t use "{}" as a result '
+                                 .format(key) + 'column.')
+        self.keys = list(keys)
+        if dirname(filename) != '' and not isdir(dirname(filename)):
+            makedirs(dirname(filename), exist_ok=True)
+        self.connection = sqlite3.connect(filename)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        columns = ''.join(', p_{0} REAL, d_{0} INTEGER'.format(key)
+                          for key in self.keys)
+        with self.connection:
+            has_items = self.connection.execute(
+                                    'SELECT COUNT(*) FROM sqlite_master ' +
+                                    'WHERE type = \'table\' AND ' +
+                                    'name = \'batch_items\'').fetchone()[0] > 0
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results (' +
+                                    'id INTEGER PRIMARY KEY, ' +
+                                    'batch INTEGER NOT NULL, ' +
+                                    'image TEXT NOT NULL, ' +
+                                    'content_hash TEXT NOT NULL, ' +
+                                    'model_version TEXT NOT NULL, ' +
+                                    'threshold_version TEXT NOT NULL, ' +
+                                    'scored REAL NOT NULL, ' +
+                                    'early_exit INTEGER NOT NULL DEFAULT 0' +
+                                    columns + ')')
+            existing = [row[1] for row in self.connection.execute(
+                                            'PRAGMA table_info(results)')]
+            if 'early_exit' not in existing:
+                self.connection.execute('ALTER TABLE results ADD COLUMN ' +
+                                        'early_exit INTEGER NOT NULL ' +
+                                        'DEFAULT 0')
+            for key in self.keys:
+                if 'p_{}'.format(key) not in existing:
+                    self.connection.execute('ALTER TABLE results ADD ' +
+                                            'COLUMN p_{} REAL'.format(key))
+                    self.connection.execute('ALTER TABLE results ADD ' +
+                                            'COLUMN d_{} INTEGER'.format(key))
+            self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS ' +
+                                    'results_content ON results ' +
+                                    '(content_hash, model_version, ' +
+                                    'threshold_version)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS ' +
+                                    'results_batch ON results (batch, id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS ' +
+                                    'results_scored ON results (scored)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS ' +
+                                    'batch_items (' +
+                                    'batch INTEGER NOT NULL, ' +
+                                    'position INTEGER NOT NULL, ' +
+                                    'result_id INTEGER NOT NULL, ' +
+                                    'image TEXT NOT NULL, ' +
+                                    'PRIMARY KEY (batch, position))')
+            if not has_items:
+                # Stores written before batch_items keep their batches.
+                self.connection.execute('INSERT INTO batch_items (batch, ' +
+                                        'position, result_id, image) ' +
+                                        'SELECT batch, id, id, image FROM ' +
+                                        'results')
+            for key in self.keys:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS ' +
+                                        'results_p_{0} ON results '
+                                        .format(key) +
+                                        '(p_{0}, scored)'.format(key))
+
+
+    def add(self, records : list, batch : int = None) -> int:
+        """
+        Add records in one transaction
+        ==============================
+
+        Parameters
+        ----------
+        records : list[dict]
+            Records with the keys 'image', 'content_hash', 'model_version',
+            'threshold_version', 'probabilities' and 'decisions', and
+            optionally 'scored' and 'early_exit'. Probabilities and decisions
+            are dicts by disease key.
+        batch : int, optional (None if omitted)
+            Batch number of the records. If omitted, a new batch is started.
+            If given, the records are appended to the batch.
+
+        Returns
+        -------
+        int
+            The batch number.
+
+        Notes
+        -----
+            A record of an already stored content and versions updates the
+            stored row, but the row stays in the batches it was added to
+            before. Records keep their order in the batch, duplicates
+            included.
+        """
+
+        names = ['batch', 'image', 'content_hash', 'model_version',
+                 'threshold_version', 'scored', 'early_exit']
+        for key in self.keys:
+            names += ['p_{}'.format(key), 'd_{}'.format(key)]
+        statement = ('INSERT INTO results ({}) VALUES ({}) '.format(
+                                    ', '.join(names),
+                                    ', '.join('?' for _ in names)) +
+                     'ON CONFLICT (content_hash, model_version, ' +
+                     'threshold_version) DO UPDATE SET ' +
+                     ', '.join('{0} = excluded.{0}'.format(name)
+                               for name in names if name not in
+                               ['content_hash', 'model_version',
+                                'threshold_version']) +
+                     ' RETURNING id')
+        with self.connection:
+            if batch is None:
+                batch = self.connection.execute('SELECT COALESCE(MAX(batch)' +
+                                                ', 0) + 1 FROM batch_items'
+                                                ).fetchone()[0]
+            position = self.connection.execute('SELECT COALESCE(MAX(' +
+                                               'position), 0) FROM ' +
+                                               'batch_items WHERE batch = ?',
+                                               (batch,)).fetchone()[0]
+            items = []
+            for record in records:
+                row = [batch, record['image'], record['content_hash'],
+                       record['model_version'], record['threshold_version'],
+                       record.get('scored', time()),
+                       int(record.get('early_exit', False))]
+                for key in self.keys:
+                    row += [record['probabilities'].get(key),
+                            record['decisions'].get(key)]
+                position += 1
+                items.append((batch, position, self.connection.execute(
+                                            statement, row).fetchone()[0],
+                               record['image']))
+            self.connection.executemany('INSERT INTO batch_items (batch, ' +
+                                        'position, result_id, image) ' +
+                                        'VALUES (?, ?, ?, ?)', items)
+        return batch
+
+
+    def close(self):
+        """
+        Close the database
+        ==================
+        """
+
+        self.connection.close()
+
+
+    def count(self, batch : int = None) -> int:
+        """
+        Count records
+        =============
+
+        Parameters
+        ----------
+        batch : int, optional (None if omitted)
+            Batch to count. If omitted, every record is counted.
+
+        Returns
+        -------
+        int
+            Number of records.
+        """
+
+        if batch is None:
+            return self.connection.execute('SELECT COUNT(*) FROM results'
+                                           ).fetchone()[0]
+        return self.connection.execute('SELECT COUNT(*) FROM batch_items ' +
+                                       'WHERE batch = ?', (batch,)
+                                       ).fetchone()[0]
+
+
+    def find(self, content_hash : str, model_version : str,
+             threshold_version : str) -> dict:
+        """
+        Find the record of an image content
+        ===================================
+
+        Parameters
+        ----------
+        content_hash : str
+            Hash of the image file.
+        model_version : str
+            Version of the models.
+        threshold_version : str
+            Version of the thresholds.
+
+        Returns
+        -------
+        dict | None
+            The record or None if the content wasn't scored with these
+            versions.
+        """
+
+        row = self.connection.execute('SELECT * FROM results WHERE ' +
+                                      'content_hash = ? AND ' +
+                                      'model_version = ? AND ' +
+                                      'threshold_version = ?',
+                                      (content_hash, model_version,
+                                       threshold_version)).fetchone()
+        return None if row is None else self.__to_record(row)
+
+
+    def page(self, offset : int, limit : int, batch : int = None,
+             since : float = None) -> list:
+        """
+        Get a page of records
+        =====================
+
+        Parameters
+        ----------
+        offset : int
+            Number of records to skip.
+        limit : int
+            Maximum number of records.
+        batch : int, optional (None if omitted)
+            Batch to page through. If omitted, every batch is paged.
+        since : float, optional (None if omitted)
+            Earliest scoring time as a timestamp.
+
+        Returns
+        -------
+        list[dict]
+            Records in insertion order. The records of a batch are in the
+            order they were added to it, their 'batch' and 'image' keys are
+            the requested batch and the file name added to it.
+        """
+
+        if batch is None:
+            statement, values = 'SELECT * FROM results WHERE 1', []
+            order = 'id'
+        else:
+            statement = ('SELECT results.*, batch_items.batch AS item_batch' +
+                         ', batch_items.image AS item_image FROM ' +
+                         'batch_items JOIN results ON results.id = ' +
+                         'batch_items.result_id WHERE batch_items.batch = ?')
+            values, order = [batch], 'batch_items.position'
+        if since is not None:
+            statement += ' AND scored >= ?'
+            values.append(since)
+        rows = self.connection.execute(statement + ' ORDER BY {} LIMIT ? '
+                                       .format(order) + 'OFFSET ?',
+                                       values + [limit, offset])
+        return [self.__to_record(row) for row in rows]
+
+
+    def query(self, key : str, minimum : float, since : float = None,
+              until : float = None, limit : int = None) -> list:
+        """
+        Get records above a probability
+        ===============================
+
+        Parameters
+        ----------
+        key : str
+            Disease key.
+        minimum : float
+            Records with higher probability are returned.
+        since : float, optional (None if omitted)
+            Earliest scoring time as a timestamp.
+        until : float, optional (None if omitted)
+            Latest scoring time as a timestamp.
+        limit : int, optional (None if omitted)
+            Maximum number of records.
+
+        Returns
+        -------
+        list[dict]
+            Records in descending order of the probability.
+
+        Raises
+        ------
+        ValueError
+            When the key is unknown.
+        """
+
+        if key not in self.keys:
+            raise ValueError('ChainRad doesn\'t know the disease "{}".'
+                             .format(key))
+        statement = 'SELECT * FROM results WHERE p_{} > ?'.format(key)
+        values = [minimum]
+        if since is not None:
+            statement += ' AND scored >= ?'
+            values.append(since)
+        if until is not None:
+            statement += ' AND scored <= ?'
+            values.append(until)
+        statement += ' ORDER BY p_{} DESC'.format(key)
+        if limit is not None:
+            statement += ' LIMIT ?'
+            values.append(limit)
+        return [self.__to_record(row) for row
+                in self.connection.execute(statement, values)]
+
+
+    def __to_record(self, row : sqlite3.Row) -> dict:
+        """
+        Convert a row to a record
+        =========================
+
+        Parameters
+        ----------
+        row : sqlite3.Row
+            Row of the results table.
+
+        Returns
+        -------
+        dict
+            Record in the form ResultStore.add() expects, with the keys 'id'
+            and 'batch' added. The batch and the image are the ones of the
+            batch_items row if the row was selected through it, otherwise the
+            last ones the record was scored with.
+        """
+
+        record = {name : row[name] for name in ['id', 'batch', 'image',
+                                                'content_hash',
+                                                'model_version',
+                                                'threshold_version',
+                                                'scored']}
+        record['early_exit'] = bool(row['early_exit'])
+        if 'item_batch' in row.keys():
+            record['batch'] = row['item_batch']
+            record['image'] = row['item_image']
+        record['probabilities'] = {key : row['p_{}'.format(key)]
+                                   for key in self.keys}
+        record['decisions'] = {key : row['d_{}'.format(key)]
+                               for key in self.keys}
+        return record
+
+
+def get_content_hash(filename : str) -> str:
+    """
+    Get the content hash of a file
+    ==============================
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file.
+
+    Returns
+    -------
+    str
+        SHA-256 hash of the file content.
+    """
+
+    result = sha256()
+    with open(filename, 'rb') as instream:
+        for chunk in iter(lambda: instream.read(1 << 20), b''):
+            result.update(chunk)
+    return result.hexdigest()
+
+
+def get_version(data : any) -> str:
+    """
+    Get a short version string of JSON serializable data
+    ====================================================
+
+    Parameters
+    ----------
+    data : any
+        Data to identify, like thresholds or file names with sizes and
+        modification times.
+
+    Returns
+    -------
+    str
+        First 12 characters of the SHA-1 hash of the data.
+    """
+
+    return sha1(json_dumps(data, sort_keys=True).encode('utf8')
+                ).hexdigest()[:12]
@@ -0,0 +1,641 @@
+"""
+ChainRad
+========
+
+File: multi-instance serving with pinned workers
+"""
+
+
+# Standard library imports
+from argparse import ArgumentParser
+from json import dump as json_dump
+from multiprocessing import get_context
+from os import environ, remove
+from os.path import getsize, isfile, join
+from queue import Empty
+from time import perf_counter
+
+# Project level imports
+from affinity import THREAD_ENV_VARIABLES, get_available_cpus
+from affinity import get_available_memory, get_numa_nodes, get_placement
+from benchmark import BENCH_IMG_DIR, make_synthetic_images, percentile
+import inference
+from ingest import IngestService
+from profiling import get_process_memory
+from results import RESULTS_FILE, ResultStore
+from session import InferenceSession
+
+
+POLL_INTERVAL = 1.0
+
+
+class WorkerPool:
+    """
+    Pinned ChainRad worker processes behind a single local queue
+    ============================================================
+
+    Notes
+    -----
+        Every worker is a separate process with its own session, pinned to
+        its CPUs with the given thread counts, so instances don't fight for
+        cores. Workers take tasks from one shared queue when they are idle,
+        so a slow batch doesn't hold back the others. Waiting for results
+        checks the workers every POLL_INTERVAL seconds, so a worker dying in
+        its setup or in a task raises RuntimeError instead of a hang.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    #         The amount of attributes is needed because of the functionality.
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+
+    def __init__(self, instances : int, threads : int,
+                 inter_op_threads : int = 1, setup_kwargs : dict = None,
+                 placement : list = None):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        instances : int
+            Number of worker processes.
+        threads : int
+            Intra-op threads per worker.
+        inter_op_threads : int, optional (1 if omitted)
+            Inter-op threads per worker.
+        setup_kwargs : dict, optional (None if omitted)
+            Arguments of inference.SessionSetup.setup() in the workers.
+        placement : list, optional (None if omitted)
+            CPUs of every worker. If omitted, affinity.get_placement() gives
+            it.
+        """
+
+        self.instances = instances
+        self.threads = threads
+        self.inter_op_threads = inter_op_threads
+        self.setup_kwargs = {} if setup_kwargs is None else setup_kwargs
+        self.placement = (get_placement(instances, threads)
+                          if placement is None else placement)
+        self.processes = []
+        self.__next_id = 0
+        self.__results = None
+        self.__tasks = None
+
+
+    def close(self, timeout : float = 30.0):
+        """
+        Stop the workers
+        ================
+
+        Parameters
+        ----------
+        timeout : float, optional (30.0 if omitted)
+            Seconds to wait for a worker to finish its task before it is
+            terminated.
+        """
+
+        if self.__tasks is not None:
+            for _ in self.processes:
+                self.__tasks.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        self.__tasks, self.__results = None, None
+
+
+    def get(self, timeout : float = None) -> tuple:
+        """
+        Get a finished task
+        ===================
+
+        Parameters
+        ----------
+        timeout : float, optional (None if omitted)
+            Seconds to wait, wait forever if omitted.
+
+        Returns
+        -------
+        tuple
+            (task id, records, error). Records are None and error is the
+            message if the task failed.
+
+        Raises
+        ------
+        queue.Empty
+            When no task finished in time.
+        RuntimeError
+            When a worker process exited.
+        """
+
+        deadline = None if timeout is None else perf_counter() + timeout
+        while True:
+            wait = (POLL_INTERVAL if deadline is None else
+                    max(0.0, min(POLL_INTERVAL, deadline - perf_counter())))
+            try:
+                return self.__results.get(timeout=wait)
+            except Empty:
+                self.__raise_if_exited()
+                if deadline is not None and perf_counter() >= deadline:
+                    raise
+
+
+    def memory(self) -> list:
+        """
+        Get memory accounting of the workers
+        ====================================
+
+        Returns
+        -------
+        list[dict]
+            Memory of every worker with the keys 'worker', 'pid' and the
+            ones of profiling.get_process_memory().
+
+        Notes
+        -----
+            With setup_kwargs={'weights_file' : ...} the weights are shared,
+            compare the sum of 'pss_mb' to the sum of 'rss_mb'.
+        """
+
+        return [dict(get_process_memory(process.pid), worker=i,
+                     pid=process.pid)
+                for i, process in enumerate(self.processes)]
+
+
+    def is_alive(self) -> bool:
+        """
+        Check whether every worker is running
+        =====================================
+
+        Returns
+        -------
+        bool
+            True if the pool is started and no worker exited, False if not.
+        """
+
+        return len(self.processes) > 0 and all(process.exitcode is None
+                                               for process in self.processes)
+
+
+    def score(self, filelist : list, band : float = None) -> list:
+        """
+        Score images with every worker
+        ==============================
+
+        Parameters
+        ----------
+        filelist : list
+            Images to score.
+        band : float, optional (None if omitted)
+            Uncertainty band of the cascade, see inference.score().
+
+        Returns
+        -------
+        list[dict]
+            Records in the form of inference.score(), in the order of
+            filelist.
+
+        Raises
+        ------
+        RuntimeError
+            When a worker couldn't score its part.
+
+        Notes
+        -----
+            The images are split into one task per worker, so a single
+            caller keeps every worker busy. Results of other tasks, like the
+            late ones of an earlier call that lost a worker, are dropped.
+        """
+
+        if len(filelist) == 0:
+            return []
+        size = -(-len(filelist) // self.instances)
+        task_ids = [self.submit(filelist[pos:pos + size], band)
+                    for pos in range(0, len(filelist), size)]
+        done, errors = {}, []
+        while len(done) + len(errors) < len(task_ids):
+            task_id, records, error = self.get()
+            if task_id not in task_ids:
+                continue
+            if error is None:
+                done[task_id] = records
+            else:
+                errors.append(error)
+        if len(errors) > 0:
+            raise RuntimeError('ChainRad couldn\'t score in a worker: {}'
+                               .format(errors[0]))
+        return [record for task_id in task_ids for record in done[task_id]]
+
+
+    def start(self):
+        """
+        Start the workers and wait until their sessions are set up
+        ==========================================================
+
+        Raises
+        ------
+        RuntimeError
+            When a worker couldn't set up its session.
+        """
+
+        context = get_context('spawn')
+        self.__tasks, self.__results = context.Queue(), context.Queue()
+        saved = {name : environ.get(name) for name in THREAD_ENV_VARIABLES}
+        try:
+            for name in THREAD_ENV_VARIABLES:
+                # Spawned interpreters read them before torch starts.
+                environ[name] = str(self.threads)
+            for i, cpus in enumerate(self.placement):
+                process = context.Process(target=run_worker,
+                                          args=(i, cpus, self.threads,
+                                                self.inter_op_threads,
+                                                self.setup_kwargs,
+                                                self.__tasks, self.__results),
+                                          daemon=True)
+                process.start()
+                self.processes.append(process)
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    environ.pop(name, None)
+                else:
+                    environ[name] = value
+        errors = []
+        try:
+            for _ in self.processes:
+                _, _, error = self.get()
+                if error is not None:
+                    errors.append(error)
+        except RuntimeError as error:
+            errors.append(str(error))
+        if len(errors) > 0:
+            self.close()
+            raise RuntimeError('ChainRad couldn\'t start a worker: {}'
+                               .format(errors[0]))
+
+
+    def submit(self, filelist : list, band : float = None) -> int:
+        """
+        Put a task into the queue
+        =========================
+
+        Parameters
+        ----------
+        filelist : list
+            Images to score.
+        band : float, optional (None if omitted)
+            Uncertainty band of the cascade, see inference.score().
+
+        Returns
+        -------
+        int
+            Id of the task, get() returns it with the result.
+        """
+
+        self.__next_id += 1
+        self.__tasks.put((self.__next_id, filelist, band))
+        return self.__next_id
+
+
+    def __raise_if_exited(self):
+        """
+        Raise an error if a worker process exited
+        =========================================
+
+        Raises
+        ------
+        RuntimeError
+            When a worker process exited, like after a crash in an import or
+            in the setup of its session. Workers exit only when the pool is
+            closed otherwise.
+        """
+
+        for i, process in enumerate(self.processes):
+            if process.exitcode is not None:
+                raise RuntimeError('ChainRad lost worker {} (exit code {}).'
+                                   .format(i, process.exitcode))
+
+
+def benchmark(filelist : list, splits : list, batch_size : int = 4,
+              repeats : int = 3, setup_kwargs : dict = None) -> list:
+    """
+    Measure instances x threads splits
+    ==================================
+
+    Parameters
+    ----------
+    filelist : list
+        Images to score.
+    splits : list
+        (instances, threads) tuples to measure.
+    batch_size : int, optional (4 if omitted)
+        Images per task.
+    repeats : int, optional (3 if omitted)
+        Number of passes over filelist per split.
+    setup_kwargs : dict, optional (None if omitted)
+        Arguments of inference.SessionSetup.setup() in the workers.
+
+    Returns
+    -------
+    list[dict]
+        Results with the keys 'instances', 'threads', 'setup_sec',
+        'images_per_sec', 'p50_ms' and 'p95_ms' (task latency from submit to
+        result), and 'rss_mb' and 'pss_mb' (sums over the workers after the
+        run), best throughput first.
+
+    Notes
+    -----
+        Every worker gets one unmeasured task first. At most two tasks per
+        worker are queued at once, like a loaded service.
+    """
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    batches = [filelist[pos:pos + batch_size]
+               for pos in range(0, len(filelist), batch_size)] * repeats
+    result = []
+    for instances, threads in splits:
+        pool = WorkerPool(instances, threads, setup_kwargs=setup_kwargs)
+        start = perf_counter()
+        pool.start()
+        setup_time = perf_counter() - start
+        try:
+            pool.score(filelist[:batch_size * instances])
+            submitted, latencies, position = {}, [], 0
+            start = perf_counter()
+            while position < len(batches) or len(submitted) > 0:
+                while position < len(batches) and \
+                      len(submitted) < 2 * instances:
+                    submitted[pool.submit(batches[position])] = perf_counter()
+                    position += 1
+                task_id, _, error = pool.get()
+                if error is not None:
+                    raise RuntimeError('ChainRad couldn\'t score in a ' +
+                                       'worker: {}'.format(error))
+                latencies.append(perf_counter() - submitted.pop(task_id))
+            elapsed = perf_counter() - start
+            memory = pool.memory()
+        finally:
+            pool.close()
+        result.append({'instances' : instances, 'threads' : threads,
+                       'setup_sec' : setup_time,
+                       'images_per_sec' : sum(len(batch) for batch
+                                              in batches) / elapsed,
+                       'p50_ms' : percentile(latencies, 50) * 1000,
+                       'p95_ms' : percentile(latencies, 95) * 1000,
+                       'rss_mb' : sum(item['rss_mb'] or 0.0
+                                      for item in memory),
+                       'pss_mb' : sum(item['pss_mb'] or 0.0
+                                      for item in memory)})
+        print('{:3d} x {:3d} -- {:8.2f} images/s -- p50 {:10.2f} ms -- p95 '
+              .format(instances, threads, result[-1]['images_per_sec'],
+                      result[-1]['p50_ms']) +
+              '{:10.2f} ms -- pss {:9.1f} MB'.format(result[-1]['p95_ms'],
+                                                     result[-1]['pss_mb']),
+              flush=True)
+    return sorted(result, key=lambda item: -item['images_per_sec'])
+
+
+def get_splits(cpu_count : int = None, worker_memory : float = None,
+               memory : float = None) -> list:
+    """
+    Get instances x threads splits of the CPUs
+    ==========================================
+
+    Parameters
+    ----------
+    cpu_count : int, optional (None if omitted)
+        Number of CPUs to split. If omitted, the available CPUs are counted.
+    worker_memory : float, optional (None if omitted)
+        Memory of a worker in MB. If given, no split has more instances than
+        fit into memory.
+    memory : float, optional (None if omitted)
+        Memory for the workers in MB. If omitted, the available memory is
+        used, see affinity.get_available_memory().
+
+    Returns
+    -------
+    list[tuple]
+        (instances, threads) for every power of two thread count, and one
+        instance with every CPU. Splits that are the same after the memory
+        bound are listed once.
+    """
+
+    if cpu_count is None:
+        cpu_count = len(get_available_cpus())
+    if memory is None and worker_memory is not None:
+        memory = get_available_memory()
+    limit = cpu_count
+    if worker_memory is not None and memory is not None:
+        limit = max(1, min(cpu_count, int(memory // worker_memory)))
+    result, threads = [], 1
+    while threads < cpu_count:
+        if (min(cpu_count // threads, limit), threads) not in result:
+            result.append((min(cpu_count // threads, limit), threads))
+        threads *= 2
+    result.append((1, cpu_count))
+    return result
+
+
+def main():
+    """
+    Provides main functionality
+    ===========================
+    """
+
+    # pylint: disable=too-many-branches
+    #         Every command is handled here, like the arguments.
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    # pylint: disable=too-many-statements
+    #         Argument definitions are easier to read in one place.
+
+    parser = ArgumentParser(description='Serve ChainRad with pinned ' +
+                                        'worker processes.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, text in [('plan', 'Print the CPUs of every worker.'),
+                          ('serve', 'Score images arriving in a directory.'),
+                          ('benchmark', 'Find the best instances x threads ' +
+                                        'split.'),
+                          ('export-weights', 'Save the models for sharing ' +
+                                             'between workers.')]:
+        subparser = subparsers.add_parser(command, help=text)
+        if command in ['plan', 'serve']:
+            subparser.add_argument('--instances', type=int,
+                                   default=len(get_numa_nodes()))
+            subparser.add_argument('--threads', type=int, default=None,
+                                   help='Intra-op threads per worker, ' +
+                                        'the CPUs are split if omitted.')
+            subparser.add_argument('--inter-op-threads', type=int, default=1)
+        if command != 'plan':
+            subparser.add_argument('--weights-file', default=None,
+                                   help='File of save_weights() the ' +
+                                        'workers share. benchmark ' +
+                                        'exports a temporary one if ' +
+                                        'omitted.')
+            subparser.add_argument('--backend', choices=['chain', 'student'],
+                                   default='chain')
+            subparser.add_argument('--variant', default=None)
+            subparser.add_argument('--random-init', action='store_true',
+                                   help='Use random weights, no model ' +
+                                        'download.')
+        if command == 'serve':
+            subparser.add_argument('directory', help='Directory to watch.')
+            subparser.add_argument('--queue', default=None)
+            subparser.add_argument('--batch-size', type=int, default=None,
+                                   help='Images claimed at once, 8 per ' +
+                                        'worker if omitted.')
+            subparser.add_argument('--debounce', type=float, default=2.0)
+            subparser.add_argument('--poll-interval', type=float, default=2.0)
+            subparser.add_argument('--store', default=RESULTS_FILE)
+            subparser.add_argument('--no-store', action='store_true')
+            subparser.add_argument('--band', type=float, default=None)
+        if command == 'benchmark':
+            subparser.add_argument('--splits', nargs='+', default=None,
+                                   help='Splits like 4x16, the powers of ' +
+                                        'two are measured if omitted.')
+            subparser.add_argument('--image-dir', default=BENCH_IMG_DIR)
+            subparser.add_argument('--image-count', type=int, default=64)
+            subparser.add_argument('--batch-size', type=int, default=4)
+            subparser.add_argument('--repeats', type=int, default=3)
+            subparser.add_argument('--output', default=None,
+                                   help='JSON file to write the results to.')
+    args = parser.parse_args()
+    if args.command in ['plan', 'serve'] and args.threads is None:
+        args.threads = max(1, len(get_available_cpus()) // args.instances)
+    if args.command == 'plan':
+        for i, cpus in enumerate(get_placement(args.instances, args.threads)):
+            print('worker {:3d} -- cpus {}'.format(i, cpus))
+        return
+    setup_kwargs = {'random_init' : args.random_init,
+                    'backend' : args.backend, 'variant' : args.variant}
+    if args.command == 'export-weights':
+        if args.weights_file is None:
+            parser.error('export-weights requires --weights-file.')
+        inference.SessionSetup.setup(**setup_kwargs)
+        inference.SessionSetup.save_weights(args.weights_file)
+        print('Models written to "{}".'.format(args.weights_file))
+        return
+    setup_kwargs['weights_file'] = args.weights_file
+    if args.command == 'benchmark':
+        filelist = make_synthetic_images(args.image_dir, args.image_count)
+        exported = None
+        if args.weights_file is None:
+            # Workers share one copy of the weights, like in production.
+            exported = join(args.image_dir, 'chainrad_weights.pt')
+            base_memory = get_process_memory()['rss_mb'] or 0.0
+            session = InferenceSession()
+            session.setup(**setup_kwargs)
+            worker_memory = base_memory + (session.sample_memory('cpu') *
+                                           args.batch_size / 1048576.0)
+            session.save_weights(exported)
+            del session
+            setup_kwargs['weights_file'] = exported
+        try:
+            if args.splits is not None:
+                splits = [tuple(int(value) for value in split.split('x'))
+                          for split in args.splits]
+            elif exported is not None and get_available_memory() is not None:
+                splits = get_splits(worker_memory=worker_memory,
+                                    memory=get_available_memory() -
+                                           getsize(exported) / 1048576.0)
+            else:
+                splits = get_splits()
+            result = benchmark(filelist, splits, args.batch_size,
+                               args.repeats, setup_kwargs)
+        finally:
+            if exported is not None and isfile(exported):
+                remove(exported)
+        print('Best split: {} x {}.'.format(result[0]['instances'],
+                                            result[0]['threads']))
+        if args.output is not None:
+            with open(args.output, 'w', encoding='utf8') as outstream:
+                json_dump(result, outstream, indent=2)
+        return
+    print('Starting {} workers... '.format(args.instances), end='', flush=True)
+    pool = WorkerPool(args.instances, args.threads, args.inter_op_threads,
+                      setup_kwargs)
+    pool.start()
+    print('Done.')
+    for item in pool.memory():
+        print('worker {:3d} (pid {}) -- rss {} MB -- pss {} MB'.format(
+                    item['worker'], item['pid'],
+                    *['{:.1f}'.format(item[name]) if item[name] is not None
+                      else '-' for name in ['rss_mb', 'pss_mb']]))
+    service = IngestService(args.directory, args.queue,
+                            args.batch_size if args.batch_size is not None
+                            else 8 * args.instances, args.debounce,
+                            args.poll_interval,
+                            None if args.no_store else
+                            ResultStore(args.store), args.band, pool)
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        pool.close()
+
+
+def run_worker(index : int, cpus : list, threads : int,
+               inter_op_threads : int, setup_kwargs : dict, tasks : any,
+               results : any):
+    """
+    Run a worker process
+    ====================
+
+    Parameters
+    ----------
+    index : int
+        Index of the worker.
+    cpus : list
+        CPUs to pin the worker to.
+    threads : int
+        Intra-op threads.
+    inter_op_threads : int
+        Inter-op threads.
+    setup_kwargs : dict
+        Arguments of inference.SessionSetup.setup().
+    tasks : multiprocessing.Queue
+        Queue of (task id, filelist, band) tuples, None stops the worker.
+    results : multiprocessing.Queue
+        Queue of (task id, records, error) tuples. The first message is
+        (index, None, error) when the session is set up, error is None on
+        success.
+    """
+
+    # pylint: disable=broad-except
+    #         Errors are reported to the pool instead of killing the worker.
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    inference.SessionSetup.configure(threads, inter_op_threads, cpus)
+    try:
+        inference.SessionSetup.setup(**setup_kwargs)
+    except Exception as error:
+        results.put((index, None, str(error)))
+        return
+    results.put((index, None, None))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, filelist, band = task
+        try:
+            results.put((task_id, inference.score(filelist, band=band), None))
+        except Exception as error:
+            results.put((task_id, None, str(error)))
+
+
+if __name__ == '__main__':
+    main()
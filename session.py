@@ -0,0 +1,917 @@
+"""
+ChainRad
+========
+
+File: inference sessions
+"""
+
+
+# Standard library imports
+from contextlib import nullcontext
+from copy import copy
+from os import replace, stat
+from os.path import isfile
+from threading import Lock
+
+# 3rd party imports
+import torch
+
+# Project level imports
+from affinity import configure_process
+from batching import get_activation_memory
+from cascade import get_light_model_file, load_light_models
+from core import DISEASES_FILE, HEADLESS_FEATURES, SHARED_FILE
+from core import SharedTrunkClassifier
+from core import get_classifier, get_head_file, get_headless_models
+from core import get_random_classifier, get_simple_transformer
+from core import load_diseases
+from decode import IMAGE_SIZE
+from distill import STUDENT_FILE, STUDENT_SIZE, load_student
+from results import get_version
+
+
+class InferenceSession:
+    """
+    Models, tresholds and versions of an inference configuration
+    ============================================================
+
+    Notes
+    -----
+        The models, tresholds and versions are kept in a single state dict
+        that is never changed once it's in use. setup() and reload() build
+        a new state without holding any lock and swap it in with a single
+        assignment, so scoring never waits for them. Scoring works on a
+        snapshot(), which keeps the state of the moment it was taken, so a
+        micro-batch sees one state even if the session changes meanwhile.
+        Any number of threads can score with the same session at once.
+        Sessions are independent, sessions with different backends or head
+        variants can be used side by side, for example to compare them.
+    """
+
+    # pylint: disable=too-many-public-methods
+    #         Getters keep the interface of the former SessionSetup.
+
+
+    def __init__(self):
+        """
+        Initialize the object
+        =====================
+        """
+
+        self.__device_locks = {'backbone' : Lock(), 'head' : Lock()}
+        self.__serving = {}
+        self.__state = {'backend' : 'chain', 'diseases' : {}, 'files' : None,
+                        'headless' : {}, 'heads' : {}, 'light' : {},
+                        'model_version' : '', 'sample_memory' : {},
+                        'shared' : None, 'student' : None,
+                        'threshold_version' : '', 'transformer' : lambda x: x,
+                        'tresholds' : {}, 'variant' : None}
+        self.__swap_lock = Lock()
+
+
+    def backend(self) -> str:
+        """
+        Get the inference backend
+        =========================
+
+        Returns
+        -------
+        str
+            'chain' for the headless models and heads, 'student' for the
+            distilled student.
+        """
+
+        return self.__state['backend']
+
+
+    def configure(self, intra_op_threads : int = None,
+                  inter_op_threads : int = None, cpus : list = None) -> dict:
+        """
+        Configure threading and CPU affinity of the serving process
+        ===========================================================
+
+        Parameters
+        ----------
+        intra_op_threads : int, optional (None if omitted)
+            Threads of a single torch operator.
+        inter_op_threads : int, optional (None if omitted)
+            Threads running independent torch operators.
+        cpus : list, optional (None if omitted)
+            CPUs to pin the process to.
+
+        Returns
+        -------
+        dict
+            The applied configuration, see affinity.configure_process().
+
+        Notes
+        -----
+            Threading and affinity belong to the process, every session of
+            the process is affected. Call it before setup(), torch accepts
+            the inter-op thread count only before the first parallel work.
+        """
+
+        self.__serving = configure_process(intra_op_threads,
+                                           inter_op_threads, cpus)
+        return self.__serving
+
+
+    def device_guard(self, device : str, group : str) -> any:
+        """
+        Guard moving models between devices
+        ===================================
+
+        Parameters
+        ----------
+        device : str
+            Device the models run on.
+        group : str
+            'backbone' for the headless models, the light heads and the
+            student, 'head' for the heads.
+
+        Returns
+        -------
+        context manager
+            No-op for the CPU, where models never move. For other devices a
+            lock of the group, since scoring moves the models to the device
+            and back, which must not interleave between threads. Groups have
+            their own locks, so the backbone and head stages of a pipeline
+            still overlap. Sessions sharing backbones share the backbone
+            lock, see setup().
+        """
+
+        if str(device) == 'cpu':
+            return nullcontext()
+        return self.__device_locks[group]
+
+
+    def diseases(self) -> dict:
+        """
+        Get diseases
+        ============
+
+        Returns
+        -------
+        dict
+            Dictionary of disease names.
+        """
+
+        return self.__state['diseases']
+
+
+    def headless_models(self) -> dict:
+        """
+        Get headles models
+        ==================
+
+        Returns
+        -------
+        dcit
+            Dictionary of headless models.
+        """
+
+        return self.__state['headless']
+
+
+    def is_configured(self) -> bool:
+        """
+        Check whether the session is already set up or not
+        ===================================================
+
+        Returns
+        -------
+        bool
+            True if the session has diseases and models, False if not.
+        """
+
+        state = self.__state
+        return len(state['diseases']) > 0 and (len(state['heads']) > 0 or
+                                               state['shared'] is not None or
+                                               state['student'] is not None)
+
+
+    def keys(self) -> list:
+        """
+        Get exisiting disease keys
+        ==========================
+
+        Returns
+        -------
+        list
+            The list of existing disease keys.
+        """
+
+        return list(self.__state['diseases'].keys())
+
+
+    def light_models(self) -> dict:
+        """
+        Get light heads of the cascade
+        ==============================
+
+        Returns
+        -------
+        dict
+            Dictionary of light heads, empty if the cascade is not available.
+        """
+
+        return self.__state['light']
+
+
+    def model_version(self) -> str:
+        """
+        Get the version of the loaded models
+        ====================================
+
+        Returns
+        -------
+        str
+            Version derived from the names, sizes and modification times of
+            the state dict files, or 'random' for randomly initialized models.
+        """
+
+        return self.__state['model_version']
+
+
+    def reload(self, timeout : float = None) -> dict:
+        """
+        Reload the changed tresholds and models
+        =======================================
+
+        Parameters
+        ----------
+        timeout : float, optional (None if omitted)
+            Maximum seconds to wait for a setup() or reload() of another
+            thread before the swap. If omitted, it waits as long as needed.
+
+        Returns
+        -------
+        dict
+            Dictionary with the keys 'tresholds' (disease keys with a changed
+            treshold) and 'models' (keys of the reloaded heads, or 'shared',
+            'student' or 'light'). Both are empty if nothing changed.
+
+        Raises
+        ------
+        FileNotFoundError
+            When the chainrad_diseases.json file doesn't exist.
+        RuntimeError
+            When the shared classifier doesn't match the diseases.
+        TimeoutError
+            When another thread kept swapping the session for too long.
+            Nothing is changed then, the next call tries again.
+
+        Notes
+        -----
+            Files are compared by size and modification time with the ones
+            loaded. Only the state dicts that changed are loaded, while
+            scoring goes on with the old models, then the new state is
+            swapped in. The light heads of the cascade are reloaded
+            together when any of them changed, and picked up once all of
+            them exist. Micro-batches running on a snapshot finish with the
+            old models, the next ones use the new models. Tresholds are
+            reloaded for the diseases of the session, adding or removing a
+            disease needs setup(). Randomly initialized models and models
+            attached from a weights file are never reloaded, their tresholds
+            are. Write the files atomically, like write and rename, a file
+            caught half-written fails to load and is tried again by the next
+            call.
+        """
+
+        # pylint: disable=too-many-branches
+        #         Same branches are separated due to readability of the code.
+
+        # pylint: disable=too-many-locals
+        #         Same variables are separated due to readability of the code.
+
+        # pylint: disable=too-many-statements
+        #         Loading and swapping are kept together, so the swap checks
+        #         the state the files were compared with.
+
+        result = {'tresholds' : [], 'models' : []}
+        state = self.__state
+        files, variant, old_tresholds = (state['files'], state['variant'],
+                                         state['tresholds'])
+        backend, keys = state['backend'], list(state['heads'].keys())
+        count = len(state['diseases'])
+        if files is None:
+            return result
+        new_files = dict(files, heads=dict(files['heads']))
+        light_files = None
+        if files['light'] is not None and backend != 'student':
+            light_files = {key : self.__get_signature(get_light_model_file(key))
+                           for key in state['diseases'].keys()}
+        tresholds = old_tresholds
+        signature = self.__get_signature(DISEASES_FILE)
+        if signature != files['diseases']:
+            json_data = load_diseases()
+            new_files['diseases'] = signature
+            tresholds = {key : json_data[key]['treshold']
+                         if key in json_data.keys()
+                         and 'treshold' in json_data[key].keys() else value
+                         for key, value in old_tresholds.items()}
+            result['tresholds'] = [key for key, value in tresholds.items()
+                                   if value != old_tresholds[key]]
+        models = {}
+        if backend == 'student' and files['student'] is not None:
+            signature = self.__get_signature(STUDENT_FILE)
+            if signature is not None and signature != files['student']:
+                models['student'] = load_student(list(tresholds.keys()))
+                new_files['student'] = signature
+        elif files['shared'] is not None:
+            signature = self.__get_signature(SHARED_FILE)
+            if signature is not None and signature != files['shared']:
+                models['shared'] = self.__load_head(SHARED_FILE)
+                if len(models['shared'].fc4) != count:
+                    raise RuntimeError('ChainRad couldn\'t match the ' +
+                                       'outputs of the shared classifier ' +
+                                       'to diseases.')
+                new_files['shared'] = signature
+        else:
+            for key in keys:
+                if key not in files['heads'].keys():
+                    continue
+                signature = self.__get_signature(get_head_file(key, variant))
+                if signature is not None and \
+                   signature != files['heads'][key]:
+                    models[key] = self.__load_head(get_head_file(key,
+                                                                 variant))
+                    new_files['heads'][key] = signature
+        if light_files is not None and light_files != files['light'] and \
+           None not in light_files.values():
+            light = load_light_models(list(light_files.keys()))
+            if len(light) > 0:
+                models['light'] = light
+                new_files['light'] = light_files
+        result['models'] = list(models.keys())
+        if new_files == files:
+            return result
+        state = dict(state, files=new_files)
+        if len(result['tresholds']) > 0:
+            state['tresholds'] = tresholds
+            state['threshold_version'] = get_version(tresholds)
+        if len(models) > 0:
+            if 'light' in models.keys():
+                state['light'] = models.pop('light')
+            if 'student' in models.keys():
+                state['student'] = models['student']
+            elif 'shared' in models.keys():
+                state['shared'] = models['shared']
+            else:
+                state['heads'] = {key : models.get(key, model)
+                                  for key, model in state['heads'].items()}
+            state['model_version'] = self.__get_model_version(new_files,
+                                                              variant)
+            state['sample_memory'] = {}
+        if not self.__swap_lock.acquire(timeout=-1 if timeout is None
+                                        else timeout):
+            raise TimeoutError('ChainRad couldn\'t swap the session in ' +
+                               '{} seconds.'.format(timeout))
+        try:
+            if self.__state['files'] is not files:
+                # setup() or another reload() came first.
+                return {'tresholds' : [], 'models' : []}
+            self.__state = state
+        finally:
+            self.__swap_lock.release()
+        return result
+
+
+    def sample_memory(self, device : str) -> int:
+        """
+        Get the working memory of a single sample
+        =========================================
+
+        Parameters
+        ----------
+        device : str
+            Device the models run on.
+
+        Returns
+        -------
+        int
+            Bytes of the decoded and transformed image, the activation peak
+            of the largest model and the headless output of a sample.
+
+        Notes
+        -----
+            The value is measured with a probe sample on the first call per
+            device and reused until the models change. Call it on a
+            snapshot() while scoring, models are moved to device and back to
+            the CPU.
+        """
+
+        # pylint: disable=no-member
+        #         torch has a member function rand()
+
+        state = self.__state
+        if device in state['sample_memory'].keys():
+            return state['sample_memory'][device]
+        if state['backend'] == 'student':
+            models = {'student' : [state['student']]}
+            height, width = STUDENT_SIZE
+        else:
+            models = {'backbone' : list(state['headless'].values()),
+                      'head' : list(state['heads'].values()) +
+                               ([state['shared']]
+                                if state['shared'] is not None else [])}
+            height, width = IMAGE_SIZE
+        probes = {'student' : torch.rand(1, 3, height, width, device=device),
+                  'backbone' : torch.rand(1, 3, height, width, device=device),
+                  'head' : torch.rand(1, HEADLESS_FEATURES, device=device)}
+        peak = 0
+        for name, model_list in models.items():
+            with self.device_guard(device, 'head' if name == 'head'
+                                   else 'backbone'):
+                for model in model_list:
+                    peak = max(peak, get_activation_memory(model.to(device),
+                                                           probes[name]))
+                    model.to('cpu')
+        # uint8 decoded and float transformed image.
+        result = 5 * 3 * height * width + peak
+        if state['backend'] != 'student':
+            # Headless output on the CPU and on the device.
+            result += 2 * HEADLESS_FEATURES * 4
+        state['sample_memory'][device] = result
+        return result
+
+
+    def save_weights(self, filename : str):
+        """
+        Save the loaded models for sharing between processes
+        ====================================================
+
+        Parameters
+        ----------
+        filename : str
+            File to write, replaced atomically.
+
+        Notes
+        -----
+            The models are pickled as they are, with their backend and model
+            version, so processes can attach to them with
+            setup(weights_file=filename) without building or loading
+            anything. The tresholds are not saved, they are always read from
+            chainrad_diseases.json. The file has to be rewritten when the
+            models change.
+        """
+
+        state = self.__state
+        torch.save({'backend' : state['backend'],
+                    'model_version' : state['model_version'],
+                    'headless' : state['headless'], 'heads' : state['heads'],
+                    'shared' : state['shared'], 'light' : state['light'],
+                    'student' : state['student']}, filename + '.tmp')
+        replace(filename + '.tmp', filename)
+
+
+    def serving(self) -> dict:
+        """
+        Get the serving configuration
+        =============================
+
+        Returns
+        -------
+        dict
+            The configuration applied by configure(), empty if it wasn't
+            called.
+        """
+
+        return self.__serving
+
+
+    def setup(self, random_init : bool = False, backend : str = 'chain',
+              variant : str = None, weights_file : str = None,
+              share_backbones : any = None):
+        """
+        Set up the session
+        ==================
+
+        Parameters
+        ----------
+        random_init : bool, optional (False if omitted)
+            Whether to use randomly initialized models instead of the stored
+            state dicts and the pretrained backbones. The heads are of the
+            variant, see core.get_random_classifier(). Predictions are
+            meaningless, it is intended for benchmarks without the model
+            download.
+        backend : str, optional ('chain' if omitted)
+            'chain' loads the headless models and the heads, 'student' loads
+            the distilled student only.
+        variant : str, optional (None if omitted)
+            Variant of the heads to load, like 'pruned' or 'lowrank', see
+            core.get_head_file(). 'shared' loads the shared trunk classifier
+            from core.SHARED_FILE. If omitted, the trained heads are loaded.
+        weights_file : str, optional (None if omitted)
+            File written by save_weights(). If given, the models are mapped
+            from it read-only instead of being loaded, random_init, backend
+            and variant are ignored and the models are the ones saved. Every
+            process attached to the same file shares the weights through the
+            page cache, so more workers fit into the memory.
+        share_backbones : InferenceSession, optional (None if omitted)
+            Session to take the headless models from instead of loading them
+            again, for sessions that differ in their heads only. The device
+            lock of the backbones is taken from it as well and kept, so the
+            sessions never move the shared models between devices at once.
+
+        Raises
+        ------
+        FileNotFoundError
+            When the chainrad_diseases.json file doesn't exist.
+        RuntimeError
+            When no disease data was added to the sassion.
+        ValueError
+            When the backend is unknown.
+
+        Notes
+        -----
+            The models are loaded while scoring goes on, then the new state
+            is swapped in. Micro-batches running on a snapshot finish with
+            the old models. The sizes and modification times of the loaded
+            files are kept for reload().
+        """
+
+        # pylint: disable=too-many-arguments
+        #         We consider a better practice having long list of named
+        #         arguments then having **kwargs only.
+
+        # pylint: disable=protected-access
+        #         The backbone lock is shared with another session.
+
+        if backend not in ['chain', 'student']:
+            raise ValueError('ChainRad doesn\'t know the backend "{}".'
+                             .format(backend))
+        signature = self.__get_signature(DISEASES_FILE)
+        json_data = load_diseases()
+        if weights_file is not None:
+            state = self.__attach(weights_file, json_data)
+        else:
+            state = self.__load(json_data, random_init, backend, variant,
+                                share_backbones)
+        state['files']['diseases'] = signature
+        state['threshold_version'] = get_version(state['tresholds'])
+        state['transformer'] = get_simple_transformer()
+        state['variant'] = variant
+        state['sample_memory'] = {}
+        with self.__swap_lock:
+            if share_backbones is not None and \
+               state['headless'] is share_backbones.headless_models():
+                # Snapshots share the dict, so they see the new lock too.
+                self.__device_locks['backbone'] = share_backbones\
+                                                  .__device_locks['backbone']
+            self.__state = state
+
+
+    def shared_model(self) -> torch.nn.Module:
+        """
+        Get the shared trunk classifier
+        ===============================
+
+        Returns
+        -------
+        torch.nn.Module | None
+            The shared trunk classifier or None if independent heads are
+            loaded. Its outputs follow the alphabetical order of keys().
+        """
+
+        return self.__state['shared']
+
+
+    def snapshot(self) -> 'InferenceSession':
+        """
+        Get a snapshot of the session
+        =============================
+
+        Returns
+        -------
+        InferenceSession
+            Session with the current state of this one. It's a shallow copy,
+            so it shares the device locks and the serving configuration, but
+            setup() and reload() of this session don't change it. Score a micro-batch with a single
+            snapshot, so it sees the same models and tresholds throughout.
+        """
+
+        return copy(self)
+
+
+    def student(self) -> torch.nn.Module:
+        """
+        Get the distilled student
+        =========================
+
+        Returns
+        -------
+        torch.nn.Module | None
+            The student or None if the backend is 'chain'.
+        """
+
+        return self.__state['student']
+
+
+    def threshold_version(self) -> str:
+        """
+        Get the version of the loaded tresholds
+        =======================================
+
+        Returns
+        -------
+        str
+            Version derived from the treshold values.
+        """
+
+        return self.__state['threshold_version']
+
+
+    def trained_models(self) -> dict:
+        """
+        Get trained models
+        ==================
+
+        Returns
+        -------
+        dcit
+            Dictionary of trained models.
+        """
+
+        return self.__state['heads']
+
+
+    def transformer(self) -> any:
+        """
+        Get transformer
+        ===============
+
+        Returns
+        -------
+        callable
+            Transformer of single images.
+        """
+
+        return self.__state['transformer']
+
+
+    def tresholds(self) -> dict:
+        """
+        Get tresholds
+        =============
+
+        Returns
+        -------
+        dcit
+            Dictionary of tresholds.
+        """
+
+        return self.__state['tresholds']
+
+
+    @staticmethod
+    def __attach(weights_file : str, json_data : dict) -> dict:
+        """
+        Attach to models saved by save_weights()
+        ========================================
+
+        Parameters
+        ----------
+        weights_file : str
+            File written by save_weights().
+        json_data : dict
+            Content of chainrad_diseases.json.
+
+        Returns
+        -------
+        dict
+            State of the session.
+
+        Raises
+        ------
+        FileNotFoundError
+            When the weights file doesn't exist.
+        RuntimeError
+            When no disease data was added to the sassion.
+
+        Notes
+        -----
+            torch.load(mmap=True) maps the tensor data of the file instead of
+            reading it, so the pages are loaded on first use and shared with
+            every process mapping the same file. Inference never writes the
+            weights, so the pages stay shared. Moving a model to a GPU and
+            back makes a private copy, sharing is meant for CPU serving.
+        """
+
+        if not isfile(weights_file):
+            raise FileNotFoundError('Cannot find "{}".'.format(weights_file))
+        data = torch.load(weights_file, map_location='cpu', mmap=True,
+                          weights_only=False)
+        state = {'backend' : data['backend'], 'diseases' : {},
+                 'tresholds' : {}, 'headless' : data['headless'],
+                 'heads' : data['heads'], 'shared' : data['shared'],
+                 'light' : data['light'], 'student' : data['student'],
+                 'model_version' : data['model_version'],
+                 'files' : {'heads' : {}, 'light' : None, 'shared' : None,
+                            'student' : None}}
+        keys = (list(state['heads'].keys()) if len(state['heads']) > 0
+                else list(json_data.keys()))
+        for key in keys:
+            if key in json_data.keys() and 'name' in json_data[key].keys() \
+               and 'treshold' in json_data[key].keys():
+                state['diseases'][key] = json_data[key]['name']
+                state['tresholds'][key] = json_data[key]['treshold']
+        if len(state['diseases']) == 0:
+            raise RuntimeError('ChainRad couldn\'t add any disease.')
+        return state
+
+
+    @staticmethod
+    def __get_model_version(files : dict, variant : str) -> str:
+        """
+        Get the version of models loaded from files
+        ===========================================
+
+        Parameters
+        ----------
+        files : dict
+            Signatures of the loaded files, see __load().
+        variant : str
+            Variant of the heads.
+
+        Returns
+        -------
+        str
+            Version derived from the names, sizes and modification times of
+            the state dict files, the light heads included.
+        """
+
+        if files['student'] is not None:
+            return get_version(['student'] + files['student'])
+        return get_version([[key, variant] + signature for key, signature
+                            in files['heads'].items()] +
+                           ([['shared'] + files['shared']]
+                            if files['shared'] is not None else []) +
+                           [[key, 'light'] + signature for key, signature
+                            in (files['light'] or {}).items()])
+
+
+    @staticmethod
+    def __get_signature(filename : str) -> list:
+        """
+        Get the signature of a file
+        ===========================
+
+        Parameters
+        ----------
+        filename : str
+            File to check.
+
+        Returns
+        -------
+        list | None
+            Size and modification time in nanoseconds, or None if the file
+            doesn't exist.
+        """
+
+        try:
+            info = stat(filename)
+        except OSError:
+            return None
+        return [info.st_size, info.st_mtime_ns]
+
+
+    @staticmethod
+    def __load(json_data : dict, random_init : bool, backend : str,
+               variant : str, share_backbones : any) -> dict:
+        """
+        Load models
+        ===========
+
+        Parameters
+        ----------
+        json_data : dict
+            Content of chainrad_diseases.json.
+        random_init : bool
+            Whether to use randomly initialized models.
+        backend : str
+            'chain' or 'student'.
+        variant : str
+            Variant of the heads.
+        share_backbones : InferenceSession
+            Session to take the headless models from or None.
+
+        Returns
+        -------
+        dict
+            State of the session. Its 'files' key holds the size and the
+            modification time of the loaded state dict files by head key and
+            under 'shared', 'student' and 'light' (by disease key), taken
+            before loading, so a file changing meanwhile is loaded again by
+            reload(). 'light' is None for randomly initialized models.
+
+        Raises
+        ------
+        RuntimeError
+            When no disease data was added to the sassion.
+        """
+
+        # pylint: disable=too-many-arguments
+        #         We consider a better practice having long list of named
+        #         arguments then having **kwargs only.
+
+        # pylint: disable=too-many-branches
+        #         Same branches are separated due to readability of the code.
+
+        state = {'backend' : backend, 'diseases' : {}, 'tresholds' : {},
+                 'headless' : {}, 'heads' : {}, 'shared' : None, 'light' : {},
+                 'student' : None, 'files' : {'heads' : {},
+                                              'light' : (None if random_init
+                                                         else {}),
+                                              'shared' : None,
+                                              'student' : None}}
+        if backend == 'student' or variant == 'shared':
+            for key, data in json_data.items():
+                if 'name' in data.keys() and 'treshold' in data.keys():
+                    state['diseases'][key] = data['name']
+                    state['tresholds'][key] = data['treshold']
+        if backend == 'student':
+            if not random_init:
+                state['files']['student'] = InferenceSession.__get_signature(
+                                                                STUDENT_FILE)
+            state['student'] = load_student(list(state['diseases'].keys()),
+                                            random_init=random_init)
+            state['model_version'] = ('random' if random_init else
+                                      InferenceSession.__get_model_version(
+                                                    state['files'], variant))
+            return state
+        if variant == 'shared':
+            if random_init:
+                state['shared'] = SharedTrunkClassifier(len(state['diseases']))
+                for param in state['shared'].parameters():
+                    param.requires_grad = False
+                state['shared'].eval()
+            else:
+                state['files']['shared'] = InferenceSession.__get_signature(
+                                                                SHARED_FILE)
+                state['shared'] = InferenceSession.__load_head(SHARED_FILE)
+            if len(state['shared'].fc4) != len(state['diseases']):
+                raise RuntimeError('ChainRad couldn\'t match the outputs ' +
+                                   'of the shared classifier to diseases.')
+        else:
+            for key, data in json_data.items():
+                filename = get_head_file(key, variant)
+                if (random_init or isfile(filename)) and \
+                   'name' in data.keys() and 'treshold' in data.keys():
+                    if random_init:
+                        state['heads'][key] = get_random_classifier(variant)
+                        for param in state['heads'][key].parameters():
+                            param.requires_grad = False
+                        state['heads'][key].eval()
+                    else:
+                        state['files']['heads'][key] = InferenceSession\
+                                                    .__get_signature(filename)
+                        state['heads'][key] = InferenceSession.__load_head(
+                                                                    filename)
+                    state['diseases'][key] = data['name']
+                    state['tresholds'][key] = data['treshold']
+        if len(state['diseases']) == 0:
+            raise RuntimeError('ChainRad couldn\'t add any disease.')
+        if share_backbones is not None and \
+           len(share_backbones.headless_models()) > 0:
+            state['headless'] = share_backbones.headless_models()
+        else:
+            state['headless'] = get_headless_models(
+                                                pretrained=not random_init)
+        if not random_init:
+            state['files']['light'] = {key : InferenceSession.__get_signature(
+                                                get_light_model_file(key))
+                                       for key in state['diseases'].keys()}
+        state['light'] = load_light_models(list(state['diseases'].keys()),
+                                           random_init=random_init)
+        if not random_init and len(state['light']) == 0:
+            # Picked up by reload() once every light head exists.
+            state['files']['light'] = {}
+        state['model_version'] = ('random' if random_init else
+                                  InferenceSession.__get_model_version(
+                                                    state['files'], variant))
+        return state
+
+
+    @staticmethod
+    def __load_head(filename : str) -> torch.nn.Module:
+        """
+        Load a head for inference
+        =========================
+
+        Parameters
+        ----------
+        filename : str
+            State dict file of the head.
+
+        Returns
+        -------
+        torch.nn.Module
+            The head in eval mode with frozen parameters.
+        """
+
+        result = get_classifier(torch.load(filename, map_location='cpu'))
+        for param in result.parameters():
+            param.requires_grad = False
+        result.eval()
+        return result
@@ -0,0 +1,225 @@
+"""
+ChainRad
+========
+
+File: decision threshold optimization
+"""
+
+
+# Standard library imports
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps as json_dumps, load as json_load
+from os import replace
+from os.path import isfile, join
+
+# 3rd party imports
+import torch
+
+# Project level imports
+from core import DISEASES_FILE, LOG_DIR, MODEL_DIR, SoloClassifier
+from core import get_stacked_data, load_diseases
+from eventlog import read_predictions
+from metrics import get_optimal_threshold
+
+
+def load_log_scores(key : str) -> tuple:
+    """
+    Load scores of the last test pass from the training log
+    =======================================================
+
+    Parameters
+    ----------
+    key : str
+        Disease key, the same as the meta file id of the training.
+
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor)
+        Predicted probabilities and targets.
+
+    Raises
+    ------
+    FileNotFoundError
+        When neither LOG_DIR/<key>.predictions.npz nor LOG_DIR/last_<key>.csv
+        exists.
+    """
+
+    # pylint: disable=no-member
+    #         toch has a member function from_numpy()
+
+    content = read_predictions(key, LOG_DIR)
+    if len(content) == 0:
+        raise FileNotFoundError('Cannot find predictions of "{}" in "{}".'
+                                .format(key, LOG_DIR))
+    return (torch.from_numpy(content['prediction']).float(),
+            torch.from_numpy(content['target']).float())
+
+
+def load_valid_scores(key : str) -> tuple:
+    """
+    Score the validation split with the trained model
+    =================================================
+
+    Parameters
+    ----------
+    key : str
+        Disease key, the same as the meta file id of the training.
+
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor)
+        Predicted probabilities and targets.
+
+    Raises
+    ------
+    FileNotFoundError
+        When MODEL_DIR/<key>.statedict doesn't exist.
+
+    See also
+    --------
+        FileNotFoundError : core.get_stacked_data()
+    """
+
+    # pylint: disable=no-member
+    #         toch has a member function sigmoid()
+
+    filename = join(MODEL_DIR, '{}.statedict'.format(key))
+    if not isfile(filename):
+        raise FileNotFoundError('Cannot find "{}".'.format(filename))
+    model = SoloClassifier()
+    model.load_state_dict(torch.load(filename, map_location='cpu'))
+    model.eval()
+    data_x, data_y = get_stacked_data(key, dataset_type='valid')
+    with torch.no_grad():
+        predictions = torch.sigmoid(model(data_x).squeeze(1))
+    return predictions, data_y
+
+
+def main():
+    """
+    Provides main functionality
+    ===========================
+
+    Raises
+    ------
+    FileNotFoundError
+        When the chainrad_diseases.json file doesn't exist.
+    """
+
+    parser = ArgumentParser(description='Optimize decision thresholds of ' +
+                                        'ChainRad diseases.')
+    parser.add_argument('--source', choices=['log', 'valid'], default='log',
+                        help='Read the last test predictions of the training ' +
+                             'log or score the valid split with the trained ' +
+                             'models.')
+    parser.add_argument('--criterion', choices=['f1', 'youden',
+                                                'sensitivity'],
+                        default='f1', help='What to optimize.')
+    parser.add_argument('--sensitivity', type=float, default=0.9,
+                        help='Target sensitivity for criterion sensitivity.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of diseases to process in parallel.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print thresholds without writing them.')
+    args = parser.parse_args()
+    diseases = load_diseases()
+    loader = load_log_scores if args.source == 'log' else load_valid_scores
+    results = optimize_thresholds(list(diseases.keys()), loader,
+                                  args.criterion, args.sensitivity,
+                                  args.workers)
+    for key, result in results.items():
+        print('{:20} threshold {:.6f} -- {} {:.4f} -- precision {:.4f} -- '
+              .format(key, result['threshold'], args.criterion,
+                      result['score'], result['precision']) +
+              'sensitivity {:.4f} -- specificity {:.4f}'
+              .format(result['sensitivity'], result['specificity']))
+    if not args.dry_run:
+        write_thresholds(results)
+        print('{} threshold(s) written to "{}".'.format(len(results),
+                                                        DISEASES_FILE))
+
+
+def optimize_thresholds(keys : list, loader : callable,
+                        criterion : str = 'f1',
+                        target_sensitivity : float = 0.9,
+                        workers : int = 4) -> dict:
+    """
+    Optimize thresholds of multiple diseases in parallel
+    ====================================================
+
+    Parameters
+    ----------
+    keys : list
+        Disease keys to optimize.
+    loader : callable
+        Function that gets a disease key and returns probabilities and
+        targets, like load_log_scores() or load_valid_scores().
+    criterion : str, optional ('f1' if omitted)
+        What to optimize, see metrics.get_optimal_threshold().
+    target_sensitivity : float, optional (0.9 if omitted)
+        Required sensitivity in case of criterion 'sensitivity'.
+    workers : int, optional (4 if omitted)
+        Number of worker threads.
+
+    Returns
+    -------
+    dict
+        Dictionary where key is the disease key and value is the result of
+        metrics.get_optimal_threshold(). Diseases without scores are left out
+        with a warning.
+    """
+
+    def optimize(key : str) -> tuple:
+        """
+        Optimize the threshold of one disease
+        =====================================
+        """
+
+        try:
+            probabilities, targets = loader(key)
+        except FileNotFoundError as error:
+            print('Skipping "{}": {}'.format(key, error))
+            return key, None
+        return key, get_optimal_threshold(probabilities, targets, criterion,
+                                          target_sensitivity)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        results = executor.map(optimize, keys)
+    return {key : result for key, result in results if result is not None}
+
+
+def write_thresholds(results : dict, filename : str = DISEASES_FILE):
+    """
+    Write thresholds into the diseases file atomically
+    ==================================================
+
+    Parameters
+    ----------
+    results : dict
+        Dictionary where key is the disease key and value is a dict with the
+        key 'threshold'.
+    filename : str, optional (DISEASES_FILE if omitted)
+        The diseases file to update.
+
+    Notes
+    -----
+        The file is re-read right before writing, every threshold is updated
+        in a single write to a temporary file that replaces the original, so
+        readers never see a partially written file.
+    """
+
+    with open(filename, 'r', encoding='utf8') as instream:
+        diseases = json_load(instream)
+    for key, result in results.items():
+        if key in diseases.keys():
+            diseases[key]['treshold'] = result['threshold']
+    content = json_dumps(diseases, indent='\t', ensure_ascii=False)
+    with open(filename + '.tmp', 'w', encoding='utf8',
+              newline='\r\n') as outstream:
+        outstream.write(content)
+    replace(filename + '.tmp', filename)
+
+
+if __name__ == '__main__':
+    main()
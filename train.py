@@ -7,24 +7,34 @@ File: model training
 
 
 # Standard library imports
+from argparse import ArgumentParser
 from os import listdir, mkdir
 from os.path import isdir, isfile, join
 import pickle
+from time import perf_counter
 from tqdm import tqdm
 
 # 3rd party imports
-from PIL import Image
 import torch
 
 # Project level imports
-from core import IMG_DIR, LOG_DIR, MODEL_DIR, OUT_DIR, SoloClassifier
-from core import check_and_get_basics, get_accuracy, get_data_in_batches
-from core import get_headless_models
-from core import get_training_transformer
+from checkpoint import CheckpointManager, copy_to_cpu
+from core import IMG_DIR, LOG_DIR, MODEL_DIR, OUT_DIR, SHARED_FILE
+from core import SharedTrunkClassifier, SoloClassifier
+from core import check_and_get_basics, get_data_in_batches
+from core import get_headless_models, get_multilabel_data, get_stacked_data
+from eventlog import EventLogger
+from metrics import MetricsAccumulator, get_auc
+from preprocess import get_training_preprocessor, load_batch
+from profiling import Profiler
 
 
 # Training parameters
 BATCH_SIZE = 128
+CHECKPOINT_EVERY = 10
+CHECKPOINT_KEEP = 3
+EVAL_BATCH_SIZE = 4096
+FEATURE_BATCH_SIZE = 16
 LEARNING_RATE = 5e-6
 MAX_EPOCHS = 200
 
@@ -32,6 +42,187 @@ MAX_EPOCHS = 200
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
+def evaluate(model : torch.nn.Module, criterion : torch.nn.Module,
+             data_x : torch.Tensor, data_y : torch.Tensor,
+             metrics : MetricsAccumulator,
+             batch_size : int = EVAL_BATCH_SIZE) -> dict:
+    """
+    Evaluate a model on a stacked dataset
+    =====================================
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Model to evaluate.
+    criterion : torch.nn.Module
+        Loss function.
+    data_x : torch.Tensor
+        Stacked inputs with shape (samples, features).
+    data_y : torch.Tensor
+        Stacked targets with shape (samples,).
+    metrics : MetricsAccumulator
+        Accumulator to collect metrics into. It is reset first.
+    batch_size : int, optional (EVAL_BATCH_SIZE if omitted)
+        Size of evaluation batches. If 0 or not less than the count of
+        samples, the whole dataset is scored in one shot.
+
+    Returns
+    -------
+    dict
+        Computed metrics, see MetricsAccumulator.compute(), with the extra key
+        'samples_per_sec'.
+    """
+
+    sample_count = data_x.shape[0]
+    if batch_size <= 0 or batch_size > sample_count:
+        batch_size = max(sample_count, 1)
+    metrics.reset()
+    model.eval()
+    start = perf_counter()
+    with torch.no_grad():
+        for pos in range(0, sample_count, batch_size):
+            batch_x = data_x[pos:pos + batch_size].to(DEVICE,
+                                                      non_blocking=True)
+            batch_y = data_y[pos:pos + batch_size].to(DEVICE,
+                                                      non_blocking=True)
+            batch_y_hat = model(batch_x).squeeze(1)
+            metrics.update(batch_y_hat, batch_y, criterion(batch_y_hat,
+                                                           batch_y))
+    result = metrics.compute()
+    result['samples_per_sec'] = sample_count / max(perf_counter() - start,
+                                                   1e-9)
+    return result
+
+
+def evaluate_multilabel(model : torch.nn.Module, data_x : torch.Tensor,
+                        data_y : torch.Tensor,
+                        batch_size : int = EVAL_BATCH_SIZE) -> dict:
+    """
+    Evaluate a multi-label model on a stacked dataset
+    =================================================
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Model with one output per disease.
+    data_x : torch.Tensor
+        Stacked inputs with shape (samples, features).
+    data_y : torch.Tensor
+        Stacked targets with shape (samples, diseases), -1 where unknown.
+    batch_size : int, optional (EVAL_BATCH_SIZE if omitted)
+        Size of evaluation batches.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'loss' (masked binary cross entropy), 'auc'
+        (list of AUCs per disease) and 'samples_per_sec'.
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions cat(), sigmoid()
+
+    model.eval()
+    start = perf_counter()
+    outputs = []
+    with torch.no_grad():
+        for pos in range(0, data_x.shape[0], batch_size):
+            outputs.append(model(data_x[pos:pos + batch_size].to(DEVICE))
+                           .cpu())
+    outputs = torch.cat(outputs)
+    known = data_y >= 0
+    loss = torch.nn.functional.binary_cross_entropy_with_logits(
+                                    outputs[known], data_y[known]).item()
+    probabilities = torch.sigmoid(outputs)
+    return {'loss' : loss,
+            'auc' : [get_auc(probabilities[known[:, i], i],
+                             data_y[known[:, i], i])
+                     for i in range(data_y.shape[1])],
+            'samples_per_sec' : data_x.shape[0] / max(perf_counter() - start,
+                                                      1e-9)}
+
+
+def fit_stacked(model : torch.nn.Module, train_x : torch.Tensor,
+                train_y : torch.Tensor, test_x : torch.Tensor,
+                test_y : torch.Tensor, epochs : int = MAX_EPOCHS,
+                batch_size : int = BATCH_SIZE,
+                learning_rate : float = LEARNING_RATE,
+                progress : bool = True) -> tuple:
+    """
+    Train a head on stacked data and keep the best state
+    ====================================================
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Model to train, it is moved to DEVICE.
+    train_x : torch.Tensor
+        Stacked training inputs with shape (samples, features).
+    train_y : torch.Tensor
+        Stacked training targets with shape (samples,). Values between 0 and
+        1 are used as soft targets.
+    test_x : torch.Tensor
+        Stacked test inputs.
+    test_y : torch.Tensor
+        Stacked binary test targets.
+    epochs : int, optional (MAX_EPOCHS if omitted)
+        Number of epochs.
+    batch_size : int, optional (BATCH_SIZE if omitted)
+        Size of training batches.
+    learning_rate : float, optional (LEARNING_RATE if omitted)
+        Learning rate of the Adam optimizer.
+    progress : bool, optional (True if omitted)
+        Whether to print the test loss and AUC of every epoch.
+
+    Returns
+    -------
+    tuple(dict, dict)
+        CPU copy of the state dict with the lowest test loss, and its test
+        metrics (see evaluate()) with the extra key 'epoch'.
+
+    Notes
+    -----
+        The short training loop of the tools that derive heads from stored
+        features (cascade, pruning, low-rank heads, ...), without logging and
+        checkpoints of train_binary_classifiers().
+    """
+
+    # pylint: disable=no-member
+    #         torch has a member function randperm()
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    model = model.to(DEVICE)
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    criterion = torch.nn.BCEWithLogitsLoss()
+    metrics = MetricsAccumulator(test_x.shape[0], DEVICE)
+    best_state, best_result = None, None
+    for epoch in range(epochs):
+        model.train()
+        order = torch.randperm(train_x.shape[0])
+        for pos in range(0, train_x.shape[0], batch_size):
+            index = order[pos:pos + batch_size]
+            optimizer.zero_grad()
+            loss = criterion(model(train_x[index].to(DEVICE)).squeeze(1),
+                             train_y[index].to(DEVICE))
+            loss.backward()
+            optimizer.step()
+        result = evaluate(model, criterion, test_x, test_y, metrics)
+        if best_result is None or result['loss'] < best_result['loss']:
+            best_state = copy_to_cpu(model.state_dict())
+            best_result = dict(result, epoch=epoch + 1)
+        if progress:
+            print('Epoch {}: test loss {:.6f} -- auc {:.4f}'.format(
+                                    epoch + 1, result['loss'], result['auc']),
+                  flush=True)
+    return best_state, best_result
+
+
 def main():
     """
     Provides main functionality
@@ -43,6 +234,12 @@ def main():
         When the folder of raw dataset images doesn't exist.
     """
 
+    parser = ArgumentParser(description='Train ChainRad heads.')
+    parser.add_argument('--shared', action='store_true',
+                        help='Train one shared trunk head for every disease ' +
+                             'instead of independent heads.')
+    args = parser.parse_args()
+
     print('Device "{}" will be used for deep neural network operations.'
           .format(DEVICE))
     if not isdir(IMG_DIR):
@@ -57,7 +254,10 @@ def main():
         print('{} files doesn\'t have headless output. Let\'s create them.'
               .format(len(new_files)))
         save_headless_outputs(new_files)
-    train_binary_classifiers()
+    if args.shared:
+        train_shared_classifier()
+    else:
+        train_binary_classifiers()
 
 
 def save_headless_outputs(imagelist : list):
@@ -79,17 +279,88 @@ def save_headless_outputs(imagelist : list):
     headless = get_headless_models()
     for value in headless.values():
         value.to(DEVICE)
-    transform = get_training_transformer()
-    for filename in tqdm(imagelist, unit='image'):
-        name_root = filename.split('.')[0]
-        img = Image.open(join(IMG_DIR, filename)).convert('RGB')
-        img = transform(img).unsqueeze(0).to(DEVICE)
-        flats = []
-        for value in headless.values():
-            flats.append(value(img).squeeze(0).detach().cpu())
-        final = torch.cat(flats)
-        with open(join(OUT_DIR, '{}.out'.format(name_root)), 'wb') as outstream:
-            pickle.dump(final, outstream)
+    preprocessor = get_training_preprocessor()
+    for pos in tqdm(range(0, len(imagelist), FEATURE_BATCH_SIZE),
+                    unit='batch'):
+        filenames = imagelist[pos:pos + FEATURE_BATCH_SIZE]
+        imgs = load_batch([join(IMG_DIR, filename) for filename in filenames])
+        imgs = preprocessor(imgs.to(DEVICE))
+        with torch.no_grad():
+            finals = torch.cat([value(imgs).detach()
+                                for value in headless.values()], 1).cpu()
+        for filename, final in zip(filenames, finals):
+            name_root = filename.split('.')[0]
+            with open(join(OUT_DIR, '{}.out'.format(name_root)),
+                      'wb') as outstream:
+                pickle.dump(final.clone(), outstream)
+
+
+def train_epoch(model : torch.nn.Module, optimizer : torch.optim.Optimizer,
+                criterion : torch.nn.Module, dataset : list,
+                metrics : MetricsAccumulator, profiler : Profiler = None,
+                progress : bool = True) -> dict:
+    """
+    Train a model for an epoch
+    ==========================
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Model to train.
+    optimizer : torch.optim.Optimizer
+        Optimizer of the model.
+    criterion : torch.nn.Module
+        Loss function.
+    dataset : list
+        Batches in the form of get_data_in_batches().
+    metrics : MetricsAccumulator
+        Accumulator to collect metrics into. It is reset first.
+    profiler : Profiler, optional (None if omitted)
+        Profiler to time the 'data', 'forward', 'backward' and 'optimizer'
+        phases of each step with.
+    progress : bool, optional (True if omitted)
+        Whether to show a progress bar.
+
+    Returns
+    -------
+    dict
+        Computed metrics, see MetricsAccumulator.compute(), with the extra key
+        'samples_per_sec'.
+    """
+
+    # pylint: disable=too-many-arguments
+    #         We consider a better practice having long list of named arguments
+    #         then having **kwargs only.
+
+    # pylint: disable=no-member
+    #         toch has a member function stack()
+
+    # pylint: disable=not-callable
+    #         toch.tensor() is callable
+
+    if profiler is None:
+        profiler = Profiler()
+    metrics.reset()
+    model.train()
+    start = perf_counter()
+    for batch_x, batch_y in tqdm(dataset, unit='batch', total=len(dataset),
+                                 disable=not progress):
+        with profiler.stage('data'):
+            batch_x = torch.stack(batch_x).to(DEVICE)
+            batch_y = torch.tensor(batch_y).float().to(DEVICE)
+        with profiler.stage('forward'):
+            optimizer.zero_grad()
+            batch_y_hat = model(batch_x).squeeze(1)
+            loss = criterion(batch_y_hat, batch_y)
+        with profiler.stage('backward'):
+            loss.backward()
+        with profiler.stage('optimizer'):
+            optimizer.step()
+            metrics.update(batch_y_hat, batch_y, loss)
+    result = metrics.compute()
+    result['samples_per_sec'] = (metrics.sample_count /
+                                 max(perf_counter() - start, 1e-9))
+    return result
 
 
 def train_binary_classifiers():
@@ -112,16 +383,6 @@ def train_binary_classifiers():
     #         Same variables are separated due to readability of the code, some
     #         other are needed being separated.
 
-    # pylint: disable=no-member
-    #         toch has a member functions round(), stack(), sigmoid()
-    #         Link: https://pytorch.org/docs/stable/generated/torch.round.html
-    #         Link: https://pytorch.org/docs/stable/generated/torch.stack.html
-    #         Link: https://pytorch.org/docs/stable/generated/torch.sigmoid.html
-
-    # pylint: disable=not-callable
-    #         toch.tensor() is callable
-    #         Link: https://pytorch.org/docs/stable/generated/torch.tensor.html
-
     diseases_basics = check_and_get_basics()
     for disease, meta_file_id in diseases_basics.items():
         print('\rDisease: {} --- initializing model...        '.format(disease),
@@ -134,97 +395,167 @@ def train_binary_classifiers():
         print('\rDisease: {} --- creating datasets...         '.format(disease),
               end='')
         train_dataset = get_data_in_batches(meta_file_id, batch_size=BATCH_SIZE)
-        test_dataset = get_data_in_batches(meta_file_id, dataset_type='test',
-                                           batch_size=1, shuffle_count=1)
+        test_x, test_y = get_stacked_data(meta_file_id, dataset_type='test')
+        valid_x, valid_y = get_stacked_data(meta_file_id,
+                                            dataset_type='valid')
+        if DEVICE == 'cuda':
+            test_x, valid_x = test_x.pin_memory(), valid_x.pin_memory()
         print('\rDisease: #{} --- training...                 '.format(disease),
               end='', flush=True)
-        train_len = len(train_dataset)
-        test_len = len(test_dataset)
-        min_test_loss = 100.0
-        test_no_decrease_count = 0
-        with open(join(LOG_DIR, '{}.csv'.format(meta_file_id)), 'w',
-                  encoding='utf8') as outstream:
-            outstream.write('\t'.join(['epoch', 'train_loss', 'train_accuracy',
-                                       'test_loss', 'test_accuracy']) + '\n')
-        for epoch in range(MAX_EPOCHS):
-            epoch_loss = 0.0
-            epoch_preds, epoch_targets = [], []
-            disease_classifier.train()
+        train_metrics = MetricsAccumulator(sum(len(batch_y) for _, batch_y
+                                               in train_dataset), DEVICE)
+        test_metrics = MetricsAccumulator(max(test_x.shape[0],
+                                              valid_x.shape[0]), DEVICE)
+        checkpoints = CheckpointManager(MODEL_DIR, meta_file_id,
+                                        keep_top=CHECKPOINT_KEEP,
+                                        save_every=CHECKPOINT_EVERY)
+        resumed = checkpoints.resume(disease_classifier, optimizer)
+        first_epoch = resumed.get('epoch', 0)
+        test_no_decrease_count = resumed.get('test_no_decrease_count', 0)
+        if first_epoch > 0:
+            print('\rDisease: #{} --- resuming after epoch {}...'
+                  .format(disease, first_epoch), flush=True)
+        events = EventLogger(meta_file_id, LOG_DIR, resume_epoch=first_epoch)
+        for epoch in range(first_epoch, MAX_EPOCHS):
+            if test_no_decrease_count > 10:
+                break
             torch.cuda.empty_cache()
-            for batch_x, batch_y in tqdm(train_dataset, unit='batch',
-                                         total=train_len):
-                for _y in batch_y:
-                    epoch_targets.append(_y)
-                batch_x = torch.stack(batch_x).to(DEVICE)
-                batch_y = torch.tensor(batch_y).float().to(DEVICE)
-                optimizer.zero_grad()
-                batch_y_hat = disease_classifier(batch_x)
-                batch_y_hat = batch_y_hat.squeeze(1)
-                loss = criterion(batch_y_hat, batch_y)
-                loss.backward()
-                optimizer.step()
-                batch_loss = loss.item()
-                epoch_loss += batch_loss
-                batch_y_hat = torch.sigmoid(batch_y_hat)
-                batch_y_hat = torch.round(batch_y_hat).tolist()
-                for _y_hat in batch_y_hat:
-                    epoch_preds.append(int(_y_hat))
-            epoch_accuracy = get_accuracy(epoch_preds, epoch_targets)
-            epoch_loss /= train_len
-            print('{} TRAIN {:3d}/{:3d}: loss {:.9f} -- accuracy {:5.2f} %'
+            epoch_result = train_epoch(disease_classifier, optimizer,
+                                       criterion, train_dataset,
+                                       train_metrics)
+            train_speed = epoch_result['samples_per_sec']
+            epoch_loss = epoch_result['loss']
+            epoch_accuracy = epoch_result['accuracy']
+            print('{} TRAIN {:3d}/{:3d}: loss {:.9f} -- accuracy {:5.2f} % '
                   .format(disease, epoch + 1, MAX_EPOCHS, epoch_loss,
-                          epoch_accuracy * 100))
-            torch.save(disease_classifier.state_dict(),
-                       join(MODEL_DIR, '{}_{:03d}.statedict'.format(meta_file_id,
-                                                                    epoch + 1)))
-            test_loss = 0.0
-            test_preds, test_preds_float, test_targets = [], [], []
+                          epoch_accuracy * 100) +
+                  '-- {:.1f} samples/s'.format(train_speed))
             torch.cuda.empty_cache()
-            disease_classifier.eval()
-            with torch.no_grad():
-                for batch_x, batch_y in tqdm(test_dataset, unit='batch',
-                                             total=test_len):
-                    for _y in batch_y:
-                        test_targets.append(_y)
-                    batch_x = torch.stack(batch_x).to(DEVICE)
-                    batch_y = torch.tensor(batch_y).float().to(DEVICE)
-                    batch_y_hat = disease_classifier(batch_x)
-                    batch_y_hat = batch_y_hat.squeeze(1)
-                    loss = criterion(batch_y_hat, batch_y)
-                    batch_loss = loss.item()
-                    test_loss += batch_loss
-                    batch_y_hat = torch.sigmoid(batch_y_hat)
-                    batch_preds_float = batch_y_hat.tolist()
-                    for _y_hat in batch_preds_float:
-                        test_preds_float.append(float(_y_hat))
-                    batch_y_hat = torch.round(batch_y_hat).tolist()
-                    for _y_hat in batch_y_hat:
-                        test_preds.append(int(_y_hat))
-            test_accuracy = get_accuracy(test_preds, test_targets)
-            test_loss /= test_len
-            print('{} TEST {:3d}/{:3d}: loss {:.9f} -- accuracy {:5.2f} %'
+            test_result = evaluate(disease_classifier, criterion, test_x,
+                                   test_y, test_metrics)
+            test_loss = test_result['loss']
+            test_accuracy = test_result['accuracy']
+            print('{} TEST {:3d}/{:3d}: loss {:.9f} -- accuracy {:5.2f} % '
                   .format(disease, epoch + 1, MAX_EPOCHS, test_loss,
-                          test_accuracy  * 100),
+                          test_accuracy  * 100) +
+                  '-- AUC {:.4f} -- F1 {:.4f} -- {:.1f} samples/s'
+                  .format(test_result['auc'], test_result['f1'],
+                          test_result['samples_per_sec']),
                   flush=True)
-            with open(join(LOG_DIR, '{}.csv'.format(meta_file_id)), 'a',
-                      encoding='utf8') as outstream:
-                outstream.write('{}\t{}\t{}\t{}\t{}\n'.format(epoch + 1,
-                                epoch_loss, epoch_accuracy, test_loss,
-                                test_accuracy))
-            with open(join(LOG_DIR, 'last_{}.csv'.format(meta_file_id)), 'w',
-                      encoding='utf8') as outstream:
-                outstream.write('prediction\ttarget\n')
-                for _x, _y in zip(test_preds_float, test_targets):
-                    outstream.write('{}\t{}\n'.format(_x, _y))
-            disease_classifier.load_state_dict(torch.load(join(MODEL_DIR,
-                    '{}_{:03d}.statedict'.format(meta_file_id, epoch + 1))))
-            if test_loss <= min_test_loss:
+            events.log_predictions(*test_metrics.values())
+            events.log_epoch({'epoch' : epoch + 1,
+                              'train_loss' : epoch_loss,
+                              'train_accuracy' : epoch_accuracy,
+                              'test_loss' : test_loss,
+                              'test_accuracy' : test_accuracy,
+                              'test_auc' : test_result['auc'],
+                              'test_f1' : test_result['f1'],
+                              'train_samples_per_sec' : train_speed,
+                              'test_samples_per_sec' :
+                              test_result['samples_per_sec']})
+            if checkpoints.is_better(test_loss):
                 test_no_decrease_count = 0
-                min_test_loss = test_loss
             else:
                 test_no_decrease_count += 1
-            if test_no_decrease_count > 10:
-                break
+            checkpoints.update(epoch + 1, disease_classifier, test_loss,
+                               optimizer=optimizer,
+                               extra={'test_no_decrease_count' :
+                                      test_no_decrease_count})
+        checkpoints.close(finished=True)
+        events.close()
+        checkpoints.restore_best(disease_classifier)
+        valid_result = evaluate(disease_classifier, criterion, valid_x,
+                                valid_y, test_metrics)
+        print('{} VALID (best epoch {}): loss {:.9f} -- accuracy {:5.2f} % '
+              .format(disease, checkpoints.best_epoch, valid_result['loss'],
+                      valid_result['accuracy'] * 100) +
+              '-- AUC {:.4f} -- F1 {:.4f} -- {:.1f} samples/s'
+              .format(valid_result['auc'], valid_result['f1'],
+                      valid_result['samples_per_sec']),
+              flush=True)
+    print('Training finished.')
+
+
+def train_shared_classifier():
+    """
+    Train the shared trunk classifier of every disease
+    ==================================================
+
+    Notes
+    -----
+        Images of every disease's meta file are trained together. The loss of
+        a disease is masked out where the image is not in its meta file.
+        Outputs follow the alphabetical order of the meta file ids, the best
+        state is saved to SHARED_FILE.
+
+    See also
+    --------
+        Error codes : check_prerequisites_and_get_basics()
+    """
+
+    # pylint: disable=no-member
+    #         torch has a member function randperm()
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    meta_file_ids = sorted(check_and_get_basics().values())
+    model = SharedTrunkClassifier(len(meta_file_ids)).to(DEVICE)
+    optimizer = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
+    criterion = torch.nn.BCEWithLogitsLoss(reduction='none')
+    train_x, train_y = get_multilabel_data(meta_file_ids, 'train')
+    test_x, test_y = get_multilabel_data(meta_file_ids, 'test')
+    checkpoints = CheckpointManager(MODEL_DIR, 'shared',
+                                    keep_top=CHECKPOINT_KEEP,
+                                    save_every=CHECKPOINT_EVERY)
+    resumed = checkpoints.resume(model, optimizer)
+    first_epoch = resumed.get('epoch', 0)
+    test_no_decrease_count = resumed.get('test_no_decrease_count', 0)
+    events = EventLogger('shared', LOG_DIR, resume_epoch=first_epoch)
+    for epoch in range(first_epoch, MAX_EPOCHS):
+        if test_no_decrease_count > 10:
+            break
+        model.train()
+        start, train_loss = perf_counter(), 0.0
+        order = torch.randperm(train_x.shape[0])
+        for pos in tqdm(range(0, train_x.shape[0], BATCH_SIZE), unit='batch'):
+            index = order[pos:pos + BATCH_SIZE]
+            batch_y = train_y[index].to(DEVICE)
+            known = (batch_y >= 0).float()
+            optimizer.zero_grad()
+            loss = (criterion(model(train_x[index].to(DEVICE)),
+                              batch_y.clamp(min=0.0)) * known).sum() / \
+                   known.sum().clamp(min=1.0)
+            loss.backward()
+            optimizer.step()
+            train_loss += loss.item() * index.numel()
+        train_time = perf_counter() - start
+        test_result = evaluate_multilabel(model, test_x, test_y)
+        print('SHARED {:3d}/{:3d}: train loss {:.9f} -- test loss {:.9f} -- '
+              .format(epoch + 1, MAX_EPOCHS, train_loss / train_x.shape[0],
+                      test_result['loss']) +
+              'mean AUC {:.4f} -- {:.1f} s'.format(
+                            sum(test_result['auc']) / len(test_result['auc']),
+                            train_time), flush=True)
+        events.log_epoch(dict({'epoch' : epoch + 1,
+                               'train_loss' : train_loss / train_x.shape[0],
+                               'test_loss' : test_result['loss'],
+                               'train_seconds' : train_time},
+                              **{'test_auc_{}'.format(meta_file_id) : auc
+                                 for meta_file_id, auc
+                                 in zip(meta_file_ids, test_result['auc'])}))
+        if checkpoints.is_better(test_result['loss']):
+            test_no_decrease_count = 0
+        else:
+            test_no_decrease_count += 1
+        checkpoints.update(epoch + 1, model, test_result['loss'],
+                           optimizer=optimizer,
+                           extra={'test_no_decrease_count' :
+                                  test_no_decrease_count})
+    checkpoints.close(finished=True)
+    events.close()
+    checkpoints.restore_best(model)
+    torch.save(copy_to_cpu(model.state_dict()), SHARED_FILE)
     print('Training finished.')
 
 
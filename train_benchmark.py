@@ -0,0 +1,201 @@
+"""
+ChainRad
+========
+
+File: head training benchmark
+"""
+
+
+# Standard library imports
+from argparse import ArgumentParser
+from json import dump as json_dump
+from platform import machine, processor, python_version
+from tempfile import TemporaryDirectory
+from time import perf_counter, strftime
+
+# 3rd party imports
+import torch
+
+# Project level imports
+from checkpoint import CheckpointManager
+from core import HEADLESS_FEATURES, SoloClassifier
+from eventlog import EventLogger
+from metrics import MetricsAccumulator
+from profiling import Profiler
+import train
+
+
+def get_synthetic_data(sample_count : int, batch_size : int,
+                       seed : int = 0) -> tuple:
+    """
+    Get synthetic headless outputs
+    ==============================
+
+    Parameters
+    ----------
+    sample_count : int
+        Number of samples.
+    batch_size : int
+        Size of training batches.
+    seed : int, optional (0 if omitted)
+        Seed of the random generator.
+
+    Returns
+    -------
+    tuple(list, torch.Tensor, torch.Tensor)
+        Training batches in the form of core.get_data_in_batches(), and the
+        same samples stacked as evaluation inputs and targets.
+
+    Notes
+    -----
+        Features are non-negative like the outputs of the headless models,
+        targets are balanced and weakly correlated with the features, so the
+        loss actually moves.
+    """
+
+    # pylint: disable=no-member
+    #         torch has member functions Generator(), rand(), randperm()
+
+    generator = torch.Generator().manual_seed(seed)
+    data_y = (torch.randperm(sample_count, generator=generator) % 2).float()
+    data_x = torch.rand(sample_count, HEADLESS_FEATURES, generator=generator)
+    data_x[:, :64] += data_y.unsqueeze(1) * 0.5
+    dataset = []
+    for pos in range(0, sample_count, batch_size):
+        dataset.append((list(data_x[pos:pos + batch_size]),
+                        data_y[pos:pos + batch_size].int().tolist()))
+    return dataset, data_x, data_y
+
+
+def main():
+    """
+    Provides main functionality
+    ===========================
+    """
+
+    parser = ArgumentParser(description='ChainRad head training benchmark.')
+    parser.add_argument('--samples', type=int, default=2048)
+    parser.add_argument('--eval-samples', type=int, default=1024)
+    parser.add_argument('--batch-size', type=int, default=train.BATCH_SIZE)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--threads', type=int,
+                        default=torch.get_num_threads())
+    parser.add_argument('--output', default='train_benchmark_{}.json'.format(
+                                                strftime('%Y%m%d%H%M%S')))
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    result = run(args.samples, args.eval_samples, args.batch_size,
+                 args.epochs)
+    result['environment']['threads'] = args.threads
+    with open(args.output, 'w', encoding='utf8') as outstream:
+        json_dump(result, outstream, indent=2)
+    print('Results written to "{}".'.format(args.output))
+
+
+def run(sample_count : int, eval_count : int, batch_size : int,
+        epochs : int) -> dict:
+    """
+    Run the benchmark
+    =================
+
+    Parameters
+    ----------
+    sample_count : int
+        Number of training samples.
+    eval_count : int
+        Number of evaluation samples.
+    batch_size : int
+        Size of training batches.
+    epochs : int
+        Number of epochs to run.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys 'environment' and 'epochs'. Every epoch has
+        samples/sec of training and evaluation, per-step time of the 'data',
+        'forward', 'backward' and 'optimizer' phases in ms, and the time of
+        logging and checkpointing in ms.
+
+    Notes
+    -----
+        The benchmark uses the same train.train_epoch() and train.evaluate()
+        functions, metrics accumulator, event logger and checkpoint manager
+        as the real training, with files written into a temporary directory.
+    """
+
+    # pylint: disable=too-many-locals
+    #         Same variables are separated due to readability of the code.
+
+    dataset, _, _ = get_synthetic_data(sample_count, batch_size)
+    _, eval_x, eval_y = get_synthetic_data(eval_count, batch_size, seed=1)
+    model = SoloClassifier().to(train.DEVICE)
+    optimizer = torch.optim.Adam(model.parameters(), lr=train.LEARNING_RATE)
+    criterion = torch.nn.BCEWithLogitsLoss()
+    train_metrics = MetricsAccumulator(sample_count, train.DEVICE)
+    eval_metrics = MetricsAccumulator(eval_count, train.DEVICE)
+    profiler = Profiler(enabled=True)
+    result = {'environment' : {'python' : python_version(),
+                               'torch' : torch.__version__,
+                               'machine' : machine(),
+                               'processor' : processor(),
+                               'device' : train.DEVICE,
+                               'samples' : sample_count,
+                               'eval_samples' : eval_count,
+                               'batch_size' : batch_size},
+              'epochs' : []}
+    with TemporaryDirectory() as directory:
+        checkpoints = CheckpointManager(directory, 'benchmark',
+                                        save_every=1)
+        events = EventLogger('benchmark', directory)
+        for epoch in range(epochs):
+            profiler.totals, profiler.counts = {}, {}
+            train_result = train.train_epoch(model, optimizer, criterion,
+                                             dataset, train_metrics,
+                                             profiler=profiler,
+                                             progress=False)
+            steps = max(profiler.counts.get('data', 0), 1)
+            eval_result = train.evaluate(model, criterion, eval_x, eval_y,
+                                         eval_metrics)
+            start = perf_counter()
+            events.log_predictions(*eval_metrics.values())
+            events.log_epoch({'epoch' : epoch + 1,
+                              'train_loss' : train_result['loss'],
+                              'test_loss' : eval_result['loss']})
+            logging_time = perf_counter() - start
+            start = perf_counter()
+            checkpoints.update(epoch + 1, model, eval_result['loss'],
+                               optimizer=optimizer)
+            checkpoint_time = perf_counter() - start
+            start = perf_counter()
+            checkpoints.flush()
+            checkpoint_flush_time = perf_counter() - start
+            epoch_result = {'epoch' : epoch + 1,
+                            'train_samples_per_sec' :
+                            train_result['samples_per_sec'],
+                            'eval_samples_per_sec' :
+                            eval_result['samples_per_sec'],
+                            'step_ms' : {name : profiler.totals.get(name, 0.0)
+                                         * 1000 / steps
+                                         for name in ['data', 'forward',
+                                                      'backward',
+                                                      'optimizer']},
+                            'logging_ms' : logging_time * 1000,
+                            'checkpoint_ms' : checkpoint_time * 1000,
+                            'checkpoint_background_ms' :
+                            checkpoint_flush_time * 1000}
+            print('Epoch {}: train {:.1f} samples/s -- eval {:.1f} samples/s '
+                  .format(epoch + 1, epoch_result['train_samples_per_sec'],
+                          epoch_result['eval_samples_per_sec']) +
+                  '-- step ' + ', '.join('{} {:.2f} ms'.format(name, value)
+                                         for name, value
+                                         in epoch_result['step_ms'].items()),
+                  flush=True)
+            result['epochs'].append(epoch_result)
+        checkpoints.close()
+        events.close()
+    return result
+
+
+if __name__ == '__main__':
+    main()
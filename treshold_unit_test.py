@@ -0,0 +1,71 @@
+"""
+ChainRad
+========
+
+File: unit test for applying tresholds
+"""
+
+
+from core import load_diseases
+from inference import SessionSetup, apply_treshold
+
+
+# pylint: disable=invalid-name
+#         The variables failed and passed are actually not constants.
+
+
+failed, passed = 0, 0
+
+
+def report(title : str, is_successful : bool):
+    """
+    Print and count the result of a test
+    ====================================
+
+    Parameters
+    ----------
+    title : str
+        Title of the test.
+    is_successful : bool
+        Whether the test passed.
+    """
+
+    # pylint: disable=global-statement
+    #         Counters are shared by the whole script.
+
+    global failed, passed
+    print('--- Test: {}: '.format(title), end='')
+    if is_successful:
+        print('PASSED')
+        passed += 1
+    else:
+        print('FAILED')
+        failed += 1
+
+
+tresholds = {key : value['treshold'] for key, value
+             in load_diseases().items() if 'treshold' in value.keys()}
+# Only the tresholds are needed, no models are loaded.
+SessionSetup.tresholds = lambda: tresholds
+print('Testing stored tresholds...')
+for key, treshold in tresholds.items():
+    report('{} at treshold'.format(key), apply_treshold(treshold, key) == 1)
+    report('{} just below treshold'.format(key),
+           apply_treshold(treshold - 1e-6, key) == 0)
+    report('{} just above treshold'.format(key),
+           apply_treshold(treshold + 1e-6, key) == 1)
+print('Testing the probability scale...')
+tresholds['low'] = 0.3
+# The logit of 0.55 is about 0.2, below the treshold on the logit scale.
+report('probability above a low treshold', apply_treshold(0.55, 'low') == 1)
+report('probability below a low treshold', apply_treshold(0.29, 'low') == 0)
+print('Testing the default treshold...')
+report('default at 0.5', apply_treshold(0.5, 'unknown') == 1)
+report('default below 0.5', apply_treshold(0.49, 'unknown') == 0)
+report('default above 0.5', apply_treshold(0.6, 'unknown') == 1)
+print('Overall test: ', end='')
+if failed == 0:
+    print('PASSED', end='')
+else:
+    print('FAILED', end='')
+print(' --- passes: {}; fails: {}'.format(passed, failed))
@@ -0,0 +1,283 @@
+"""
+ChainRad
+========
+
+File: priority worklist triage
+"""
+
+
+# Standard library imports
+from argparse import ArgumentParser
+from heapq import heapify, heappop, heappush, nsmallest
+from itertools import count
+from time import time
+
+# Project level imports
+from results import RESULTS_FILE, ResultStore
+
+
+URGENCY_WEIGHTS = {'pneumothorax' : 5.0, 'edema' : 3.0, 'pneumonia' : 3.0,
+                   'consolidation' : 2.5, 'effusion' : 2.0, 'mass' : 2.0,
+                   'cardiomegaly' : 1.5, 'atelectasis' : 1.5,
+                   'infiltration' : 1.0, 'nodule' : 1.0, 'emphysema' : 1.0,
+                   'pleural_thickening' : 0.5, 'fibrosis' : 0.5,
+                   'hernia' : 0.5}
+
+
+class Worklist:
+    """
+    Priority queue of scored studies
+    ================================
+
+    Notes
+    -----
+        Studies are ordered by descending urgency, studies with the same
+        urgency by arrival. The urgency is computed once from the stored
+        probabilities, so neither adding studies nor changing the urgency
+        function requires scoring again. Adding and removing a study costs
+        O(log n), removed and replaced entries are dropped lazily.
+    """
+
+
+    def __init__(self, urgency : callable = None):
+        """
+        Initialize the object
+        =====================
+
+        Parameters
+        ----------
+        urgency : callable, optional (None if omitted)
+            Function that gets the probabilities by disease key and returns
+            a float, higher is more urgent. If omitted, get_urgency() is used.
+        """
+
+        self.urgency = get_urgency if urgency is None else urgency
+        self.__counter = count()
+        self.__entries = {}
+        self.__heap = []
+
+
+    def __len__(self) -> int:
+        """
+        Get the number of studies
+        =========================
+
+        Returns
+        -------
+        int
+            Number of studies in the worklist.
+        """
+
+        return len(self.__entries)
+
+
+    def add(self, records : list):
+        """
+        Add or update studies
+        =====================
+
+        Parameters
+        ----------
+        records : list[dict]
+            Records in the form of inference.score(). A record with the
+            content hash of a study in the worklist replaces that study.
+        """
+
+        for record in records:
+            if record['content_hash'] in self.__entries.keys():
+                self.__entries[record['content_hash']][3] = None
+            entry = [-self.urgency(record['probabilities']),
+                     next(self.__counter), record['content_hash'], record]
+            self.__entries[record['content_hash']] = entry
+            heappush(self.__heap, entry)
+        self.__compact()
+
+
+    def page(self, offset : int, limit : int) -> list:
+        """
+        Get studies in priority order
+        =============================
+
+        Parameters
+        ----------
+        offset : int
+            Number of studies to skip.
+        limit : int
+            Maximum number of studies.
+
+        Returns
+        -------
+        list[dict]
+            Records in priority order, with the key 'urgency' added.
+        """
+
+        result = []
+        for entry in nsmallest(offset + limit, self.__entries.values()
+                               )[offset:]:
+            result.append(dict(entry[3], urgency=-entry[0]))
+        return result
+
+
+    def pop(self) -> dict:
+        """
+        Take the most urgent study
+        ==========================
+
+        Returns
+        -------
+        dict | None
+            Record of the most urgent study with the key 'urgency' added, or
+            None if the worklist is empty.
+        """
+
+        while len(self.__heap) > 0:
+            entry = heappop(self.__heap)
+            if entry[3] is not None:
+                del self.__entries[entry[2]]
+                return dict(entry[3], urgency=-entry[0])
+        return None
+
+
+    def remove(self, content_hash : str) -> bool:
+        """
+        Remove a study
+        ==============
+
+        Parameters
+        ----------
+        content_hash : str
+            Content hash of the study.
+
+        Returns
+        -------
+        bool
+            True if the study was in the worklist, False if not.
+        """
+
+        if content_hash not in self.__entries.keys():
+            return False
+        self.__entries.pop(content_hash)[3] = None
+        self.__compact()
+        return True
+
+
+    def reprioritize(self, urgency : callable):
+        """
+        Change the urgency function
+        ===========================
+
+        Parameters
+        ----------
+        urgency : callable
+            New urgency function, see Worklist().
+
+        Notes
+        -----
+            Urgencies are computed again from the stored probabilities and
+            the heap is rebuilt in O(n).
+        """
+
+        self.urgency = urgency
+        for entry in self.__entries.values():
+            entry[0] = -urgency(entry[3]['probabilities'])
+        self.__heap = list(self.__entries.values())
+        heapify(self.__heap)
+
+
+    def __compact(self):
+        """
+        Drop stale entries if they are the majority of the heap
+        =======================================================
+        """
+
+        if len(self.__heap) > 2 * len(self.__entries) + 16:
+            self.__heap = list(self.__entries.values())
+            heapify(self.__heap)
+
+
+def get_urgency(probabilities : dict, weights : dict = None) -> float:
+    """
+    Get the urgency of a study
+    ==========================
+
+    Parameters
+    ----------
+    probabilities : dict
+        Probabilities by disease key.
+    weights : dict, optional (None if omitted)
+        Weights by disease key. If omitted, URGENCY_WEIGHTS is used. Diseases
+        without a weight get 1.0.
+
+    Returns
+    -------
+    float
+        The largest weighted probability. A single likely critical finding
+        makes a study urgent, many unlikely findings don't.
+    """
+
+    if weights is None:
+        weights = URGENCY_WEIGHTS
+    return max([probability * weights.get(key, 1.0) for key, probability
+                in probabilities.items() if probability is not None],
+               default=0.0)
+
+
+def get_weighted_urgency(weights : dict) -> callable:
+    """
+    Get an urgency function with custom weights
+    ===========================================
+
+    Parameters
+    ----------
+    weights : dict
+        Weights by disease key, missing keys are taken from URGENCY_WEIGHTS.
+
+    Returns
+    -------
+    callable
+        Urgency function for Worklist().
+    """
+
+    merged = dict(URGENCY_WEIGHTS, **weights)
+    return lambda probabilities: get_urgency(probabilities, merged)
+
+
+def main():
+    """
+    Provides main functionality
+    ===========================
+    """
+
+    parser = ArgumentParser(description='List stored ChainRad results in ' +
+                                        'order of urgency.')
+    parser.add_argument('--store', default=RESULTS_FILE,
+                        help='SQLite file of the result store.')
+    parser.add_argument('--hours', type=float, default=24.0,
+                        help='Studies scored in the last hours.')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--weight', action='append', default=[],
+                        metavar='KEY=VALUE', help='Urgency weight of a ' +
+                                                  'disease.')
+    args = parser.parse_args()
+    weights = {}
+    for item in args.weight:
+        key, value = item.split('=', 1)
+        weights[key] = float(value)
+    store = ResultStore(args.store)
+    worklist = Worklist(get_weighted_urgency(weights))
+    since, offset = time() - args.hours * 3600, 0
+    page = store.page(offset, 1000, since=since)
+    while len(page) > 0:
+        worklist.add(page)
+        offset += len(page)
+        page = store.page(offset, 1000, since=since)
+    store.close()
+    for record in worklist.page(0, args.limit):
+        top = max(record['probabilities'].items(),
+                  key=lambda item: item[1] if item[1] is not None else -1.0)
+        print('{:8.4f}  {:<20} {:.4f}  {}'.format(record['urgency'], top[0],
+                                                  top[1], record['image']))
+
+
+if __name__ == '__main__':
+    main()